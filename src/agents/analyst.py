@@ -1,23 +1,24 @@
 """
     Analyst will receive the data and will try to make some insigts on the data and return the summary.
 """
+import asyncio
 
-from typing import Literal
+from typing import List, Literal
 
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
 
 from langgraph.types import Command
 
 from state_schemas import ApplicationState
 from config.models import llm
+from agents.context_builder import build_context, last_question
+from agents import document_refs
 
 import logging
 
 _logger = logging.getLogger(__name__)
 
-def analyst_node(state: ApplicationState) -> Command[Literal["supervisor_node"]]:
-    
-    systemMessage = SystemMessage(content="""
+_CONST_SYSTEM_MESSAGE = SystemMessage(content="""
                                     You are a highly skilled data analysis assistant. Your primary role is to analyze the data provided by the user, uncover meaningful insights, and present findings in a clear, concise, and actionable manner.
                                     Follow these guidelines to fulfill your role:
                                     
@@ -53,11 +54,14 @@ def analyst_node(state: ApplicationState) -> Command[Literal["supervisor_node"]]
                                         
                                     Your role is to be an analytical partner, combining technical rigor with user-friendly communication to deliver impactful insights from the provided data.
                                     """)
+
+def _prompt(state: ApplicationState) -> List[BaseMessage]:
+    context = build_context(document_refs.load(state["documents"]), last_question(state["messages"]))
+    documents_message = HumanMessage(content="Here are the raw contents of the data: \n" + context.text, name="documents")
     
-    documents_message = HumanMessage(content="Here are the raw contents of the data: \n" + "\n---------\n".join(state["documents"]), name="documents")
-    
-    result = llm.invoke([systemMessage] + state["messages"][-1:] + [documents_message])
+    return [_CONST_SYSTEM_MESSAGE] + state["messages"][-1:] + [documents_message]
 
+def _command(result: BaseMessage) -> Command[Literal["supervisor_node"]]:
     return Command(
         update={
             "messages": [
@@ -65,4 +69,15 @@ def analyst_node(state: ApplicationState) -> Command[Literal["supervisor_node"]]
             ]
         },
         goto="supervisor_node",
-    )
\ No newline at end of file
+    )
+
+def analyst_node(state: ApplicationState) -> Command[Literal["supervisor_node"]]:
+    
+    return _command(llm.invoke(_prompt(state)))
+
+async def aanalyst_node(state: ApplicationState) -> Command[Literal["supervisor_node"]]:
+    """Async analyst_node, used by app.aquery"""
+    
+    # reading the documents and building the context is sync (files, sqlite, tokenizer), keep it off the event loop
+    prompt = await asyncio.to_thread(_prompt, state)
+    return _command(await llm.ainvoke(prompt))
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""
+chart_cache keeps the rendered charts on disk, content addressed: the key is a hash of what the chart is drawn from
+(the template code with the data for the template charts, the question and the data for the code agent charts).
+The same chart asked again is returned right away, without the llm and matplotlib.
+
+    - size bounded (CHART_CACHE_MAX_MB), least recently used charts are removed first (a hit touches the files' mtime).
+      The chat keeps the bytes of the charts it shows (see ui.chat), so removing a file doesn't break the history
+    - the visualizer's tempfiles (CHART_FILE_PREFIX in the system tmp dir) left from the failed or older attempts
+      are garbage collected once they are older than CHART_TEMPFILE_MAX_AGE_HOURS
+"""
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from typing import Any, List, Union
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+CHART_CACHE_PATH = "data/chart_cache/"
+
+# The visualizer writes the charts it didn't get from the cache to the system tmp dir with this prefix
+CHART_FILE_PREFIX = "iii_chart_"
+
+_CONST_MAX_BYTES = int(os.getenv("CHART_CACHE_MAX_MB", "128")) * 1024 * 1024
+
+_CONST_TEMPFILE_MAX_AGE_SECONDS = float(os.getenv("CHART_TEMPFILE_MAX_AGE_HOURS", "24")) * 3600
+
+# Garbage collection runs with a put, at most this often
+_CONST_GC_INTERVAL_SECONDS = 3600
+
+_lock = threading.Lock()
+_last_gc = 0.0
+
+
+def key(*parts: Any) -> str:
+    """Content hash of everything the chart is drawn from"""
+
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _files(chart_key: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(CHART_CACHE_PATH, f"{chart_key}.*.png")), key=lambda path: int(path.split(".")[-2]))
+
+
+def get(chart_key: str) -> Union[List[str], None]:
+    """Paths of the cached chart images or None"""
+
+    with _lock:
+        paths = _files(chart_key)
+        if not paths:
+            return None
+
+        now = time.time()
+        for path in paths:
+            os.utime(path, (now, now))
+
+    _logger.info(f"Chart cache hit {chart_key[:12]}")
+    return paths
+
+
+def put(chart_key: str, images: List[bytes]) -> List[str]:
+    """Stores the images of the chart and returns their paths in the cache"""
+
+    os.makedirs(CHART_CACHE_PATH, exist_ok=True)
+    paths = []
+    with _lock:
+        # images of an older render with more of them, get() would return them with the new ones
+        for stale_path in _files(chart_key)[len(images):]:
+            os.remove(stale_path)
+
+        for index, image in enumerate(images):
+            path = os.path.join(CHART_CACHE_PATH, f"{chart_key}.{index}.png")
+            with tempfile.NamedTemporaryFile("wb", dir=CHART_CACHE_PATH, prefix=".chart_", delete=False) as f:
+                f.write(image)
+            os.replace(f.name, path)
+            paths.append(path)
+
+        _evict()
+
+    _maybe_collect_garbage()
+    return paths
+
+
+def is_chart_tempfile(path: str) -> bool:
+    return os.path.dirname(os.path.abspath(path)) == os.path.abspath(tempfile.gettempdir()) \
+        and os.path.basename(path).startswith(CHART_FILE_PREFIX) and os.path.isfile(path)
+
+
+def put_files(chart_key: str, image_paths: List[str]) -> List[str]:
+    """Moves the visualizer tempfiles into the cache and returns their new paths"""
+
+    images = []
+    for image_path in image_paths:
+        with open(image_path, "rb") as f:
+            images.append(f.read())
+
+    paths = put(chart_key, images)
+    for image_path in image_paths:
+        os.remove(image_path)
+
+    return paths
+
+
+def _evict():
+    """Removes whole charts (all the images of a key), the least recently used first"""
+
+    charts = {}
+    for path in glob.glob(os.path.join(CHART_CACHE_PATH, "*.png")):
+        stat = os.stat(path)
+        paths, size, used = charts.get(os.path.basename(path).split(".")[0], ([], 0, 0.0))
+        charts[os.path.basename(path).split(".")[0]] = (paths + [path], size + stat.st_size, max(used, stat.st_mtime))
+
+    total = sum(size for _, size, _ in charts.values())
+    if total <= _CONST_MAX_BYTES:
+        return
+
+    # down to 90% of the limit, so we don't evict on every put
+    removed = 0
+    for paths, size, _ in sorted(charts.values(), key=lambda chart: chart[2]):
+        if total <= _CONST_MAX_BYTES * 0.9:
+            break
+        for path in paths:
+            os.remove(path)
+        total -= size
+        removed += 1
+
+    _logger.info(f"Chart cache: evicted {removed} charts")
+
+
+def collect_garbage(max_age_seconds: float = _CONST_TEMPFILE_MAX_AGE_SECONDS) -> int:
+    """Removes the visualizer tempfiles older than max_age_seconds. Returns how many were removed"""
+
+    global _last_gc
+    _last_gc = time.time()
+
+    removed = 0
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), f"{CHART_FILE_PREFIX}*")):
+        try:
+            if _last_gc - os.path.getmtime(path) > max_age_seconds:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            # removed by someone else in the meantime
+            continue
+
+    if removed:
+        _logger.info(f"Removed {removed} chart tempfiles")
+    return removed
+
+
+def _maybe_collect_garbage():
+    if time.time() - _last_gc > _CONST_GC_INTERVAL_SECONDS:
+        collect_garbage()
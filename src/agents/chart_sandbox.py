@@ -0,0 +1,144 @@
+"""
+chart_sandbox runs the llm generated chart code outside of the app process.
+
+A pool of worker processes (see chart_worker) is started ahead of time, with matplotlib (Agg) already imported and warmed up.
+Every job runs in one of them under a cpu time, memory (RLIMIT_AS) and wall clock limit and returns the figures as png bytes.
+A worker that hangs or dies is killed and replaced, so a bad script can't take the app down with it.
+Workers are also recycled after a number of jobs, so leaks of the generated code don't pile up.
+
+Uses socketpair + pass_fds and the resource module - Linux / macOS only.
+"""
+import atexit
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+
+from multiprocessing.connection import Connection
+from typing import List, Union
+
+from pydantic import BaseModel, Field
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_CONST_WORKERS = int(os.getenv("CHART_WORKERS", "2"))
+_CONST_TIMEOUT_SECONDS = int(os.getenv("CHART_TIMEOUT_SECONDS", "20"))
+_CONST_MEMORY_MB = int(os.getenv("CHART_MEMORY_MB", "2048"))
+
+# A worker is replaced after this many jobs
+_CONST_MAX_JOBS_PER_WORKER = 50
+
+# Importing matplotlib and building the font cache on a cold start
+_CONST_STARTUP_TIMEOUT_SECONDS = 60
+
+_CONST_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chart_worker.py")
+
+
+class ChartResult(BaseModel):
+    images: List[bytes] = Field(default_factory=list, description="png images, one per figure created by the code")
+    stdout: str = ""
+    error: Union[str, None] = Field(default=None, description="why the code failed, None on success")
+
+
+class _Worker:
+    def __init__(self, memory_mb: int):
+        parent_socket, child_socket = socket.socketpair()
+        environment = dict(os.environ, OPENBLAS_NUM_THREADS="1", OMP_NUM_THREADS="1", MPLBACKEND="Agg")
+        self.process = subprocess.Popen(
+            [sys.executable, _CONST_WORKER_SCRIPT, str(child_socket.fileno()), str(memory_mb)],
+            pass_fds=[child_socket.fileno()],
+            stdin=subprocess.DEVNULL,
+            env=environment,
+        )
+        child_socket.close()
+        self.connection = Connection(parent_socket.detach())
+        self.ready = False
+        self.jobs = 0
+
+    def wait_ready(self) -> bool:
+        if not self.ready and self.connection.poll(_CONST_STARTUP_TIMEOUT_SECONDS):
+            self.ready = self.connection.recv() == "ready"
+        return self.ready
+
+    def close(self):
+        self.connection.close()
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+
+class ChartSandbox:
+    def __init__(self, workers: int = _CONST_WORKERS, timeout_seconds: int = _CONST_TIMEOUT_SECONDS, memory_mb: int = _CONST_MEMORY_MB):
+        """
+        Args:
+            workers: how many processes are kept ready. That's also how many charts are rendered at the same time.
+            timeout_seconds: wall clock and cpu time limit of a single job
+            memory_mb: address space limit of a worker process
+        """
+        self.timeout_seconds = timeout_seconds
+        self.memory_mb = memory_mb
+
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        for _ in range(workers):
+            self._idle.put(_Worker(memory_mb))
+
+    def run(self, code: str) -> ChartResult:
+        """Executes the code in a worker and returns the figures it created"""
+
+        worker = self._idle.get()
+        try:
+            if not worker.wait_ready():
+                raise EOFError("worker did not start")
+
+            worker.connection.send((code, self.timeout_seconds))
+            worker.jobs += 1
+            if not worker.connection.poll(self.timeout_seconds):
+                _logger.warning(f"Chart code did not finish in {self.timeout_seconds}s, killing the worker")
+                worker.close()
+                worker = _Worker(self.memory_mb)
+                return ChartResult(error=f"Timed out after {self.timeout_seconds} seconds")
+
+            return ChartResult(**worker.connection.recv())
+        except (EOFError, OSError) as e:
+            # killed by the cpu limit, out of memory or crashed
+            _logger.warning(f"Chart worker died ({e!r}), exit code {worker.process.poll()}")
+            worker.close()
+            worker = _Worker(self.memory_mb)
+            return ChartResult(error="The chart process was terminated - the code used too much cpu time or memory or crashed")
+        finally:
+            if worker.jobs >= _CONST_MAX_JOBS_PER_WORKER:
+                worker.close()
+                worker = _Worker(self.memory_mb)
+            self._idle.put(worker)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_sandbox: Union[ChartSandbox, None] = None
+_sandbox_lock = threading.Lock()
+
+
+def get_sandbox() -> ChartSandbox:
+    """The shared sandbox. Workers are started on the first call (see warm_up)."""
+
+    global _sandbox
+    with _sandbox_lock:
+        if _sandbox is None:
+            _sandbox = ChartSandbox()
+            atexit.register(_sandbox.close)
+
+    return _sandbox
+
+
+def warm_up():
+    """Starts the workers ahead of the first chart. They import matplotlib in the background."""
+    get_sandbox()
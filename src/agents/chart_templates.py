@@ -0,0 +1,153 @@
+"""
+chart_templates draws the common iii.org charts without the code writing agent.
+
+The llm only fills in a ChartSpec (chart type, series, columns, year range) - a single structured output call.
+The values come straight from the series_store and the chart is drawn by a fixed matplotlib template
+(in the chart_sandbox, where matplotlib is already loaded).
+
+Templates:
+    line - values of one or more columns over the years
+    percent_change_bar - year over year percent change bars (the "Percent change" column if the spec picks one, computed otherwise)
+
+Anything else (chart_type "other", unknown series, no values) returns None and the visualizer falls back to the code agent.
+"""
+import json
+
+from typing import Dict, List, Literal, Tuple, Union
+
+from langchain_core.messages import HumanMessage, SystemMessage
+from pydantic import BaseModel, Field
+
+from config.models import llm
+from agents import series_store
+from agents.chart_sandbox import ChartResult, get_sandbox
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class ChartSpec(BaseModel):
+    """Chart of an iii.org yearly data series"""
+    chart_type: Literal["line", "percent_change_bar", "other"] = Field(
+        description="line - values over the years, percent_change_bar - year over year percent change, other - any other chart")
+    series: str = Field(description="exact series name from the list")
+    columns: List[str] = Field(description="exact column names of the series, at most 5")
+    year_from: Union[int, None] = Field(description="first year (inclusive) or null for all the years")
+    year_to: Union[int, None] = Field(description="last year (inclusive) or null for all the years")
+    title: str = Field(description="chart title")
+
+
+_CONST_SPEC_PROMPT = """
+    You choose a chart for the user request. The data comes from the iii.org yearly data series listed below (series: columns).
+    Use the exact series and column names from the list.
+    If the request needs a chart that is not a line chart over the years or a year over year percent change bar chart,
+    or if the data is not in the list, use chart_type "other".
+    """
+
+_CONST_LINE_TEMPLATE = """
+import matplotlib
+import matplotlib.pyplot as plt
+matplotlib.use('agg')
+
+data = json.loads({data!r})
+figure, axes = plt.subplots(figsize=(10, 5))
+for column, points in data.items():
+    axes.plot([point[0] for point in points], [point[1] for point in points], marker="o", label=column)
+axes.set_title({title!r})
+axes.set_xlabel("Year")
+axes.grid(alpha=0.3)
+axes.legend()
+"""
+
+_CONST_PERCENT_CHANGE_BAR_TEMPLATE = """
+import matplotlib
+import matplotlib.pyplot as plt
+matplotlib.use('agg')
+
+data = json.loads({data!r})
+figure, axes = plt.subplots(figsize=(10, 5))
+width = 0.8 / max(len(data), 1)
+for index, (column, points) in enumerate(data.items()):
+    years = [point[0] + (index - (len(data) - 1) / 2) * width for point in points]
+    changes = [point[1] for point in points]
+    colors = ["tab:green" if change >= 0 else "tab:red" for change in changes] if len(data) == 1 else None
+    axes.bar(years, changes, width=width, color=colors, label=column)
+axes.axhline(0, color="black", linewidth=0.8)
+axes.set_title({title!r})
+axes.set_xlabel("Year")
+axes.set_ylabel("Percent change")
+axes.grid(alpha=0.3, axis="y")
+if len(data) > 1:
+    axes.legend()
+"""
+
+
+def _spec_messages(question: str) -> list:
+    catalog = "\n".join(f"{series}: {', '.join(columns)}" for series, columns in series_store.yearly_columns().items())
+    return [SystemMessage(content=_CONST_SPEC_PROMPT + "\n" + catalog), HumanMessage(content=question)]
+
+
+def chart_spec(question: str) -> ChartSpec:
+    return llm.with_structured_output(ChartSpec).invoke(_spec_messages(question))
+
+
+async def achart_spec(question: str) -> ChartSpec:
+    return await llm.with_structured_output(ChartSpec).ainvoke(_spec_messages(question))
+
+
+def _points(spec: ChartSpec) -> Dict[str, List[Tuple[int, float]]]:
+    """column -> [(year, value)] of the spec. Columns without numeric values are left out"""
+
+    points = {}
+    for column in spec.columns:
+        # the lookup matches by words, "Legal services Index" also finds "Legal services (6) Index"
+        points[column] = [
+            (value.year, value.value)
+            for value in series_store.query(spec.series, column, spec.year_from, spec.year_to)
+            if value.series == spec.series and value.column_name == column and value.year is not None and value.value is not None
+        ]
+
+    return {column: sorted(column_points) for column, column_points in points.items() if column_points}
+
+
+def _percent_changes(column: str, points: List[Tuple[int, float]]) -> List[Tuple[int, float]]:
+    if "percent" in column.lower() or "change" in column.lower():
+        return points
+
+    return [
+        (year, round((value - previous) / previous * 100, 2))
+        for (_, previous), (year, value) in zip(points, points[1:])
+        if previous
+    ]
+
+
+def template_code(spec: ChartSpec) -> Union[str, None]:
+    """The template filled in with the data of the spec. None if the spec doesn't fit any template or there is no data for it"""
+
+    if spec.chart_type not in ("line", "percent_change_bar"):
+        return None
+
+    points = _points(spec)
+    if not points:
+        _logger.info(f"No values for the chart {spec}")
+        return None
+
+    if spec.chart_type == "percent_change_bar":
+        points = {column: _percent_changes(column, column_points) for column, column_points in points.items()}
+        template = _CONST_PERCENT_CHANGE_BAR_TEMPLATE
+    else:
+        template = _CONST_LINE_TEMPLATE
+
+    return "import json\n" + template.format(data=json.dumps(points), title=spec.title or spec.series)
+
+
+def render(code: str) -> Union[ChartResult, None]:
+    """Draws the template_code in the sandbox. None if it failed"""
+
+    result = get_sandbox().run(code)
+    if result.error:
+        _logger.warning(f"Chart template failed: {result.error}")
+        return None
+
+    return result
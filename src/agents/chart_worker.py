@@ -0,0 +1,98 @@
+"""
+chart_worker is the process chart_sandbox runs the generated chart code in. Not imported by the app, started as a script:
+    python chart_worker.py <socket fd> <memory limit in MB>
+
+matplotlib (Agg) is imported and warmed up once, before the worker reports it's ready.
+Then for every job (code, cpu seconds) the code is executed in a fresh namespace and
+all the open figures are sent back as png bytes: {"images": [bytes], "stdout": str, "error": str or None}
+"""
+import contextlib
+import io
+import sys
+import traceback
+
+from multiprocessing.connection import Connection
+
+try:
+    import resource
+except ImportError:  # not available on Windows, the jobs then run without the limits
+    resource = None
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+
+def _warm_up():
+    """First figure builds the font cache, so the first job doesn't pay for it"""
+    figure = plt.figure()
+    plt.plot([0, 1], [0, 1])
+    figure.savefig(io.BytesIO(), format="png")
+    plt.close("all")
+
+
+def _limit_memory(memory_mb: int):
+    if resource is not None and memory_mb > 0:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _limit_cpu(cpu_seconds: int):
+    """RLIMIT_CPU counts the whole life of the process, so the limit is set relative to the time used so far.
+    Over the limit the process gets SIGXCPU and dies, the sandbox replaces it."""
+    if resource is None or cpu_seconds <= 0:
+        return
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(usage.ru_utime + usage.ru_stime) + cpu_seconds
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _figures() -> list:
+    images = []
+    for number in plt.get_fignums():
+        buffer = io.BytesIO()
+        plt.figure(number).savefig(buffer, format="png", bbox_inches="tight")
+        images.append(buffer.getvalue())
+
+    return images
+
+
+def _run(code: str, cpu_seconds: int) -> dict:
+    _limit_cpu(cpu_seconds)
+    stdout = io.StringIO()
+    error = None
+    images = []
+    try:
+        with contextlib.redirect_stdout(stdout):
+            exec(compile(code, "<chart>", "exec"), {"__name__": "__main__"})
+        images = _figures()
+        if not images:
+            error = "The code did not create any matplotlib figure"
+    except BaseException:
+        error = traceback.format_exc(limit=3)
+    finally:
+        plt.close("all")
+
+    return {"images": images, "stdout": stdout.getvalue(), "error": error}
+
+
+def main():
+    connection = Connection(int(sys.argv[1]))
+    _warm_up()
+    _limit_memory(int(sys.argv[2]))
+    # the sandbox closes its end at shutdown (EOFError, often ConnectionResetError/BrokenPipeError), the worker just exits
+    try:
+        connection.send("ready")
+        while True:
+            code, cpu_seconds = connection.recv()
+            connection.send(_run(code, cpu_seconds))
+    except (EOFError, OSError):
+        return
+
+
+if __name__ == "__main__":
+    main()
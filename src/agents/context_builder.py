@@ -0,0 +1,209 @@
+"""
+context_builder prepares state["documents"] for the llm prompts of the analyst and the visualizer.
+
+The documents are raw iii.org html files (full of <font> and <td> tags) and series_store csv tables.
+Several retriever calls pile up the same files again and again, so the raw join can easily overflow the context window.
+
+    - html tables are converted to compact csv (see table_extractor), other html to plain text
+    - repeated documents are dropped
+    - documents are ranked by how many of the question words they contain (rarer words weigh more)
+    - the best ones are packed into the token budget (CONTEXT_TOKEN_BUDGET), the rows of the last one may be cut
+"""
+import csv
+import hashlib
+import io
+import math
+import os
+import re
+
+from functools import lru_cache
+from typing import Callable, List, Union
+
+from bs4 import BeautifulSoup
+from langchain_core.messages import AnyMessage, HumanMessage
+from pydantic import BaseModel, Field
+
+from agents.table_extractor import ExtractedTable, extract_table
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_CONST_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "12000"))
+
+# Used when tiktoken (or it's encoding files) is not available
+_CONST_CHARS_PER_TOKEN = 4
+
+# A cut document is only worth including if at least this many tokens are left for it
+_CONST_MIN_PARTIAL_TOKENS = 200
+
+_CONST_DOCUMENT_SEPARATOR = "\n---------\n"
+
+_CONST_YEAR_PATTERN = re.compile(r"^(19|20)\d\d$")
+
+_CONST_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+_CONST_STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "data", "did", "do", "does", "for", "from", "has", "have", "how",
+    "i", "in", "is", "it", "me", "of", "on", "or", "show", "that", "the", "this", "to", "was", "were", "what", "when",
+    "which", "with", "you",
+}
+
+
+class BuiltContext(BaseModel):
+    text: str = Field(description="documents to put into the prompt")
+    tokens: int = Field(description="tokens of the text")
+    raw_tokens: int = Field(description="tokens of the raw documents joined together")
+    documents: int = Field(description="documents included (fully or partly)")
+    dropped: int = Field(description="documents left out - duplicates or over the budget")
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.raw_tokens - self.tokens
+
+
+@lru_cache(maxsize=1)
+def _token_counter() -> Callable[[str], int]:
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("o200k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        _logger.info(f"tiktoken is not available ({e!r}), estimating tokens by the text length")
+        return lambda text: math.ceil(len(text) / _CONST_CHARS_PER_TOKEN)
+
+
+def count_tokens(text: str) -> int:
+    return _token_counter()(text)
+
+
+def _table_to_csv(table: ExtractedTable) -> str:
+    output = io.StringIO()
+    output.write(table.context() + "\n")
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow([table.label_header or "Label"] + table.columns)
+    rows = table.rows
+    if all(_CONST_YEAR_PATTERN.match(row.label) for row in rows):
+        # side by side layouts come out interleaved (1999, 2004, 2000, 2005, ...)
+        rows = sorted(rows, key=lambda row: row.label)
+
+    for row in rows:
+        writer.writerow([row.label] + [row.values.get(column, "") for column in table.columns])
+
+    if table.footnotes:
+        output.write(f"Notes: {table.footnotes}\n")
+
+    return output.getvalue()
+
+
+def _is_html(document: str) -> bool:
+    return bool(re.match(r"\s*<", document)) and bool(re.search(r"</(table|html|body|div|p|td)>", document, re.IGNORECASE))
+
+
+def compact_document(document: str) -> str:
+    """html table -> csv, other html -> text, anything else as is"""
+
+    if not _is_html(document):
+        return document.strip()
+
+    table = extract_table(document)
+    if table is not None:
+        return _table_to_csv(table)
+
+    return " ".join(BeautifulSoup(document, "html.parser").get_text(" ", strip=True).split())
+
+
+def _words(text: str) -> List[str]:
+    return [word for word in _CONST_WORD_PATTERN.findall(text.lower()) if word not in _CONST_STOP_WORDS]
+
+
+def _rank(pieces: List[str], question: str) -> List[int]:
+    """Indexes of the pieces, the most relevant first. Question words found in fewer pieces weigh more (idf)."""
+
+    question_words = set(_words(question))
+    piece_words = [set(_words(piece)) for piece in pieces]
+
+    def score(index: int) -> float:
+        return sum(
+            math.log((len(pieces) + 1) / (1 + sum(word in words for words in piece_words)))
+            for word in question_words if word in piece_words[index]
+        )
+
+    # stable: the retrieval order (best similarity first) breaks the ties
+    return sorted(range(len(pieces)), key=lambda index: -score(index))
+
+
+def _cut(piece: str, token_budget: int) -> str:
+    """Keeps the first lines (title, header and the first rows) that fit into the budget"""
+
+    lines = piece.splitlines()
+    kept = []
+    used = 0
+    for line in lines:
+        used += count_tokens(line) + 1
+        if used > token_budget:
+            break
+        kept.append(line)
+
+    return "\n".join(kept + [f"... {len(lines) - len(kept)} more rows left out"])
+
+
+def last_question(messages: List[AnyMessage]) -> str:
+    """The last user message. Workers' messages are named (retriever, analyst), user messages are not."""
+
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage) and not message.name:
+            return str(message.content)
+
+    return str(messages[-1].content) if messages else ""
+
+
+def build_context(documents: List[str], question: str, token_budget: Union[int, None] = None) -> BuiltContext:
+    """Compacts, deduplicates and ranks the documents and packs them into the token budget.
+
+    Args:
+        documents: state["documents"]
+        question: the user question the documents are ranked against
+        token_budget: defaults to CONTEXT_TOKEN_BUDGET env variable
+
+    Returns:
+        BuiltContext
+    """
+
+    token_budget = token_budget or _CONST_TOKEN_BUDGET
+    raw_tokens = count_tokens(_CONST_DOCUMENT_SEPARATOR.join(documents))
+
+    pieces = []
+    seen = set()
+    for document in documents:
+        piece = compact_document(document)
+        digest = hashlib.sha256(piece.encode("utf-8")).digest()
+        if piece and digest not in seen:
+            seen.add(digest)
+            pieces.append(piece)
+
+    separator_tokens = count_tokens(_CONST_DOCUMENT_SEPARATOR)
+    packed = []
+    used = 0
+    for index in _rank(pieces, question):
+        tokens = count_tokens(pieces[index])
+        remaining = token_budget - used - (separator_tokens if packed else 0)
+        if tokens <= remaining:
+            used += tokens + (separator_tokens if packed else 0)
+            packed.append(pieces[index])
+        elif remaining >= _CONST_MIN_PARTIAL_TOKENS:
+            packed.append(_cut(pieces[index], remaining))
+            used = token_budget
+
+    text = _CONST_DOCUMENT_SEPARATOR.join(packed)
+    context = BuiltContext(
+        text=text,
+        tokens=count_tokens(text),
+        raw_tokens=raw_tokens,
+        documents=len(packed),
+        dropped=len(documents) - len(packed),
+    )
+    _logger.info(f"Context: {context.documents} documents, {context.tokens} tokens "
+                 f"(raw {context.raw_tokens}, saved {context.saved_tokens}, dropped {context.dropped} documents)")
+
+    return context
@@ -1,15 +1,17 @@
 """
-document_preprocessor will read a textual file, llm it's summary, split and index it's embedings
-After each insert, a summary of the document will be appended to the file.
-After all files are uploaded (or manually called) - the summary files will be send to llm 
-make a short summary of it's contents and prepare some example questions.
+document_preprocessor will read a textual file, extract it's data rows and summary, split and index it's embedings.
+iii.org html tables are flattened locally (see table_extractor), the llm is used only for the files the extractor can't handle.
+The chunks go to the vector store and, with the same ids, to the keyword_index.
+After each insert, a summary of the document is saved to the summary_store.
+After all files are uploaded (or manually called) - the new summaries are merged by the llm into
+a short overview of the knowledge base with some example questions.
 """
 
 import os
 
 import re
 
-from typing import List, Dict, Any, Final, Union, Annotated
+from typing import Callable, List, Dict, Any, Final, Tuple, Union, Annotated
 from pydantic import BaseModel, Field
 
 from langchain_community.document_loaders import UnstructuredExcelLoader
@@ -18,11 +20,21 @@ from langchain_core.documents import Document
 from langchain_core.language_models import BaseChatModel
 
 import shutil
+import sqlite3
 
-import filecmp
+import asyncio
+import hashlib
+import itertools
+import threading
+import uuid
 
 from config.models import llm
-from config.db import vector_store
+from config.db import vector_store, search_results_cache
+from config import metrics
+
+from agents.document_store import DocumentStore
+from agents.table_extractor import ExtractedTable, extract_table
+from agents import keyword_index, series_store, storage_manifest, summary_store
 
 import logging
 
@@ -30,7 +42,21 @@ _logger = logging.getLogger(__name__)
 
 DOCUMENT_STORAGE_PATH: Final[str] = "data/storage/"
 
-_CONST_DOCUMENT_SUMMARY_FILE = "documents_summary.txt"
+# How many new document summaries are merged into the overview with a single llm call
+_CONST_OVERVIEW_BATCH_SIZE = 20
+
+_CONST_HASH_CHUNK_SIZE = 1024 * 1024
+
+# Files can be inserted from several threads (see app.process_directotry) and processes (ingestion workers).
+# Guards the "check if exists -> copy to the store" step within the process, storage_manifest.locked() across them.
+_store_lock = threading.RLock()
+
+# Hot documents are served from memory, see get_source_contents
+document_store = DocumentStore(DOCUMENT_STORAGE_PATH)
+metrics.register_cache("document_store", document_store.stats)
+
+# The manifest is rebuilt from the storage if it's empty, checked once per process
+_manifest_checked = False
 
 
 def _normalize_filename(filename):
@@ -46,15 +72,88 @@ def get_source_contents(source_path: str) -> str:
             source: file name with extension
     """
     
-    with open(os.path.join(DOCUMENT_STORAGE_PATH, _normalize_filename(source_path.strip())), encoding="utf-8") as f:
-        return f.read()
+    return document_store.get(_normalize_filename(source_path.strip()))
+
+def get_many_source_contents(source_paths: List[str]) -> List[str]:
+    """get_source_contents for several documents, in the same order"""
+    
+    names = [_normalize_filename(source_path.strip()) for source_path in source_paths]
+    contents = document_store.get_many(names)
+    
+    return [contents[name] for name in names]
+
+async def aget_source_contents(source_path: str) -> str:
+    """Async get_source_contents. The file is read in a worker thread, so the event loop is not blocked by the disk"""
+    
+    return await asyncio.to_thread(get_source_contents, source_path)
+    
+def _hash_file(file_path: str) -> str:
+    """sha256 hex digest of the file contents"""
+    
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CONST_HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            
+    return digest.hexdigest()
+
+def rebuild_manifest() -> Dict[str, str]:
+    """Rebuilds the content hash manifest from the files currently in DOCUMENT_STORAGE_PATH.
+    Call it if files were added or removed from the storage by hand.
+    
+    Returns:
+        sha256 -> normalized file name
+    """
+    
+    manifest = {}
+    for file in sorted(os.listdir(DOCUMENT_STORAGE_PATH)):
+        path = os.path.join(DOCUMENT_STORAGE_PATH, file)
+        if file.startswith(".") or not os.path.isfile(path):
+            continue
+        
+        manifest.setdefault(_hash_file(path), file)
     
-def _check_if_file_exists_in_store(file_path: str):
+    storage_manifest.replace_all(manifest)
+        
+    _logger.info(f"Storage manifest rebuilt with {len(manifest)} files")
+    return manifest
+
+def _ensure_manifest():
+    """Builds the manifest of the documents stored before there was one"""
+    global _manifest_checked
+    
+    with _store_lock:
+        if not _manifest_checked:
+            stored = os.listdir(DOCUMENT_STORAGE_PATH) if os.path.isdir(DOCUMENT_STORAGE_PATH) else []
+            if storage_manifest.is_empty() and any(not file.startswith(".") for file in stored):
+                _logger.info("Storage manifest is empty, rebuilding it")
+                rebuild_manifest()
+            _manifest_checked = True
+
+def _store_file(file_path: str, normalized_name: str, link: bool):
+    target = os.path.join(DOCUMENT_STORAGE_PATH, normalized_name)
+    if link:
+        # linked under a hidden name first, so a reindexed document is replaced atomically
+        linked = os.path.join(DOCUMENT_STORAGE_PATH, f".{normalized_name}.link")
+        try:
+            if os.path.lexists(linked):
+                os.remove(linked)
+            os.link(file_path, linked)
+            os.replace(linked, target)
+            return
+        except OSError as e:
+            _logger.info(f"Can't link {file_path} into the storage ({e}), copying it")
+    
+    shutil.copyfile(file_path, target)
+
+def _check_if_file_exists_in_store(file_path: str, content_hash: str, manifest: sqlite3.Connection):
     """Check if file already exists in the file store.
-    File is compared by contents.
+    File is compared by name and by contents hash (see rebuild_manifest).
     
     Args:
         path: str - full path to the file
+        content_hash: str - sha256 of the file contents
+        manifest: connection holding the manifest lock (see storage_manifest.locked)
         
     """
     
@@ -62,12 +161,10 @@ def _check_if_file_exists_in_store(file_path: str):
     if(os.path.exists(os.path.join(DOCUMENT_STORAGE_PATH, normalized_file_name))):
         return True
     
-    existing_files = [os.path.join(DOCUMENT_STORAGE_PATH, file) for file in os.listdir(DOCUMENT_STORAGE_PATH)]
-    for existing_file in existing_files:
-        if filecmp.cmp(file_path, existing_file):
-            return True
+    existing_file = storage_manifest.lookup(content_hash, manifest)
     
-    return False
+    # Someone might have removed the file from the storage without rebuilding the manifest
+    return existing_file is not None and os.path.exists(os.path.join(DOCUMENT_STORAGE_PATH, existing_file))
 
 class _DataDocument(BaseModel):
     data_rows: str = Field(description="""Extracted rows data from the document""")
@@ -79,19 +176,137 @@ _text_splitter = RecursiveCharacterTextSplitter(
     chunk_overlap=200
 )
 
-def insert_file_into_vector(file_path: str) -> Union[List[str], str]:
+def _extract_with_llm(file_contents: str) -> _DataDocument:
+    """Fallback for the files table_extractor can't parse: let the llm flatten the rows and summarize the file"""
+    
+    llm_for_document_summary = llm.with_structured_output(_DataDocument);
+    
+    prompt = f"""This file content contains some texts and a data table.
+                                        Extract the data in separate rows, where each row starts with the free texts and adds a description of data table row:
+                                        At the end, summarize file contents as short as possible. Return summary right away. No need for introductions.
+
+                                        For example:
+                                        "
+                                            title
+
+                                            data-header-1, data-header-2
+                                            data-row-1-col-1, data-row-1-col-2
+                                            data-row-2-col-1, data-row-2-col-2
+
+                                            some remarks
+                                        "
+
+                                        Should be extracted into separate lines as:
+                                        
+                                        "
+                                        extracted data:
+                                            Title, remarks, explanation of data-row-1
+                                            Title, remarks, explanation of data-row-2
+                                        
+                                        summary:
+                                            Information about data-header-1, data-header-2  
+                                        "
+
+                                        Here are the contents:{file_contents}"""
+    
+    return llm_for_document_summary.invoke(prompt)
+
+def _notes_id(series: str) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"series_store:{series}|notes"))
+
+def _llm_chunk_id(normalized_name: str, index: int) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{normalized_name}|{index}"))
+
+def _add_missing_to_keyword_index():
+    """Adds the chunks whose keyword index add failed earlier (see _add_to_indexes), taking them from the vector store"""
+    
+    missing = keyword_index.missing_ids()
+    if not missing:
+        return
+    
+    documents = vector_store.get_by_ids(missing)
+    keyword_index.add_documents(documents, [document.id for document in documents])
+    # deleted from the vector store in the meantime
+    keyword_index.delete(list(set(missing) - {document.id for document in documents}))
+    _logger.info(f"Added {len(documents)} chunks missing from the keyword index")
+
+def _add_to_indexes(documents: List[Document], ids: List[str]) -> List[str]:
+    """Adds the chunks to the vector store and, with the same ids, to the keyword index. Drops the cached search results.
+    A failed keyword index add doesn't fail the insert, the file is already in the manifest and the chunks in the vector store.
+    The ids are recorded as missing and added with the next insert (or run --rebuild-keyword-index).
+    """
+
+    inserted_ids = vector_store.add_documents(documents, ids=ids)
+    try:
+        _add_missing_to_keyword_index()
+        keyword_index.add_documents(documents, inserted_ids)
+    except Exception as e:
+        _logger.error(f"Adding {len(inserted_ids)} chunks to the keyword index failed: {e!r}")
+        try:
+            keyword_index.record_missing(inserted_ids)
+        except Exception as e:
+            _logger.error(f"Recording the chunks missing from the keyword index failed too ({e!r}), run --rebuild-keyword-index")
+    search_results_cache.clear()
+
+    return inserted_ids
+
+def _index_table(extracted_table: ExtractedTable, normalized_name: str, reindex: bool = False) -> List[str]:
+    """Saves the table values to the series_store and embeds only the rows this file added or revised.
+    Rolling windows of the same series overlap, so most of the rows are usually already in the vector store.
+    Each row is a separate document with an id derived from (series, year), so a revised row replaces the old one.
+    
+    Returns:
+        ids of the new or replaced documents
+    """
+    
+    series = series_store.normalize_series_title(extracted_table.title)
+    
+    # Files of the same series are indexed one at a time, also by different worker processes,
+    # so an older window can't overwrite a newer row in the vector store
+    with series_store.series_lock(series):
+        changed = series_store.add_table(extracted_table, normalized_name, reindex)
+        rows = series_store.canonical_rows(changed)
+        if not rows:
+            _logger.info(f"All rows of {normalized_name} are already indexed")
+            return []
+        
+        ids = [row.id for row in rows]
+        documents = [
+            Document(page_content=row.text, metadata={"source": row.source, "sources": row.sources, "series": row.series})
+            for row in rows
+        ]
+        
+        if extracted_table.footnotes:
+            ids.append(_notes_id(series))
+            documents.append(Document(page_content=f"{extracted_table.context()} Notes: {extracted_table.footnotes}",
+                                      metadata={"source": normalized_name, "sources": [normalized_name], "series": series}))
+        
+        return _add_to_indexes(documents, ids)
+
+def insert_file_into_vector(file_path: str, file_name: Union[str, None] = None, content_hash: Union[str, None] = None,
+                            link: bool = False, reindex: bool = False,
+                            progress: Union[Callable[[str], None], None] = None) -> Union[List[str], str]:
         """
-        Reads file contents, checks if it's not already vectorized (by comparing file contents with the already existing ones),
-        Passes it through llm to prepare for the vector store,
-        splits the llm result if the result is too long
+        Reads file contents, checks if it's not already vectorized (by looking up the file contents hash in the storage manifest),
+        Extracts the data rows (locally or, if the file is not an iii.org table, with the llm) to prepare for the vector store,
+        splits the extracted rows if the result is too long
         and eventually saves it to the vectore store.
         
-        It also saves the summary of the file to the tracked summary location
-        which maintains a short summary of all the documents together. Check @update_overview
+        Values of the extracted tables are also saved to the series_store, so they can be queried directly.
+        Only the table rows which are not already known from an overlapping file are embedded (see _index_table).
+        
+        It also saves the summary of the file to the summary_store,
+        it's merged into the overview of all the documents with the next refresh. Check @update_overview
         
         splits it with the
         Args:
             file_path: Path to the textual file
+            file_name: name the document is stored under, the name of file_path by default (uploads are saved to tempfiles)
+            content_hash: sha256 of the file if the caller already has it (see uploads.save_upload), otherwise the file is hashed here
+            link: hard link the file into the storage instead of copying it. Only for the files nobody changes afterwards, like the saved uploads.
+            reindex: index the file again even if it's already stored. Used to retry an insert that crashed half way (see ingestion_queue),
+                     the vector ids are deterministic, so the documents of the crashed attempt are replaced.
+            progress: called with the name of each stage ("storing", "extracting", "indexing", "summarizing")
 
         Returns:
             List of ids inserted into the vectore store or Error string if something failed 
@@ -99,90 +314,194 @@ def insert_file_into_vector(file_path: str) -> Union[List[str], str]:
         
         _logger.info(f"Loading Excel file: {file_path}")
         
-        if _check_if_file_exists_in_store(file_path):
-            return f"File insert error: {file_path} was already indexed."
-
-        normalized_name = _normalize_filename(os.path.basename(file_path))
-        shutil.copyfile(file_path, os.path.join(DOCUMENT_STORAGE_PATH, normalized_name))
+        progress = progress or (lambda stage: None)
+        file_name = file_name or os.path.basename(file_path)
+        normalized_name = _normalize_filename(file_name)
         
-        file_contents = get_source_contents(normalized_name);
+        progress("storing")
+        content_hash = content_hash or _hash_file(file_path)
         
-        llm_for_document_summary = llm.with_structured_output(_DataDocument);
+        _ensure_manifest()
+        # the manifest lock makes the check and the store atomic across the processes (ingestion workers)
+        with _store_lock, storage_manifest.locked() as manifest:
+            if not reindex and _check_if_file_exists_in_store(file_name, content_hash, manifest):
+                return f"File insert error: {file_name} was already indexed."
+
+            _store_file(file_path, normalized_name, link)
+            storage_manifest.register(content_hash, normalized_name, manifest)
         
-        prompt = f"""This file content contains some texts and a data table.
-                                            Extract the data in separate rows, where each row starts with the free texts and adds a description of data table row:
-                                            At the end, summarize file contents as short as possible. Return summary right away. No need for introductions.
-
-                                            For example:
-                                            "
-                                                title
-
-                                                data-header-1, data-header-2
-                                                data-row-1-col-1, data-row-1-col-2
-                                                data-row-2-col-1, data-row-2-col-2
-
-                                                some remarks
-                                            "
-
-                                            Should be extracted into separate lines as:
-                                            
-                                            "
-                                            extracted data:
-                                                Title, remarks, explanation of data-row-1
-                                                Title, remarks, explanation of data-row-2
-                                            
-                                            summary:
-                                                Information about data-header-1, data-header-2  
-                                            "
-
-                                            Here are the contents:{file_contents}"""
+        file_contents = get_source_contents(normalized_name);
         
-        try:
-            response = llm_for_document_summary.invoke(prompt)
-        except Exception as e:
-            return f"Failed parsing {normalized_name} with with an error: " + str(e)
+        progress("extracting")
+        extracted_table = extract_table(file_contents)
+        if extracted_table is not None:
+            summary = extracted_table.summary()
             
-        document = Document(
-            page_content=response.data_rows,
-            metadata={"source": normalized_name},
-        )
-
-        splitted_docs = _text_splitter.split_documents([document])
-        try:
-            inserted_ids = vector_store.add_documents(splitted_docs)
-        except Exception as e:
-            return f"Failed indexing {normalized_name} with with an error: " + str(e)
+            progress("indexing")
+            try:
+                inserted_ids = _index_table(extracted_table, normalized_name, reindex)
+            except Exception as e:
+                return f"Failed indexing {normalized_name} with with an error: " + str(e)
+        else:
+            _logger.info(f"{normalized_name} doesn't look like an iii.org table, falling back to the llm extraction")
+            
+            try:
+                response = _extract_with_llm(file_contents)
+            except Exception as e:
+                return f"Failed parsing {normalized_name} with with an error: " + str(e)
+            
+            summary = response.summary
+            document = Document(
+                page_content=response.data_rows,
+                metadata={"source": normalized_name},
+            )
+
+            splitted_docs = _text_splitter.split_documents([document])
+            ids = [_llm_chunk_id(normalized_name, index) for index in range(len(splitted_docs))]
+            
+            progress("indexing")
+            try:
+                inserted_ids = _add_to_indexes(splitted_docs, ids)
+            except Exception as e:
+                return f"Failed indexing {normalized_name} with with an error: " + str(e)
         
-        with open(_CONST_DOCUMENT_SUMMARY_FILE, 'a+') as file:
-            file.write(response.summary)
+        progress("summarizing")
+        summary_store.add_summary(normalized_name, summary)
         
         return inserted_ids;
     
 
-def update_overview():
-    f"""We maintain a short summary (llm summarized) of all documents saved in the vector store.
-    Mainly to give the user some overview of what could be the topics to ask.
+def rebuild_series_store() -> int:
+    """Extracts the tables of all the documents in the file storage again, saves their values to the series_store
+    and embeds the rows which are new to it.
+    Use it to fill the series store for the documents indexed before it existed and after a change of its keys (schema upgrade),
+    the documents of the rows dropped by the upgrade are deleted from the vector store and the keyword index.
     
-    This function can be called when new files are added for example.
+    Returns:
+        number of new or revised rows
     """
     
-    with open(_CONST_DOCUMENT_SUMMARY_FILE, 'r') as file:
-        contents = file.read();
+    saved = 0
+    for file in sorted(os.listdir(DOCUMENT_STORAGE_PATH)):
+        if file.startswith("."):
+            continue
         
-    result = llm.invoke(f"""Make a summary about the text. No introductions.
+        extracted_table = extract_table(get_source_contents(file))
+        if extracted_table is None:
+            _logger.info(f"{file} can't be parsed, skipping it")
+            continue
+        
+        saved += len(_index_table(extracted_table, file))
+    
+    dropped = series_store.dropped_keys()
+    current = set(series_store.all_keys())
+    stale = [series_store.row_id(*key) for key in dropped if key not in current]
+    stale += [_notes_id(series) for series in {key[0] for key in dropped} - set(series_store.list_series())]
+    if stale:
+        _logger.info(f"Deleting {len(stale)} documents of the series rows dropped by the schema upgrade")
+        vector_store.delete(stale)
+        keyword_index.delete(stale)
+        search_results_cache.clear()
+    series_store.forget_dropped_keys(dropped)
+    
+    return saved
+
+def rebuild_keyword_index() -> int:
+    """Fills the keyword index again with the chunks of the vector store.
+    Use it for the documents indexed before the keyword index existed.
+    
+    The chunks are looked up by their deterministic ids, so only the documents indexed since the ids are derived from the contents
+    (the canonical series rows) are recovered. Chunks of the older inserts have random uuids and are not added,
+    those files have to be inserted again (into an emptied vector store) to be found by the keyword search.
+    
+    Returns:
+        number of indexed chunks
+    """
+    
+    # the vector store ids are deterministic: series rows, series notes and the numbered chunks of the llm extracted files
+    ids = [row.id for row in series_store.canonical_rows(series_store.all_keys())]
+    ids += [_notes_id(series) for series in series_store.list_series()]
+    
+    llm_extracted = [file for file in sorted(os.listdir(DOCUMENT_STORAGE_PATH))
+                     if not file.startswith(".") and extract_table(get_source_contents(file)) is None]
+    for file in llm_extracted:
+        batch_size = 20
+        for start in itertools.count(0, batch_size):
+            batch = [_llm_chunk_id(file, index) for index in range(start, start + batch_size)]
+            found = [document.id for document in vector_store.get_by_ids(batch)]
+            ids += found
+            if len(found) < batch_size:
+                break
+    
+    keyword_index.clear()
+    indexed = 0
+    for start in range(0, len(ids), 500):
+        documents = vector_store.get_by_ids(ids[start:start + 500])
+        keyword_index.add_documents(documents, [document.id for document in documents])
+        indexed += len(documents)
+    
+    search_results_cache.clear()
+    return indexed
+
+def _merge_into_overview(overview: Union[str, None], summaries: List[Tuple[str, str]]) -> str:
+    new_summaries = "\n\n".join(f"{source}:\n{summary}" for source, summary in summaries)
+    previous = f"Here is the current overview of the knowledge base:\n{overview}\n\n" if overview else ""
+    
+    result = llm.invoke(f"""Make a short overview of the knowledge base. No introductions.
                         Just start with "Data about..." and keep it short.
+                        {"Update the current overview with the newly added documents, keep what it already covers." if overview else ""}
                         
-                        Add few example questions on what can be asked about this text.
-                        Here are the contents: {contents}""")
+                        Add few example questions on what can be asked about the data.
+                        
+                        {previous}Summaries of the newly added documents:
+                        {new_summaries}""")
+    
+    return result.content
+
+def update_overview(rebuild: bool = False) -> bool:
+    """We maintain a short summary (llm summarized) of all documents saved in the vector store.
+    Mainly to give the user some overview of what could be the topics to ask.
+    
+    The summaries of the documents are kept in the summary_store. Only the ones added since the last refresh
+    are merged into the previous overview (in batches of _CONST_OVERVIEW_BATCH_SIZE), so the prompt doesn't grow with the knowledge base.
+    
+    This function can be called when new files are added for example. The ingestion workers call it once their queue runs empty.
+    Only one process merges at a time, the others return right away (the one merging picks up their summaries too).
     
-    with open(_CONST_DOCUMENT_SUMMARY_FILE, 'w') as file:
-        file.write(result.content)
+    Args:
+        rebuild: build the overview again from all the document summaries
+    Returns:
+        True if the overview was updated, False if nothing was pending or another process is refreshing it
+    """
+    
+    updated = False
+    while True:
+        # a single process merges (the ingestion workers call it concurrently), the others don't wait for it
+        with summary_store.overview_lock() as acquired:
+            if not acquired:
+                if rebuild:
+                    _logger.warning("The overview is being refreshed by another process, run the rebuild again later")
+                else:
+                    _logger.info("The overview is being refreshed by another process")
+                return updated
+            
+            if rebuild:
+                summary_store.reset()
+                rebuild = False
+            
+            while summaries := summary_store.pending(_CONST_OVERVIEW_BATCH_SIZE):
+                _logger.info(f"Merging {len(summaries)} document summaries into the overview")
+                overview = _merge_into_overview(summary_store.get_overview(), summaries)
+                summary_store.save_overview(overview, summaries)
+                updated = True
         
+        # summaries added by a process which skipped the refresh while we held the lock
+        if not summary_store.pending(1):
+            return updated
+
 def get_overview() -> str:
     """retrieves a cached short summary of currently known documents"""
-    with open(_CONST_DOCUMENT_SUMMARY_FILE, 'r') as file:
-        contents = file.read()
-        return contents or "Knowledge base currently is empty"
+    return summary_store.get_overview() or "Knowledge base currently is empty"
 
 
 class DocumentProcessor:
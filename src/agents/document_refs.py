@@ -0,0 +1,103 @@
+"""
+document_refs keeps the contents of the retrieved documents out of the graph state.
+
+The state holds only DocumentRef(source, hash), nodes call load() when they need the texts:
+    - source files are read through the document_store of document_processor, which already keeps the hot ones in memory
+    - series_store lookup results are kept in a shared in-memory LRU keyed by the hash,
+      if they were evicted the lookup is run again (the lookup parameters are kept in the source id)
+
+That keeps long chat sessions (the state is carried over in st.session_state) and graph checkpoints small.
+"""
+import hashlib
+import json
+import os
+
+from typing import List, Union
+
+from config.cache import TTLCache
+from config import metrics
+from state_schemas import DocumentRef
+
+from agents.document_processor import get_source_contents, get_many_source_contents, aget_source_contents
+from agents import series_store
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_CONST_SERIES_PREFIX = "series_store:"
+
+# Shared by all the sessions, hash -> csv of the series lookup. The files are cached by the document_store.
+_series_lookups = TTLCache(int(os.getenv("SERIES_LOOKUP_CACHE_SIZE", "256")))
+metrics.register_cache("series_lookups", _series_lookups.stats)
+
+
+def _hash(contents: str) -> str:
+    return hashlib.sha256(contents.encode("utf-8")).hexdigest()
+
+
+def _ref(source: str, contents: str) -> DocumentRef:
+    return DocumentRef(source=source, hash=_hash(contents))
+
+
+def from_source(source: str) -> DocumentRef:
+    """Reference to a file in the document storage"""
+    
+    return _ref(source, get_source_contents(source))
+
+
+async def afrom_source(source: str) -> DocumentRef:
+    return _ref(source, await aget_source_contents(source))
+
+
+def from_sources(sources: List[str]) -> List[DocumentRef]:
+    """References to several files in the document storage, read in one batch"""
+    
+    return [_ref(source, contents) for source, contents in zip(sources, get_many_source_contents(sources))]
+
+
+def series_lookup(series: str, column: str, year_from: Union[int, None], year_to: Union[int, None]) -> Union[DocumentRef, None]:
+    """Runs the series_store lookup and returns a reference to it's csv table. None if nothing was found"""
+    
+    values = series_store.query(series, column, year_from, year_to)
+    if not values:
+        return None
+    
+    parameters = json.dumps({"series": series, "column": column, "year_from": year_from, "year_to": year_to}, sort_keys=True)
+    contents = series_store.to_csv(values)
+    ref = _ref(_CONST_SERIES_PREFIX + parameters, contents)
+    _series_lookups.set(ref.hash, contents)
+    
+    return ref
+
+
+def _check(ref: DocumentRef, contents: str) -> str:
+    if _hash(contents) != ref.hash:
+        _logger.warning(f"{ref.source} has changed since it was retrieved, using the current contents")
+        
+    return contents
+
+
+def _series_contents(ref: DocumentRef) -> str:
+    contents = _series_lookups.get(ref.hash)
+    if contents is None:
+        parameters = json.loads(ref.source[len(_CONST_SERIES_PREFIX):])
+        contents = _check(ref, series_store.to_csv(series_store.query(**parameters)))
+        # values revised since the lookup don't go under its hash, the next load would take them for the ones the hash stands for
+        if _hash(contents) == ref.hash:
+            _series_lookups.set(ref.hash, contents)
+        
+    return contents
+
+
+def load(refs: List[DocumentRef]) -> List[str]:
+    """Contents of the referenced documents, in the same order"""
+    
+    files = [ref for ref in refs if not ref.source.startswith(_CONST_SERIES_PREFIX)]
+    file_contents = dict(zip([ref.hash for ref in files], get_many_source_contents([ref.source for ref in files])))
+    
+    return [_series_contents(ref) if ref.source.startswith(_CONST_SERIES_PREFIX) else _check(ref, file_contents[ref.hash]) for ref in refs]
+
+
+def cache_stats():
+    return _series_lookups.stats()
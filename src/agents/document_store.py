@@ -0,0 +1,95 @@
+"""
+document_store serves the contents of the stored source documents from an in-process LRU.
+
+Entries are keyed by the normalized file name and checked against the file's mtime and size,
+so a re-uploaded file is read again, while hot documents are served from memory (a single stat, no reads).
+The total size of the cached documents is bounded (DOCUMENT_STORE_MAX_MB), counted in bytes of the files they were decoded from.
+"""
+import os
+import threading
+
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Union
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_CONST_MAX_BYTES = int(os.getenv("DOCUMENT_STORE_MAX_MB", "64")) * 1024 * 1024
+
+
+class DocumentStore:
+    def __init__(self, root: str, max_bytes: int = _CONST_MAX_BYTES):
+        """
+        Args:
+            root: directory of the documents
+            max_bytes: least recently used documents are dropped when the cached documents grow over this size (in bytes of the files)
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # name -> ((mtime_ns, size in bytes), contents)
+        self._entries: "OrderedDict[str, Tuple[Tuple[int, int], str]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _read(self, path: str) -> str:
+        with open(path, "rb") as f:
+            data = f.read()
+
+        # same newlines as open(path, encoding="utf-8").read()
+        return data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+    def get(self, name: str) -> str:
+        """Contents of the document.
+        Args:
+            name: normalized file name in the root directory
+        Raises:
+            FileNotFoundError, same as open()
+        """
+
+        path = os.path.join(self.root, name)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        contents = self._read(path)
+
+        with self._lock:
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                self._size -= previous[0][1]
+
+            if stat.st_size <= self.max_bytes:
+                self._entries[name] = (version, contents)
+                self._size += stat.st_size
+                while self._size > self.max_bytes:
+                    _, ((_, evicted_size), _) = self._entries.popitem(last=False)
+                    self._size -= evicted_size
+
+        return contents
+
+    def get_many(self, names: List[str]) -> Dict[str, str]:
+        """Contents of several documents, each one read at most once. name -> contents, in the order of names"""
+
+        return {name: self.get(name) for name in dict.fromkeys(names)}
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "documents": len(self._entries),
+                "bytes": self._size,
+            }
@@ -0,0 +1,332 @@
+"""
+ingestion_queue is a persistent (SQLite) queue of the files waiting to be inserted into the knowledge base.
+
+The upload tab only saves the uploaded file and enqueues a job - the extraction, embedding and the overview refresh
+are done by separate worker processes (ingestion_worker.py), so the browser session isn't blocked.
+
+    - every file gets its own job id; status (queued, running, done, failed) and the current stage are kept in the table
+    - a running job holds a lease that its worker renews (heartbeat). If the worker crashes the lease expires
+      and another worker claims the job again, at most _CONST_MAX_ATTEMPTS times
+    - a retried job re-indexes the file (insert_file_into_vector(reindex=True)), the vector ids are deterministic
+      so the documents written by the crashed attempt are replaced, not duplicated
+"""
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from contextlib import closing
+from typing import Dict, Final, List, Union
+
+from pydantic import BaseModel
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+INGESTION_DB_PATH: Final[str] = "data/ingestion_jobs.sqlite"
+
+_CONST_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))
+
+# A running job whose worker didn't renew the lease for this long is considered crashed
+_CONST_LEASE_SECONDS = 60
+_CONST_HEARTBEAT_SECONDS = 10
+_CONST_MAX_ATTEMPTS = 3
+
+_CONST_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ingestion_worker.py")
+
+_CONST_SCHEMA_VERSION = 1
+
+_CONST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingestion_jobs (
+    id TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    content_hash TEXT,
+    status TEXT NOT NULL,
+    stage TEXT NOT NULL DEFAULT '',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    worker TEXT,
+    lease_until REAL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ingestion_jobs_status ON ingestion_jobs (status, created);
+CREATE TABLE IF NOT EXISTS ingestion_workers (
+    id TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    heartbeat REAL NOT NULL
+);
+"""
+
+
+class Job(BaseModel):
+    id: str
+    file_name: str
+    path: str
+    content_hash: Union[str, None]
+    status: str
+    stage: str
+    attempts: int
+    result: Union[str, None]
+    created: float
+    updated: float
+
+
+_init_lock = threading.Lock()
+_initialized = False
+
+# Worker processes started by this process (see ensure_workers)
+_spawned: List[subprocess.Popen] = []
+
+
+def _connect() -> sqlite3.Connection:
+    global _initialized
+
+    os.makedirs(os.path.dirname(INGESTION_DB_PATH) or ".", exist_ok=True)
+    # autocommit, transactions are started explicitly where needed (see claim)
+    connection = sqlite3.connect(INGESTION_DB_PATH, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+
+    with _init_lock:
+        if not _initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_CONST_SCHEMA)
+            if connection.execute("PRAGMA user_version").fetchone()[0] < _CONST_SCHEMA_VERSION:
+                columns = [row["name"] for row in connection.execute("PRAGMA table_info(ingestion_jobs)")]
+                if "content_hash" not in columns:
+                    connection.execute("ALTER TABLE ingestion_jobs ADD COLUMN content_hash TEXT")
+                connection.execute(f"PRAGMA user_version = {_CONST_SCHEMA_VERSION}")
+            _initialized = True
+
+    return connection
+
+
+def _job(row: sqlite3.Row) -> Job:
+    return Job(**{field: row[field] for field in Job.model_fields})
+
+
+def enqueue(path: str, file_name: str, content_hash: Union[str, None] = None) -> str:
+    """Adds the file to the queue. Returns the job id.
+    Args:
+        path: the saved upload (see uploads.save_upload), it's linked into the storage and removed once the job is finished
+        file_name: original name of the file, the document is stored under it
+        content_hash: sha256 of the file, computed while it was saved
+    """
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with closing(_connect()) as connection:
+        connection.execute(
+            "INSERT INTO ingestion_jobs (id, file_name, path, content_hash, status, stage, created, updated) VALUES (?, ?, ?, ?, 'queued', 'queued', ?, ?)",
+            (job_id, file_name, path, content_hash, now, now),
+        )
+
+    return job_id
+
+
+def claim(worker_id: str) -> Union[Job, None]:
+    """Takes the oldest queued job, or a running one whose worker's lease expired. None if there is nothing to do."""
+
+    now = time.time()
+    with closing(_connect()) as connection:
+        # IMMEDIATE takes the write lock right away, so two workers can't claim the same job
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                """SELECT * FROM ingestion_jobs
+                   WHERE status = 'queued' OR (status = 'running' AND lease_until < ?)
+                   ORDER BY created LIMIT 1""",
+                (now,),
+            ).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+
+            if row["attempts"] >= _CONST_MAX_ATTEMPTS:
+                _logger.warning(f"Ingestion job {row['id']} ({row['file_name']}) crashed {row['attempts']} times, giving up")
+                connection.execute(
+                    "UPDATE ingestion_jobs SET status = 'failed', stage = 'failed', result = ?, lease_until = NULL, updated = ? WHERE id = ?",
+                    (f"File insert error: {row['file_name']} - the worker crashed {row['attempts']} times", now, row["id"]),
+                )
+                connection.execute("COMMIT")
+                return claim(worker_id)
+
+            connection.execute(
+                """UPDATE ingestion_jobs SET status = 'running', stage = 'started', attempts = attempts + 1,
+                   worker = ?, lease_until = ?, updated = ? WHERE id = ?""",
+                (worker_id, now + _CONST_LEASE_SECONDS, now, row["id"]),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    return get_job(row["id"])
+
+
+def _update_running(job_id: str, worker_id: str, **values):
+    """Updates the job only while this worker still owns it, a job taken over after an expired lease is left alone"""
+
+    assignments = ", ".join(f"{column} = ?" for column in values)
+    with closing(_connect()) as connection:
+        connection.execute(
+            f"UPDATE ingestion_jobs SET {assignments}, updated = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (*values.values(), time.time(), job_id, worker_id),
+        )
+
+
+def set_stage(job_id: str, worker_id: str, stage: str):
+    _update_running(job_id, worker_id, stage=stage, lease_until=time.time() + _CONST_LEASE_SECONDS)
+
+
+def renew_lease(job_id: str, worker_id: str):
+    _update_running(job_id, worker_id, lease_until=time.time() + _CONST_LEASE_SECONDS)
+
+
+def finish(job_id: str, worker_id: str, result: Union[List[str], str]):
+    """Marks the job done, or failed if the result is an error string"""
+
+    if isinstance(result, list):
+        _update_running(job_id, worker_id, status="done", stage="done", result=f"{len(result)} documents indexed", lease_until=None)
+    else:
+        _update_running(job_id, worker_id, status="failed", stage="failed", result=result, lease_until=None)
+
+
+def get_job(job_id: str) -> Union[Job, None]:
+    with closing(_connect()) as connection:
+        row = connection.execute("SELECT * FROM ingestion_jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job(row) if row else None
+
+
+def get_jobs(job_ids: List[str]) -> List[Job]:
+    """Jobs in the order of job_ids, unknown ids are left out"""
+
+    with closing(_connect()) as connection:
+        rows = connection.execute(
+            f"SELECT * FROM ingestion_jobs WHERE id IN ({', '.join('?' for _ in job_ids)})", job_ids
+        ).fetchall()
+
+    jobs = {row["id"]: _job(row) for row in rows}
+    return [jobs[job_id] for job_id in job_ids if job_id in jobs]
+
+
+def counts() -> Dict[str, int]:
+    """status -> number of jobs"""
+
+    with closing(_connect()) as connection:
+        return dict(connection.execute("SELECT status, COUNT(*) FROM ingestion_jobs GROUP BY status").fetchall())
+
+
+def has_pending() -> bool:
+    with closing(_connect()) as connection:
+        return connection.execute(
+            "SELECT 1 FROM ingestion_jobs WHERE status IN ('queued', 'running') LIMIT 1"
+        ).fetchone() is not None
+
+
+def register_worker(worker_id: str):
+    """Workers report they're alive, so ensure_workers doesn't start more of them"""
+
+    with closing(_connect()) as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO ingestion_workers (id, pid, heartbeat) VALUES (?, ?, ?)", (worker_id, os.getpid(), time.time())
+        )
+
+
+def unregister_worker(worker_id: str):
+    with closing(_connect()) as connection:
+        connection.execute("DELETE FROM ingestion_workers WHERE id = ?", (worker_id,))
+
+
+def live_workers() -> int:
+    with closing(_connect()) as connection:
+        return connection.execute(
+            "SELECT COUNT(*) FROM ingestion_workers WHERE heartbeat > ?", (time.time() - _CONST_LEASE_SECONDS,)
+        ).fetchone()[0]
+
+
+def ensure_workers(workers: int = _CONST_WORKERS):
+    """Starts worker processes if there aren't enough alive (started by us or by hand, see ingestion_worker.py)"""
+
+    _spawned[:] = [process for process in _spawned if process.poll() is None]
+    alive = max(live_workers(), len(_spawned))
+    for _ in range(workers - alive):
+        _logger.info("Starting an ingestion worker")
+        _spawned.append(subprocess.Popen([sys.executable, _CONST_WORKER_SCRIPT], stdin=subprocess.DEVNULL, start_new_session=True))
+
+
+class _Heartbeat(threading.Thread):
+    """Renews the worker registration and the lease of the current job while the job runs"""
+
+    def __init__(self, worker_id: str):
+        super().__init__(name="ingestion-heartbeat", daemon=True)
+        self.worker_id = worker_id
+        self.job_id: Union[str, None] = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(_CONST_HEARTBEAT_SECONDS):
+            try:
+                register_worker(self.worker_id)
+                if self.job_id is not None:
+                    renew_lease(self.job_id, self.worker_id)
+            except sqlite3.Error as e:
+                _logger.warning(f"Ingestion heartbeat failed: {e}")
+
+
+def run_worker(poll_seconds: float = 1.0, exit_when_idle: bool = False):
+    """Processes the queued jobs until stopped (or until the queue is empty with exit_when_idle).
+    The overview is refreshed whenever the queue runs empty after some files were inserted.
+    """
+    from agents import document_processor
+
+    worker_id = f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    register_worker(worker_id)
+    heartbeat = _Heartbeat(worker_id)
+    heartbeat.start()
+    _logger.info(f"Ingestion worker {worker_id} started")
+
+    inserted = False
+    try:
+        while True:
+            job = claim(worker_id)
+            if job is None:
+                if inserted and not has_pending():
+                    document_processor.update_overview()
+                    inserted = False
+                if exit_when_idle:
+                    return
+                time.sleep(poll_seconds)
+                continue
+
+            _logger.info(f"Ingestion job {job.id}: {job.file_name}, attempt {job.attempts}")
+            heartbeat.job_id = job.id
+            try:
+                result = document_processor.insert_file_into_vector(
+                    job.path,
+                    file_name=job.file_name,
+                    content_hash=job.content_hash,
+                    link=True,
+                    reindex=job.attempts > 1,
+                    progress=lambda stage: set_stage(job.id, worker_id, stage),
+                )
+            except Exception as e:
+                _logger.exception(f"Ingestion job {job.id} failed")
+                result = f"Failed inserting {job.file_name} with an error: {e}"
+            finally:
+                heartbeat.job_id = None
+
+            finish(job.id, worker_id, result)
+            inserted = inserted or isinstance(result, list)
+            try:
+                os.remove(job.path)
+            except FileNotFoundError:
+                pass
+    finally:
+        heartbeat.stopped.set()
+        unregister_worker(worker_id)
@@ -0,0 +1,143 @@
+"""
+keyword_index keeps a BM25 full text index (SQLite FTS5) of the chunks in the vector store.
+
+The questions depend on exact tokens - years ("2013"), series names ("Consumer Price Indices"), "percent change" -
+which the embeddings blur: the neighbouring windows of a rolling series look almost the same to them.
+The retriever fuses the keyword and the vector results (see retriever._fuse, called from retriever._similarity_search).
+
+Chunks are added with the same ids as in the vector store (see document_processor), a re-inserted chunk replaces its text.
+Ids whose add failed after they were added to the vector store are recorded in missing, document_processor adds them again.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from contextlib import closing
+from typing import Final, List, Tuple
+
+from langchain_core.documents import Document
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+KEYWORD_DB_PATH: Final[str] = "data/keyword_index.sqlite"
+
+_CONST_TOKEN_PATTERN = re.compile(r"\w+")
+
+# Words of the questions that match almost every chunk, left out of the match expression
+_CONST_STOPWORDS = frozenset("""
+a an and are as at be by did do does for from has have how in is it its of on or per show tell than that the their there these
+this to was were what when where which who why with about between give me list
+""".split())
+
+# chunks is the content table, chunks_fts indexes its text and is kept in sync by the triggers
+_CONST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    row INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    text TEXT NOT NULL,
+    metadata TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(text, content='chunks', content_rowid='row', tokenize='unicode61 remove_diacritics 2');
+CREATE TRIGGER IF NOT EXISTS chunks_insert AFTER INSERT ON chunks BEGIN
+    INSERT INTO chunks_fts (rowid, text) VALUES (new.row, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS chunks_delete AFTER DELETE ON chunks BEGIN
+    INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', old.row, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS chunks_update AFTER UPDATE ON chunks BEGIN
+    INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', old.row, old.text);
+    INSERT INTO chunks_fts (rowid, text) VALUES (new.row, new.text);
+END;
+CREATE TABLE IF NOT EXISTS missing (
+    id TEXT PRIMARY KEY
+);
+"""
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _connect() -> sqlite3.Connection:
+    global _initialized
+
+    os.makedirs(os.path.dirname(KEYWORD_DB_PATH) or ".", exist_ok=True)
+    connection = sqlite3.connect(KEYWORD_DB_PATH, timeout=30)
+
+    with _init_lock:
+        if not _initialized:
+            with connection:
+                connection.executescript(_CONST_SCHEMA)
+            _initialized = True
+
+    return connection
+
+
+def _match_expression(query: str) -> str:
+    """Any of the query words. BM25 ranks the chunks with more (and rarer) of them first."""
+
+    tokens = [token for token in _CONST_TOKEN_PATTERN.findall(query.lower()) if token not in _CONST_STOPWORDS]
+    return " OR ".join(f'"{token}"' for token in dict.fromkeys(tokens))
+
+
+def add_documents(documents: List[Document], ids: List[str]):
+    """Adds (or replaces) the chunks, ids are the vector store ids of the documents"""
+
+    with closing(_connect()) as connection, connection:
+        connection.executemany("""
+            INSERT INTO chunks (id, text, metadata) VALUES (?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET text = excluded.text, metadata = excluded.metadata""",
+            [(id, document.page_content, json.dumps(document.metadata)) for id, document in zip(ids, documents)])
+        connection.executemany("DELETE FROM missing WHERE id = ?", [(id,) for id in ids])
+
+
+def record_missing(ids: List[str]):
+    """Records the vector store ids which couldn't be added, see missing_ids"""
+
+    with closing(_connect()) as connection, connection:
+        connection.executemany("INSERT OR IGNORE INTO missing VALUES (?)", [(id,) for id in ids])
+
+
+def missing_ids() -> List[str]:
+    with closing(_connect()) as connection:
+        return [row[0] for row in connection.execute("SELECT id FROM missing ORDER BY id")]
+
+
+def search(query: str, k: int) -> List[Tuple[Document, float]]:
+    """Top k chunks by BM25
+
+    Returns:
+        (document, bm25 score) pairs, the best first. SQLite's bm25 is negative, lower is better.
+    """
+    expression = _match_expression(query)
+    if not expression:
+        return []
+
+    with closing(_connect()) as connection:
+        rows = connection.execute("""
+            SELECT chunks.id, chunks.text, chunks.metadata, bm25(chunks_fts) AS score
+            FROM chunks_fts JOIN chunks ON chunks.row = chunks_fts.rowid
+            WHERE chunks_fts MATCH ? ORDER BY score LIMIT ?""", (expression, k)).fetchall()
+
+    return [(Document(id=id, page_content=text, metadata=json.loads(metadata)), score) for id, text, metadata, score in rows]
+
+
+def delete(ids: List[str]):
+    with closing(_connect()) as connection, connection:
+        connection.executemany("DELETE FROM chunks WHERE id = ?", [(id,) for id in ids])
+        connection.executemany("DELETE FROM missing WHERE id = ?", [(id,) for id in ids])
+
+
+def count() -> int:
+    with closing(_connect()) as connection:
+        return connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+
+def clear():
+    with closing(_connect()) as connection, connection:
+        connection.execute("DELETE FROM chunks")
+        connection.execute("DELETE FROM missing")
+        connection.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
@@ -2,49 +2,189 @@
 Retriever will atempt to retrieve the information from the underlying DB.
 The reAct agent will try to reason and retrieve different data for several times before returning the data.
 
-After the similar results are retieved from the DB, retriever will read the content of the original files from the file storage and update the state with them
+The search returns the top-k chunks with their scores and source metadata directly (no extra QA llm call).
+It's hybrid: the vector search and the BM25 keyword search (see keyword_index) are merged with reciprocal rank fusion,
+so the exact tokens of the question (years, series names) decide between chunks the embeddings see as almost the same.
+After the similar results are retieved from the DB, retriever will update the state with references to the original files (see document_refs)
 so that the downstream nodes can make use of the full data.
+
+Exact values of the data series (year, column, value) are looked up directly in the series_store, skipping the vector search.
 """
-from typing import Annotated, Literal
+import asyncio
+import os
+import re
+import time
+
+from typing import Annotated, Dict, List, Literal, Tuple, Union
 
-from langchain.tools import tool
-from langchain.chains import RetrievalQAWithSourcesChain
+from langchain_core.tools import StructuredTool
 
+from langchain_core.documents import Document
 from langchain_core.tools.base import InjectedToolCallId
 from langchain_core.messages import ToolMessage, HumanMessage
 
 from langgraph.types import Command
 from langgraph.prebuilt import create_react_agent
 
-from state_schemas import ApplicationState
+from state_schemas import ApplicationState, DocumentRef
 from config.models import llm
-from config.db import vector_store
+from config.db import vector_store, async_vector_store, search_results_cache, cache_stats
+from config import metrics
 
-from agents.document_processor import get_source_contents
+from agents import document_refs, keyword_index, series_store
 
 import logging
 
 _logger = logging.getLogger(__name__)
 
-chain = RetrievalQAWithSourcesChain.from_llm(llm=llm,
-                                            retriever=vector_store.as_retriever(),
-                                            return_source_documents=False)
+# Chunks returned to the agent per search
+_CONST_TOP_K = int(os.getenv("SEARCH_TOP_K", "4"))
 
-@tool()
-def _data_retrieval(query: Annotated[str, "A text to perform a search in the vector database"], tool_call_id: Annotated[str, InjectedToolCallId]):
-    """Use this tool to search the database."""
-    result = chain.invoke(query, debug=_logger.getEffectiveLevel() < logging.WARNING)
-    documents = [get_source_contents(source) for source in result["sources"].split(',')]
+# How many results of each search (vector and keyword) go into the fusion
+_CONST_SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "20"))
+
+# Reciprocal rank fusion constant, the usual 60: the first ranks of one search don't outweigh a chunk both searches found
+_CONST_RRF_K = 60
+
+def _normalize_query(query: str) -> str:
+    """ "What's the  Average expenditure?" and "what's the average expenditure" share the cache entry.
+    Punctuation becomes a space, not nothing: "2012-2021" isn't "20122021" and "1.5" isn't "15".
+    """
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+def _keyword_search(query: str) -> List[Tuple[Document, float]]:
+    started = time.perf_counter()
+    results = keyword_index.search(query, _CONST_SEARCH_CANDIDATES)
+    metrics.record_keyword_search(time.perf_counter() - started)
+    return results
+
+def _fuse(result_lists: List[List[Tuple[Document, float]]], k: int) -> List[Tuple[Document, float]]:
+    """Reciprocal rank fusion: every chunk scores the sum of 1 / (RRF_K + rank) over the result lists it's in.
+    Only the ranks count, the vector distances and the BM25 scores aren't comparable.
+    """
+    scores: Dict[str, float] = {}
+    documents: Dict[str, Document] = {}
+    for results in result_lists:
+        for rank, (document, _) in enumerate(results, start=1):
+            key = document.id or document.page_content
+            documents.setdefault(key, document)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (_CONST_RRF_K + rank)
+    
+    best = sorted(scores, key=lambda key: scores[key], reverse=True)[:k]
+    return [(documents[key], scores[key]) for key in best]
+
+def _similarity_search(query: str, k: int = _CONST_TOP_K) -> List[Tuple[Document, float]]:
+    """Hybrid (vector + keyword) search with the fused results cached in-process (see config.db.search_results_cache)"""
     
+    key = (_normalize_query(query), k)
+    results = search_results_cache.get(key)
+    # after get(), it picks up the clears of the other processes
+    generation = search_results_cache.generation
+    if results is None:
+        started = time.perf_counter()
+        vector_results = vector_store.similarity_search_with_score(query, k=_CONST_SEARCH_CANDIDATES)
+        metrics.record_vector_search(time.perf_counter() - started)
+        
+        results = _fuse([vector_results, _keyword_search(query)], k)
+        search_results_cache.set(key, results, generation)
+        
+    _logger.info(f"Search cache stats: {cache_stats()}")
+    return results
+
+async def _avector_search(query: str) -> List[Tuple[Document, float]]:
+    started = time.perf_counter()
+    results = await async_vector_store.asimilarity_search_with_score(query, k=_CONST_SEARCH_CANDIDATES)
+    metrics.record_vector_search(time.perf_counter() - started)
+    return results
+
+async def _asimilarity_search(query: str, k: int = _CONST_TOP_K) -> List[Tuple[Document, float]]:
+    """Async _similarity_search on the async_vector_store, sharing the same cache"""
+    
+    key = (_normalize_query(query), k)
+    results = search_results_cache.get(key)
+    # after get(), it picks up the clears of the other processes
+    generation = search_results_cache.generation
+    if results is None:
+        # the keyword index is a local sqlite, it runs in a thread while the vector search waits for the database
+        vector_results, keyword_results = await asyncio.gather(_avector_search(query), asyncio.to_thread(_keyword_search, query))
+        results = _fuse([vector_results, keyword_results], k)
+        search_results_cache.set(key, results, generation)
+        
+    _logger.info(f"Search cache stats: {cache_stats()}")
+    return results
+
+def _format_results(results: List[Tuple[Document, float]]) -> str:
+    """Chunks with their scores and sources, the way the agent sees them"""
+    if not results:
+        return "No documents found."
+    
+    return "\n\n".join(
+        f"[{index}] score: {score:.4f}, source: {document.metadata.get('source', 'unknown')}\n{document.page_content}"
+        for index, (document, score) in enumerate(results, start=1)
+    )
+
+def _unique_sources(results: List[Tuple[Document, float]]) -> List[str]:
+    """Source files of the results, the best scoring first. Series rows point to the newest file they were read from."""
+    sources = [document.metadata.get("source") for document, _ in results]
+    
+    return list(dict.fromkeys(source for source in sources if source))
+
+def _retrieval_command(results: List[Tuple[Document, float]], documents: List[DocumentRef], tool_call_id: str) -> Command:
     return Command(
         update={
-            "messages": [ToolMessage(content=str(result), tool_call_id=tool_call_id)],
+            "messages": [ToolMessage(content=_format_results(results), tool_call_id=tool_call_id)],
             "documents": documents
         }
     )
 
+def _data_retrieval(query: Annotated[str, "A text to perform a search in the vector database"], tool_call_id: Annotated[str, InjectedToolCallId]):
+    """Use this tool to search the database. Returns the most relevant chunks (semantic and keyword search combined) with their score (higher is better) and source file."""
+    results = _similarity_search(query)
+    documents = document_refs.from_sources(_unique_sources(results))
+    
+    return _retrieval_command(results, documents, tool_call_id)
+
+async def _adata_retrieval(query: Annotated[str, "A text to perform a search in the vector database"], tool_call_id: Annotated[str, InjectedToolCallId]):
+    results = await _asimilarity_search(query)
+    documents = await asyncio.gather(*[document_refs.afrom_source(source) for source in _unique_sources(results)])
+    
+    return _retrieval_command(results, list(documents), tool_call_id)
+
+def _series_lookup(series: Annotated[str, "Words of the data series title, for example: average expenditures auto insurance"],
+                   column: Annotated[str, "Words of the column name, for example: percent change. Empty string for all the columns"],
+                   year_from: Annotated[Union[int, None], "First year of the range (inclusive) or null"],
+                   year_to: Annotated[Union[int, None], "Last year of the range (inclusive) or null"],
+                   tool_call_id: Annotated[str, InjectedToolCallId]):
+    """Use this tool to get exact values of a data series for a year or a range of years. It's faster and more precise than searching the database."""
+    ref = document_refs.series_lookup(series, column, year_from, year_to)
+    
+    if ref is None:
+        content = f"No values found. Known series: {', '.join(series_store.list_series())}"
+        return Command(update={"messages": [ToolMessage(content=content, tool_call_id=tool_call_id)]})
+    
+    return Command(
+        update={
+            "messages": [ToolMessage(content=document_refs.load([ref])[0], tool_call_id=tool_call_id)],
+            "documents": [ref]
+        }
+    )
+
+async def _aseries_lookup(series: Annotated[str, "Words of the data series title, for example: average expenditures auto insurance"],
+                          column: Annotated[str, "Words of the column name, for example: percent change. Empty string for all the columns"],
+                          year_from: Annotated[Union[int, None], "First year of the range (inclusive) or null"],
+                          year_to: Annotated[Union[int, None], "Last year of the range (inclusive) or null"],
+                          tool_call_id: Annotated[str, InjectedToolCallId]):
+    # local sqlite, but still keep it off the event loop
+    return await asyncio.to_thread(_series_lookup, series, column, year_from, year_to, tool_call_id)
+
+# Each tool has a sync and an async implementation: retriever_node runs the sync ones, aretriever_node the async ones.
+_tools = [
+    StructuredTool.from_function(func=_series_lookup, coroutine=_aseries_lookup),
+    StructuredTool.from_function(func=_data_retrieval, coroutine=_adata_retrieval),
+]
+
 _retrieval_agent = create_react_agent(llm,
-                                    tools=[_data_retrieval],
+                                    tools=_tools,
                                     state_schema=ApplicationState, 
                                     state_modifier="""
                                     You are an intelligent search assistant specialized in querying vector-based databases to retrieve relevant information about iii.org (Insurance Information Institute) historical auto insurance data.
@@ -65,8 +205,13 @@ _retrieval_agent = create_react_agent(llm,
                                         Accurately interpret user queries, identifying key entities, topics, or semantic goals.
                                         Support natural language queries and handle ambiguous inputs gracefully by asking clarifying questions.
                                     
+                                    - Exact values:
+                                        When the user asks for values of a data series in a year or a range of years, use the _series_lookup tool first.
+                                        Search the vector database only when _series_lookup does not have the data.
+                                    
                                     - Construct Vector Queries:
                                         Convert user inputs into similarity-friendly prompts.
+                                        Keep the exact years, series names and terms (e.g. "percent change") of the question in the query, the search matches them as keywords too.
                                         Leverage semantic similarity to find the most relevant results in the vector store.
                                     
                                     - Search and Retrieval:
@@ -89,18 +234,31 @@ _retrieval_agent = create_react_agent(llm,
                                         debug=_logger.getEffectiveLevel() < logging.WARNING)
 
 
-def retriever_node(state: ApplicationState) -> Command[Literal["supervisor_node"]]:
-    """
-    langgraph node
-    """
-    result = _retrieval_agent.invoke(state, debug=_logger.getEffectiveLevel() < logging.WARNING)
+def _agent_input(state: ApplicationState) -> ApplicationState:
+    """The agent starts without the documents of the previous questions, so its result holds only what this turn retrieved"""
+    return {**state, "documents": []}
 
+def _command(result: ApplicationState) -> Command[Literal["supervisor_node"]]:
+    documents = result.get("documents", [])
     return Command(
         update={
             "messages": [
-                HumanMessage(content=result["messages"][-1].content, name="retriever")
+                # documents_found tells the supervisor whether this turn found anything, the state also holds the earlier documents
+                HumanMessage(content=result["messages"][-1].content, name="retriever", additional_kwargs={"documents_found": len(documents)})
             ],
-            "documents": result.get("documents", [])
+            "documents": documents
         },
         goto="supervisor_node",
-    )
\ No newline at end of file
+    )
+
+def retriever_node(state: ApplicationState) -> Command[Literal["supervisor_node"]]:
+    """
+    langgraph node
+    """
+    return _command(_retrieval_agent.invoke(_agent_input(state), debug=_logger.getEffectiveLevel() < logging.WARNING))
+
+async def aretriever_node(state: ApplicationState) -> Command[Literal["supervisor_node"]]:
+    """
+    Async langgraph node, used by app.aquery
+    """
+    return _command(await _retrieval_agent.ainvoke(_agent_input(state), debug=_logger.getEffectiveLevel() < logging.WARNING))
@@ -0,0 +1,459 @@
+"""
+series_store keeps the numbers of the extracted tables (see table_extractor) in a local SQLite table:
+one row per (series, year, column, value).
+
+Questions like "what was the average expenditure in 2013" or "motor vehicle insurance index 2010-2015"
+can be answered straight from here without the vector search and without reading the whole source documents.
+
+iii.org publishes rolling windows of the same series (1998-2007, 1999-2008, ...), so the same values come from many files.
+We keep a single canonical value per (series, year, column) - the one from the latest publication -
+and record every file it was found in (series_value_sources).
+"""
+import csv
+import io
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+from collections import defaultdict
+from contextlib import closing, contextmanager
+from typing import Dict, Final, Iterator, List, Tuple, Union
+
+from pydantic import BaseModel
+
+from agents.table_extractor import ExtractedTable
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+SERIES_DB_PATH: Final[str] = "data/series.sqlite"
+
+# 2 - normalized column names and titles (see normalize_name), the keys of the older values don't match anymore
+# 3 - the summary rows of the yearly tables ("Percent change 2000-2009") are footnotes, not values (see table_extractor)
+# 4 - yearly rows under a section heading ("Liability 2004") are stored by year, the section is their label
+_CONST_SCHEMA_VERSION = 4
+
+_CONST_YEAR_PATTERN = re.compile(r"^(19|20)\d\d$")
+
+# label of a yearly row under a section heading (see table_extractor): "Liability 2004"
+_CONST_SECTION_YEAR_PATTERN = re.compile(r"^(?P<section>.*\D)\s+(?P<year>(19|20)\d\d)$")
+
+_CONST_PERIOD_PATTERN = re.compile(r"(19|20)\d\d(\s*-\s*(19|20)\d\d)?(\s+model years)?", re.IGNORECASE)
+
+# ", 2004-2013", ", 2015", " 2010-2012 Model Years", "(1)", "(Cont'd)", ", United States"
+_CONST_TITLE_NOISE_PATTERNS = [
+    re.compile(r"\(\d+\)"),
+    re.compile(r",\s*United States", re.IGNORECASE),
+    re.compile(r"\(?Cont'?d\)?", re.IGNORECASE),
+    re.compile(r",?\s*" + _CONST_PERIOD_PATTERN.pattern, re.IGNORECASE),
+]
+
+# "(6)", "(5), (6)", "(5),(6)" and "1/", "2/" footnote markers of the headers and labels
+_CONST_FOOTNOTE_PATTERN = re.compile(r"\s*\(\d+\)(\s*,\s*\(\d+\))*|(?<=\D)\s+\d+/(?=\s|$)")
+
+# "single- family" (a line break in the header cell) -> "single-family"
+_CONST_HYPHEN_SPACE_PATTERN = re.compile(r"(\w)-\s+(\w)")
+
+_CONST_NUMBER_WORDS = {
+    word: str(number) for number, word in enumerate(
+        "zero one two three four five six seven eight nine ten eleven twelve thirteen fourteen fifteen sixteen seventeen eighteen nineteen twenty".split())
+}
+_CONST_NUMBER_WORD_PATTERN = re.compile(r"\b(" + "|".join(_CONST_NUMBER_WORDS) + r")\b", re.IGNORECASE)
+
+# period is the year for the yearly series ("2013") or the period of the title for the rest ("2015", "2010-2012 Model Years")
+# published is the last year mentioned in the title. Values from the latest publication win.
+_CONST_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS series_values (
+        series TEXT NOT NULL,
+        period TEXT NOT NULL,
+        label TEXT NOT NULL,
+        label_header TEXT NOT NULL DEFAULT '',
+        year INTEGER,
+        column_name TEXT NOT NULL,
+        value REAL,
+        raw_value TEXT NOT NULL,
+        unit TEXT NOT NULL DEFAULT '',
+        attribution TEXT NOT NULL DEFAULT '',
+        title TEXT NOT NULL,
+        source TEXT NOT NULL,
+        published INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (series, period, label, column_name)
+    );
+    CREATE INDEX IF NOT EXISTS series_values_series_year ON series_values (series, year);
+
+    CREATE TABLE IF NOT EXISTS series_value_sources (
+        series TEXT NOT NULL,
+        period TEXT NOT NULL,
+        label TEXT NOT NULL,
+        column_name TEXT NOT NULL,
+        source TEXT NOT NULL,
+        raw_value TEXT NOT NULL,
+        PRIMARY KEY (series, period, label, column_name, source)
+    );
+"""
+
+# Not part of the versioned schema, an upgrade doesn't drop the values for it
+_CONST_LOCKS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS series_locks (
+        series TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires REAL NOT NULL
+    );
+"""
+
+# (series, period, label) keys dropped by a schema upgrade, removed from the vector store by the next rebuild (see document_processor.rebuild_series_store)
+_CONST_DROPPED_KEYS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS dropped_keys (
+        series TEXT NOT NULL,
+        period TEXT NOT NULL,
+        label TEXT NOT NULL,
+        PRIMARY KEY (series, period, label)
+    );
+"""
+
+# A series lock older than this is left over by a crashed process and is taken over
+_CONST_SERIES_LOCK_SECONDS = 600
+_CONST_SERIES_LOCK_POLL_SECONDS = 0.05
+
+_CONST_UPSERT = """
+    INSERT INTO series_values (series, period, label, label_header, year, column_name, value, raw_value, unit, attribution, title, source, published)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (series, period, label, column_name) DO UPDATE SET
+        value = excluded.value, raw_value = excluded.raw_value, unit = excluded.unit, attribution = excluded.attribution,
+        title = excluded.title, source = excluded.source, published = excluded.published
+    WHERE excluded.published >= series_values.published
+"""
+
+
+class SeriesValue(BaseModel):
+    series: str
+    period: str
+    label: str
+    year: Union[int, None]
+    column_name: str
+    value: Union[float, None]
+    raw_value: str
+    unit: str
+    source: str
+
+
+class CanonicalRow(BaseModel):
+    """A row of canonical values we embed instead of the rows of every single file"""
+    id: str
+    text: str
+    series: str
+    source: str
+    sources: List[str]
+
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _connect() -> sqlite3.Connection:
+    global _initialized
+
+    os.makedirs(os.path.dirname(SERIES_DB_PATH) or ".", exist_ok=True)
+    connection = sqlite3.connect(SERIES_DB_PATH, timeout=30)
+
+    # Once per process. Concurrent first connections (process_directotry) would otherwise see each other's half created schema and drop it.
+    with _init_lock:
+        if not _initialized:
+            connection.executescript(_CONST_LOCKS_SCHEMA + _CONST_DROPPED_KEYS_SCHEMA)
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version < _CONST_SCHEMA_VERSION:
+                if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'series_values'").fetchone():
+                    _logger.warning("Series store schema has changed, old values are dropped. Run --rebuild-series-store to fill it again")
+                    if version >= 1:
+                        # their rows are in the vector store under the old keys, see dropped_keys()
+                        connection.execute("INSERT OR IGNORE INTO dropped_keys SELECT DISTINCT series, period, label FROM series_values")
+                connection.executescript("DROP TABLE IF EXISTS series_values; DROP TABLE IF EXISTS series_value_sources;")
+                connection.executescript(_CONST_SCHEMA + f"PRAGMA user_version = {_CONST_SCHEMA_VERSION};")
+        _initialized = True
+
+    return connection
+
+
+@contextmanager
+def series_lock(series: str) -> Iterator[None]:
+    """Lock on a series across the threads and the processes (the ingestion workers), held while its rows are indexed.
+    It's a row in series_locks, so it doesn't block the writes of the other series.
+    """
+    owner = uuid.uuid4().hex
+    while True:
+        with closing(_connect()) as connection, connection:
+            now = time.time()
+            connection.execute("DELETE FROM series_locks WHERE series = ? AND expires < ?", (series, now))
+            acquired = connection.execute("INSERT OR IGNORE INTO series_locks VALUES (?, ?, ?)",
+                                          (series, owner, now + _CONST_SERIES_LOCK_SECONDS)).rowcount == 1
+        if acquired:
+            break
+        time.sleep(_CONST_SERIES_LOCK_POLL_SECONDS)
+
+    try:
+        yield
+    finally:
+        with closing(_connect()) as connection, connection:
+            connection.execute("DELETE FROM series_locks WHERE series = ? AND owner = ?", (series, owner))
+
+
+def normalize_name(name: str) -> str:
+    """Column name, row label or title without the differences between the files of the same series:
+    footnote markers, the space after a hyphen and number words.
+    "Legal services (6) Index" -> "Legal services Index", "Existing single- family homes" -> "Existing single-family homes", "Top Ten" -> "Top 10"
+    """
+
+    name = _CONST_FOOTNOTE_PATTERN.sub("", name.replace("\xa0", " "))
+    name = _CONST_HYPHEN_SPACE_PATTERN.sub(r"\1-\2", name)
+    name = _CONST_NUMBER_WORD_PATTERN.sub(lambda match: _CONST_NUMBER_WORDS[match.group(1).lower()], name)
+    return " ".join(name.split()).strip(" ,")
+
+
+def _normalize_column(column: str) -> str:
+    """normalize_name in sentence case, "Collision/Comprehensive Combined ratio (2)" and "Collision/comprehensive Combined ratio" are the same column"""
+
+    column = normalize_name(column)
+    return column[:1].upper() + column[1:].lower()
+
+
+def normalize_series_title(title: str) -> str:
+    """Title without the year range and footnote markers, so the rolling windows of the same series share a name.
+    "Average Expenditures For Auto Insurance, 2004-2013" -> "Average Expenditures For Auto Insurance"
+    """
+
+    for pattern in _CONST_TITLE_NOISE_PATTERNS:
+        title = pattern.sub(" ", title)
+
+    title = normalize_name(title.replace("&#039;", "'")).strip(" ,.")
+    return title.title()
+
+
+def _title_period(title: str) -> Tuple[str, int]:
+    """ "Top 10 Writers ..., 2015" -> ("2015", 2015), "... 2010-2012 Model Years" -> ("2010-2012 Model Years", 2012) """
+
+    matches = list(_CONST_PERIOD_PATTERN.finditer(title))
+    if not matches:
+        return "", 0
+
+    period = " ".join(matches[-1].group(0).split())
+    return period, max(int(year) for year in re.findall(r"(?:19|20)\d\d", period))
+
+
+def parse_value(raw_value: str) -> Union[float, None]:
+    """ "$842.65" -> 842.65, "1.5%" -> 1.5, "-4.2 pts." -> -4.2, "NA" -> None """
+
+    cleaned = re.sub(r"[$,%\s]|pts?\.?", "", raw_value)
+    negative = cleaned.startswith("(") and cleaned.endswith(")")
+    try:
+        value = float(cleaned.strip("()"))
+    except ValueError:
+        return None
+
+    return -value if negative else value
+
+
+def add_table(table: ExtractedTable, source: str, reindex: bool = False) -> List[Tuple[str, str, str]]:
+    """Writes all the values of the extracted table.
+    Values already known from a later publication are only recorded as found in this source.
+
+    Args:
+        table: the extracted table
+        source: normalized file name of the document in the storage
+        reindex: also return the rows whose canonical values come from this source but didn't change,
+                 so an insert that crashed before embedding them can embed them again
+
+    Returns:
+        (series, period, label) keys of the rows which got new or revised values
+    """
+
+    series = normalize_series_title(table.title)
+    title_period, published = _title_period(table.title)
+    title_year = int(title_period) if _CONST_YEAR_PATTERN.match(title_period) else None
+
+    records = []
+    for row in table.rows:
+        is_yearly = table.label_header == "Year" and _CONST_YEAR_PATTERN.match(row.label)
+        section_year = _CONST_SECTION_YEAR_PATTERN.match(row.label) if table.label_header in ("Year", "") else None
+        for column, raw_value in row.values.items():
+            if not raw_value:
+                continue
+
+            if is_yearly:
+                records.append((row.label, row.label, "Year", int(row.label), _normalize_column(column), raw_value))
+            elif section_year:
+                # "Liability 2004" -> the 2004 row of Liability
+                year = section_year.group("year")
+                records.append((year, normalize_name(section_year.group("section")), "", int(year), _normalize_column(column), raw_value))
+            elif _CONST_YEAR_PATTERN.match(column):
+                # years are the columns (e.g. incurred losses), the row is the measure
+                records.append((column, column, "Year", int(column), _normalize_column(row.label), raw_value))
+            else:
+                records.append((title_period, normalize_name(row.label), table.label_header, title_year, _normalize_column(column), raw_value))
+
+    changed = set()
+    with closing(_connect()) as connection, connection:
+        for period, label, label_header, year, column, raw_value in records:
+            key = (series, period, label, column)
+            before = connection.execute("SELECT value, raw_value FROM series_values WHERE series = ? AND period = ? AND label = ? AND column_name = ?", key).fetchone()
+
+            connection.execute(_CONST_UPSERT, (series, period, label, label_header, year, column, parse_value(raw_value), raw_value,
+                                               table.note, table.source, table.title, source, published))
+            connection.execute("INSERT OR REPLACE INTO series_value_sources VALUES (?, ?, ?, ?, ?, ?)", key + (source, raw_value))
+
+            after = connection.execute("SELECT value, raw_value, source FROM series_values WHERE series = ? AND period = ? AND label = ? AND column_name = ?", key).fetchone()
+            # "$842.65" and "842.65" are the same value, only the formatting differs
+            if before is None or (after[2] == source and (reindex or (before[0] != after[0] if after[0] is not None else before[1] != after[1]))):
+                changed.add((series, period, label))
+
+    _logger.info(f"{len(records)} values of {series} saved from {source}, {len(changed)} rows are new or revised")
+    return sorted(changed)
+
+
+def row_id(series: str, period: str, label: str) -> str:
+    """Vector store id of the canonical row"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"series_store:{series}|{period}|{label}"))
+
+
+def canonical_rows(keys: List[Tuple[str, str, str]]) -> List[CanonicalRow]:
+    """Text rows to embed for the given (series, period, label) keys, built from the canonical values.
+    Row ids are derived from the keys, so re-embedding a revised row replaces the old one.
+    """
+
+    rows = []
+    with closing(_connect()) as connection:
+        for series, period, label in keys:
+            values = connection.execute("""
+                SELECT label_header, column_name, raw_value, unit, attribution, source FROM series_values
+                WHERE series = ? AND period = ? AND label = ? ORDER BY rowid""", (series, period, label)).fetchall()
+            if not values:
+                continue
+
+            sources = [row[0] for row in connection.execute("""
+                SELECT DISTINCT source FROM series_value_sources
+                WHERE series = ? AND period = ? AND label = ? ORDER BY source""", (series, period, label))]
+
+            label_header, _, _, unit, attribution, source = values[0]
+            context = " ".join(part.rstrip(".") + "." for part in [series, unit, attribution] if part)
+            key = f"{label_header}: {label}" if label_header else label
+            if period != label:
+                key = f"{period}, {key}"
+
+            pairs = [f"{column}: {raw_value}" for _, column, raw_value, _, _, _ in values]
+            rows.append(CanonicalRow(
+                id=row_id(series, period, label),
+                text=f"{context} {', '.join([key] + pairs)}",
+                series=series,
+                source=source,
+                sources=sources,
+            ))
+
+    return rows
+
+
+def all_keys() -> List[Tuple[str, str, str]]:
+    """(series, period, label) keys of all the rows, see canonical_rows"""
+
+    with closing(_connect()) as connection:
+        return connection.execute("SELECT DISTINCT series, period, label FROM series_values ORDER BY series, period, label").fetchall()
+
+
+def dropped_keys() -> List[Tuple[str, str, str]]:
+    """(series, period, label) keys of the rows dropped by a schema upgrade whose documents may still be in the vector store"""
+
+    with closing(_connect()) as connection:
+        return connection.execute("SELECT series, period, label FROM dropped_keys ORDER BY series, period, label").fetchall()
+
+
+def forget_dropped_keys(keys: List[Tuple[str, str, str]]):
+    with closing(_connect()) as connection, connection:
+        connection.executemany("DELETE FROM dropped_keys WHERE series = ? AND period = ? AND label = ?", keys)
+
+
+def _like_all(field: str, text: str) -> Tuple[str, List[str]]:
+    # the names are stored normalized: "top ten" has to find "Top 10"
+    words = [word for word in re.findall(r"\w+", normalize_name(text).lower()) if len(word) > 1]
+    return " AND ".join([f"LOWER({field}) LIKE ?"] * len(words)), [f"%{word}%" for word in words]
+
+
+def query(series: str, column: str = "", year_from: Union[int, None] = None, year_to: Union[int, None] = None, limit: int = 500) -> List[SeriesValue]:
+    """Finds the values by series and column names (every word has to match) and a year range.
+
+    Args:
+        series: words of the series title, for example "average expenditures auto insurance"
+        column: words of the column name, for example "percent change". Empty - all the columns
+        year_from, year_to: inclusive year range. None - not limited
+
+    Returns:
+        matching canonical values ordered by series, year and column
+    """
+
+    conditions, parameters = [], []
+    for field, text in [("series", series), ("column_name", column)]:
+        condition, values = _like_all(field, text)
+        if condition:
+            conditions.append(condition)
+            parameters.extend(values)
+
+    if year_from is not None:
+        conditions.append("year >= ?")
+        parameters.append(year_from)
+    if year_to is not None:
+        conditions.append("year <= ?")
+        parameters.append(year_to)
+
+    where = " AND ".join(conditions) or "1 = 1"
+    with closing(_connect()) as connection:
+        rows = connection.execute(f"""
+            SELECT series, period, label, year, column_name, value, raw_value, unit, source
+            FROM series_values
+            WHERE {where}
+            ORDER BY series, year, period, rowid
+            LIMIT ?""", parameters + [limit]).fetchall()
+
+    return [SeriesValue(series=row[0], period=row[1], label=row[2], year=row[3], column_name=row[4], value=row[5], raw_value=row[6], unit=row[7], source=row[8])
+            for row in rows]
+
+
+def sources_of(series: str) -> Dict[str, List[str]]:
+    """Provenance of the series: period -> every file its values were found in"""
+
+    provenance = defaultdict(list)
+    with closing(_connect()) as connection:
+        for period, source in connection.execute("SELECT DISTINCT period, source FROM series_value_sources WHERE series = ? ORDER BY period, source", (series,)):
+            provenance[period].append(source)
+
+    return dict(provenance)
+
+
+def list_series() -> List[str]:
+    with closing(_connect()) as connection:
+        return [row[0] for row in connection.execute("SELECT DISTINCT series FROM series_values ORDER BY series")]
+
+
+def yearly_columns() -> Dict[str, List[str]]:
+    """series -> columns, of the series that have values by year (the ones that can be charted over time)"""
+
+    columns = defaultdict(list)
+    with closing(_connect()) as connection:
+        for series, column_name in connection.execute("""
+                SELECT series, column_name FROM series_values
+                WHERE year IS NOT NULL
+                GROUP BY series, column_name
+                ORDER BY series, MIN(rowid)"""):
+            columns[series].append(column_name)
+
+    return dict(columns)
+
+
+def to_csv(values: List[SeriesValue]) -> str:
+    """Compact text representation for the prompts"""
+
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(["series", "period", "label", "column", "value", "unit", "source"])
+    writer.writerows([value.series, value.period, value.label, value.column_name, value.raw_value, value.unit, value.source] for value in values)
+    return output.getvalue()
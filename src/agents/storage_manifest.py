@@ -0,0 +1,112 @@
+"""
+storage_manifest maps the sha256 of the file contents to the normalized file name in the document storage,
+so a duplicate is found with a single lookup instead of comparing against every stored file.
+
+It's a local SQLite table shared by all the processes (the CLI, the UI, the ingestion workers): every insert
+writes just its own entry, nobody rewrites the whole manifest from a stale in-memory copy.
+The "is it stored already -> store it -> register it" step of an insert runs under locked(), so two processes can't store the same file twice.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+from contextlib import closing, contextmanager
+from typing import Dict, Final, Iterator, Union
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+STORAGE_MANIFEST_DB_PATH: Final[str] = "data/storage_manifest.sqlite"
+
+# The manifest used to be a json file, it's imported when the table is created
+_CONST_LEGACY_MANIFEST_FILE = "data/storage_manifest.json"
+
+_CONST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifest (
+    content_hash TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL
+);
+"""
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _import_legacy(connection: sqlite3.Connection):
+    try:
+        with open(_CONST_LEGACY_MANIFEST_FILE, encoding="utf-8") as f:
+            legacy = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return
+
+    _logger.info(f"Importing {len(legacy)} entries from {_CONST_LEGACY_MANIFEST_FILE}")
+    connection.executemany("INSERT OR IGNORE INTO manifest VALUES (?, ?)", legacy.items())
+
+
+def _connect() -> sqlite3.Connection:
+    global _initialized
+
+    os.makedirs(os.path.dirname(STORAGE_MANIFEST_DB_PATH) or ".", exist_ok=True)
+    connection = sqlite3.connect(STORAGE_MANIFEST_DB_PATH, timeout=30)
+
+    with _init_lock:
+        if not _initialized:
+            with connection:
+                created = not connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'manifest'").fetchone()
+                connection.executescript(_CONST_SCHEMA)
+                if created:
+                    _import_legacy(connection)
+            _initialized = True
+
+    return connection
+
+
+@contextmanager
+def locked() -> Iterator[sqlite3.Connection]:
+    """Write lock on the manifest across the threads and the processes (BEGIN IMMEDIATE) until the block ends.
+    Pass the connection to lookup() and register() inside the block, it's committed at the end (rolled back on an error).
+    """
+    with closing(_connect()) as connection:
+        connection.isolation_level = None
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+
+def lookup(content_hash: str, connection: Union[sqlite3.Connection, None] = None) -> Union[str, None]:
+    """Normalized file name stored with these contents, None if there's none"""
+
+    if connection is None:
+        with closing(_connect()) as connection:
+            return lookup(content_hash, connection)
+
+    row = connection.execute("SELECT file_name FROM manifest WHERE content_hash = ?", (content_hash,)).fetchone()
+    return row[0] if row else None
+
+
+def register(content_hash: str, file_name: str, connection: Union[sqlite3.Connection, None] = None):
+    if connection is None:
+        with closing(_connect()) as connection, connection:
+            register(content_hash, file_name, connection)
+        return
+
+    connection.execute("INSERT OR REPLACE INTO manifest VALUES (?, ?)", (content_hash, file_name))
+
+
+def replace_all(manifest: Dict[str, str]):
+    """Replaces all the entries in one transaction, see document_processor.rebuild_manifest"""
+
+    with closing(_connect()) as connection, connection:
+        connection.execute("DELETE FROM manifest")
+        connection.executemany("INSERT INTO manifest VALUES (?, ?)", manifest.items())
+
+
+def is_empty() -> bool:
+    with closing(_connect()) as connection:
+        return connection.execute("SELECT 1 FROM manifest LIMIT 1").fetchone() is None
@@ -0,0 +1,147 @@
+"""
+summary_store keeps the per document summaries and the overview of the whole knowledge base in a local SQLite database.
+
+Every indexed document gets a row with its summary. The overview is kept apart from them and remembers
+which summaries it already covers (merged), so a refresh sends the llm only the previous overview and the new summaries
+instead of everything summarized so far (see document_processor.update_overview).
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from contextlib import closing, contextmanager
+from typing import Final, Iterator, List, Tuple, Union
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+SUMMARY_DB_PATH: Final[str] = "data/summaries.sqlite"
+
+# The overview used to be kept (mixed with the appended document summaries) in this file.
+# It's the starting overview when the store is created.
+_CONST_LEGACY_SUMMARY_FILE = "documents_summary.txt"
+
+_CONST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS document_summaries (
+    source TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    added REAL NOT NULL,
+    merged INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS document_summaries_pending ON document_summaries (merged) WHERE merged = 0;
+CREATE TABLE IF NOT EXISTS overview (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    text TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS overview_lock (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+# An overview lock older than this is left over by a crashed process and is taken over
+_CONST_OVERVIEW_LOCK_SECONDS = 600
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _seed_overview(connection: sqlite3.Connection):
+    try:
+        with open(_CONST_LEGACY_SUMMARY_FILE, encoding="utf-8") as f:
+            legacy = f.read().strip()
+    except FileNotFoundError:
+        return
+
+    if legacy:
+        _logger.info(f"Starting the overview from {_CONST_LEGACY_SUMMARY_FILE}")
+        connection.execute("INSERT OR IGNORE INTO overview (id, text, updated) VALUES (1, ?, ?)", (legacy, time.time()))
+
+
+def _connect() -> sqlite3.Connection:
+    global _initialized
+
+    os.makedirs(os.path.dirname(SUMMARY_DB_PATH) or ".", exist_ok=True)
+    connection = sqlite3.connect(SUMMARY_DB_PATH, timeout=30)
+
+    with _init_lock:
+        if not _initialized:
+            with connection:
+                created = not connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'overview'").fetchone()
+                connection.executescript(_CONST_SCHEMA)
+                if created:
+                    _seed_overview(connection)
+            _initialized = True
+
+    return connection
+
+
+def add_summary(source: str, summary: str):
+    """Saves (or replaces) the summary of a document. It's merged into the overview with the next refresh."""
+
+    with closing(_connect()) as connection, connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO document_summaries (source, summary, added, merged) VALUES (?, ?, ?, 0)",
+            (source, summary.strip(), time.time()),
+        )
+
+
+def pending(limit: Union[int, None] = None) -> List[Tuple[str, str]]:
+    """(source, summary) of the documents not merged into the overview yet, the oldest first"""
+
+    with closing(_connect()) as connection:
+        return connection.execute(
+            "SELECT source, summary FROM document_summaries WHERE merged = 0 ORDER BY added, source LIMIT ?",
+            (-1 if limit is None else limit,),
+        ).fetchall()
+
+
+def get_overview() -> Union[str, None]:
+    with closing(_connect()) as connection:
+        row = connection.execute("SELECT text FROM overview WHERE id = 1").fetchone()
+        return row[0] if row else None
+
+
+def save_overview(text: str, merged: List[Tuple[str, str]]):
+    """Replaces the overview and marks the summaries it was built from as merged, in one transaction.
+    Args:
+        text: the new overview
+        merged: (source, summary) from pending(). A summary replaced in the meantime stays pending.
+    """
+
+    with closing(_connect()) as connection, connection:
+        connection.execute("INSERT OR REPLACE INTO overview (id, text, updated) VALUES (1, ?, ?)", (text, time.time()))
+        connection.executemany("UPDATE document_summaries SET merged = 1 WHERE source = ? AND summary = ?", merged)
+
+
+@contextmanager
+def overview_lock() -> Iterator[bool]:
+    """Lock on the overview refresh across the processes, without waiting.
+    Yields True if this process holds it for the block, False if another one is refreshing the overview.
+    """
+    owner = uuid.uuid4().hex
+    with closing(_connect()) as connection, connection:
+        now = time.time()
+        connection.execute("DELETE FROM overview_lock WHERE expires < ?", (now,))
+        acquired = connection.execute("INSERT OR IGNORE INTO overview_lock VALUES (1, ?, ?)",
+                                      (owner, now + _CONST_OVERVIEW_LOCK_SECONDS)).rowcount == 1
+
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with closing(_connect()) as connection, connection:
+                connection.execute("DELETE FROM overview_lock WHERE owner = ?", (owner,))
+
+
+def reset():
+    """Drops the overview and marks all the summaries as not merged, so the next refresh builds the overview from scratch"""
+
+    with closing(_connect()) as connection, connection:
+        connection.execute("DELETE FROM overview")
+        connection.execute("UPDATE document_summaries SET merged = 0")
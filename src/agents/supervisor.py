@@ -1,13 +1,18 @@
 """
 Supervisor will dedicate tasks to the workes.
 Supervisor does not write to the state, just dedicates the tasks (except a special case where the question is too simple)
+
+The usual flow (retriever -> analyst -> visualizer if asked -> end) is routed by rules, without calling the llm.
+The llm decides only when the rules can't, e.g. a follow up question while the documents of the previous question are still in the state.
 """
+import re
+
 from pydantic import Field
-from typing import Final, TypedDict, Literal, Union
+from typing import Final, List, TypedDict, Literal, Union
 
 from langgraph.constants import END
 from langgraph.types import Command
-from langchain_core.messages import AIMessage
+from langchain_core.messages import AIMessage, AnyMessage, HumanMessage
 
 from config.models import llm
 from state_schemas import ApplicationState
@@ -42,8 +47,47 @@ class GraphRouter(TypedDict):
     reason: str = Field(description="A short explanation why this worker was needed")
     next: Union[agents] = Field(description="next worker name")
 
+_CONST_VISUALIZATION_PATTERN = re.compile(r"\b(visuali[sz]\w*|chart\w*|plot\w*|graph\w*|draw\w*|diagram\w*|histogram\w*|image\w*|picture\w*)\b", re.IGNORECASE)
+
+def _current_turn(messages: List[AnyMessage]) -> List[AnyMessage]:
+    """Messages starting with the last user question. Workers' messages are named (retriever, analyst), user messages are not."""
+    for index in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[index], HumanMessage) and not messages[index].name:
+            return messages[index:]
+
+    return messages
+
+def _route(state: ApplicationState) -> Union[str, None]:
+    """Deterministic routing of the usual flow.
+    Returns:
+        next worker name or None if the llm has to decide
+    """
+    turn = _current_turn(state["messages"])
+    if not turn or not isinstance(turn[0], HumanMessage):
+        return None
+
+    workers = [message.name for message in turn[1:]]
+    if "retriever" not in workers:
+        # documents left from a previous question may be enough for a follow up, let the llm decide
+        return "retriever_node" if not state.get("documents") else None
+
+    if not any(message.additional_kwargs.get("documents_found") for message in turn[1:] if message.name == "retriever"):
+        # retriever has found nothing for this question (the documents of the earlier ones may still be in the state),
+        # the llm decides whether to retry or give up
+        return None
+
+    if "analyst" not in workers:
+        return "analyst_node"
+
+    return "visualizer_node" if _CONST_VISUALIZATION_PATTERN.search(str(turn[0].content)) else END
+
 def supervisor_node(state: ApplicationState) -> Command[agents]:
     
+    goto = _route(state)
+    if goto is not None:
+        _logger.debug(f"Supervisor routed to {goto} without the llm")
+        return Command(goto=goto)
+    
     system_message =  {"role": "system", "content": _CONST_SUPERVISOR_SYSTEM_PROMPT}
     messages = [system_message] + state["messages"]
 
@@ -63,4 +107,17 @@ def supervisor_node(state: ApplicationState) -> Command[agents]:
     #         goto=END
     #     )
 
-    return Command(goto=goto)
\ No newline at end of file
+    return Command(goto=goto)
+
+async def asupervisor_node(state: ApplicationState) -> Command[agents]:
+    """Async supervisor_node, used by app.aquery"""
+    
+    goto = _route(state)
+    if goto is not None:
+        _logger.debug(f"Supervisor routed to {goto} without the llm")
+        return Command(goto=goto)
+    
+    system_message =  {"role": "system", "content": _CONST_SUPERVISOR_SYSTEM_PROMPT}
+    response = await llm.with_structured_output(GraphRouter).ainvoke([system_message] + state["messages"])
+
+    return Command(goto=response["next"])
@@ -0,0 +1,282 @@
+"""
+table_extractor flattens iii.org html tables (the .xls files are really html) into data rows without calling the llm.
+
+Each row is merged with the free-text information of the document, as described in the README:
+    Average Expenditures For Auto Insurance, 2004-2013. Source: ... Year: 2004, Average expenditure: $842.65, Percent change: 1.5%
+
+Handled layouts:
+    - a plain header row + data rows
+    - grouped headers (e.g. "Liability" over "Net premiums written", "Annual percent change", ...)
+    - side by side column groups (e.g. "Year | Average expenditure | Year | Average expenditure")
+    - header rows placed inside <tbody> and section label rows (e.g. "Commercial auto" followed by "Liability", "Physical damage")
+    - summary rows after the years (e.g. "Percent change 2000-2009") are not data rows, they go to the footnotes
+
+If the document doesn't look like one of these, extract_table returns None and the caller should fall back to the llm.
+"""
+import re
+
+from typing import Dict, List, Tuple, Union
+
+from bs4 import BeautifulSoup
+from bs4.element import Tag
+from pydantic import BaseModel, Field
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_CONST_YEAR_PATTERN = re.compile(r"^(19|20)\d\d$")
+
+_CONST_NUMBER_PATTERN = re.compile(r"^\(?[-+]?\$?\s*[-+]?\d[\d,]*(\.\d+)?\s*%?\s*(pts?\.?)?\)?$")
+
+
+class TableRow(BaseModel):
+    label: str = Field(description="value of the first column, for example a year or a row name")
+    values: Dict[str, str] = Field(description="column name -> raw cell value, in the column order")
+
+
+class ExtractedTable(BaseModel):
+    title: str
+    note: str = Field(default="", description="text between the title and the table, for example ($000)")
+    source: str = Field(default="", description="the 'Source: ...' remark")
+    footnotes: str = Field(default="", description="the rest of the remarks below the table")
+    label_header: str = Field(default="", description="header of the first column, for example Year or Rank")
+    columns: List[str]
+    rows: List[TableRow]
+
+    def context(self) -> str:
+        """The free texts every data row starts with"""
+        return " ".join(part.rstrip(".") + "." for part in [self.title, self.note, self.source] if part)
+
+    def to_data_rows(self) -> str:
+        """Flattens the table into the rows we embed. Rows are separated by an empty line."""
+
+        context = self.context()
+        lines = []
+        for row in self.rows:
+            pairs = [f"{column}: {value}" for column, value in row.values.items() if value]
+            label = f"{self.label_header}: {row.label}" if self.label_header else row.label
+            lines.append(f"{context} {', '.join([label] + pairs)}")
+
+        if self.footnotes:
+            lines.append(f"{context} Notes: {self.footnotes}")
+
+        return "\n\n".join(lines)
+
+    def summary(self) -> str:
+        labels = f" ({self.rows[0].label} - {self.rows[-1].label})" if self.label_header == "Year" else ""
+        return f"{self.title}{labels}: {', '.join(self.columns)}.\n"
+
+
+def _text(element: Union[Tag, str]) -> str:
+    text = element.get_text(" ", strip=True) if isinstance(element, Tag) else str(element)
+    return " ".join(text.replace("\xa0", " ").split())
+
+
+def _is_number(value: str) -> bool:
+    return bool(_CONST_NUMBER_PATTERN.match(value))
+
+
+def _cells(row: Tag) -> List[str]:
+    return [_text(cell) for cell in row.find_all(["th", "td"], recursive=False)]
+
+
+def _find_data_table(soup: BeautifulSoup) -> Union[Tag, None]:
+    """The innermost table with the most rows. Outer tables are only used for the page layout."""
+
+    tables = [table for table in soup.find_all("table") if not table.find("table")]
+    tables = [table for table in tables if len(table.find_all("tr")) > 1]
+
+    return max(tables, key=lambda table: len(table.find_all("tr")), default=None)
+
+
+def _column_names(header_rows: List[List[str]], width: int) -> List[str]:
+    """Merges (grouped) header rows into a single name per column.
+    Group rows have less cells than the data rows and no colspans, so the groups are spread evenly over the columns after the first one.
+    """
+
+    leaf = header_rows[-1] if header_rows else []
+    if len(leaf) < width:
+        # no leaf row, only the groups
+        header_rows, leaf = header_rows + [[]], []
+
+    names = leaf + [""] * (width - len(leaf))
+
+    for group_row in reversed(header_rows[:-1]):
+        groups = group_row[1:]
+        if not groups or (width - 1) % len(groups):
+            _logger.debug(f"Can't spread header groups {groups} over {width} columns, ignoring them")
+            continue
+
+        span = (width - 1) // len(groups)
+        for index in range(1, width):
+            group = groups[(index - 1) // span]
+            if group:
+                names[index] = f"{group} {names[index]}".strip()
+
+    names = [name or f"Column {index + 1}" for index, name in enumerate(names)]
+
+    # Columns under the same group without their own names get numbered: "Used cars 1", "Used cars 2"
+    if not leaf:
+        names = [
+            f"{name} {names[1:index].count(name) + 1}" if index and names[1:].count(name) > 1 else name
+            for index, name in enumerate(names)
+        ]
+
+    return names
+
+
+def _block_size(columns: List[str]) -> int:
+    """Side by side layouts repeat the first column header, e.g. Year | ... | Year | ...
+    Returns the width of a single block."""
+
+    for blocks in range(len(columns) // 2, 1, -1):
+        size = len(columns) // blocks
+        if len(columns) % blocks == 0 and size > 1 and all(columns[block * size] == columns[0] for block in range(blocks)):
+            return size
+
+    return len(columns)
+
+
+def _remarks(data_table: Tag) -> str:
+    container = data_table.parent
+    if container is None:
+        return ""
+
+    return " ".join(_text(element) for element in container.children if element is not data_table and _text(element)).strip()
+
+
+def _title_and_note(data_table: Tag) -> List[str]:
+    """Texts of the layout rows above the row holding the data table"""
+
+    row = data_table.find_parent("tr")
+    layout = row.find_parent("table") if row else None
+    if layout is None:
+        return []
+
+    texts = []
+    for layout_row in layout.find_all("tr", recursive=False):
+        if layout_row is row:
+            break
+        text = _text(layout_row)
+        if text:
+            texts.append(text)
+
+    return texts
+
+
+def _trailing_summary_rows(rows: List[TableRow]) -> List[TableRow]:
+    """Rows after the last year of a yearly table, e.g. "Percent change 2000-2009" over the whole period"""
+
+    for index in range(len(rows) - 1, -1, -1):
+        if _CONST_YEAR_PATTERN.match(rows[index].label):
+            return rows[index + 1:]
+
+    return []
+
+
+def _summary_text(row: TableRow) -> str:
+    """ "Percent change 2000-2009, Used cars and trucks Percent change: -18.5%, ..." - same as the data rows """
+
+    pairs = [f"{column}: {value}" for column, value in row.values.items() if value]
+    return ", ".join([row.label] + pairs) + "."
+
+
+def extract_table(html: str) -> Union[ExtractedTable, None]:
+    """Parses the iii.org html table.
+
+    Args:
+        html: raw file contents
+
+    Returns:
+        ExtractedTable or None if the document doesn't look like an iii.org data table
+    """
+
+    soup = BeautifulSoup(html, "html.parser")
+    data_table = _find_data_table(soup)
+    if data_table is None:
+        return None
+
+    texts = _title_and_note(data_table)
+    if not texts:
+        return None
+
+    width = max(len(_cells(row)) for row in data_table.find_all("tr"))
+    if width < 2:
+        return None
+
+    # A table can have several header + data sections (e.g. "Liability" years followed by "Physical damage" years).
+    # Header rows are the ones in <thead> or the rows without any numbers before the data rows of a section.
+    sections: List[Tuple[List[List[str]], List[List[str]]]] = []  # (header rows, data rows)
+    header_rows: List[List[str]] = []
+    body_rows: List[List[str]] = []
+    for row in data_table.find_all("tr"):
+        cells = _cells(row)
+        if not any(cells):
+            continue
+
+        is_section_label = bool(cells[0]) and not any(cells[1:])
+        is_header = row.parent.name == "thead" or (not body_rows and not is_section_label and not any(_is_number(cell) for cell in cells[1:]))
+
+        if is_header and not (is_section_label and header_rows):
+            if body_rows:
+                sections.append((header_rows, body_rows))
+                header_rows, body_rows = [], []
+            header_rows.append(cells)
+        else:
+            body_rows.append(cells)
+
+    sections.append((header_rows, body_rows))
+
+    rows: List[TableRow] = []
+    columns: List[str] = []
+    label_header = ""
+    for header_rows, body_rows in sections:
+        section_columns = _column_names(header_rows, width)
+        block = _block_size(section_columns)
+        label_header = label_header or section_columns[0]
+
+        section = ""
+        for cells in body_rows:
+            cells = cells + [""] * (width - len(cells))
+            if cells[0] and not any(cells[1:]):
+                section = cells[0]
+                continue
+
+            for start in range(0, width, block):
+                block_cells, block_columns = cells[start:start + block], section_columns[start:start + block]
+                if not any(block_cells):
+                    continue
+
+                label = f"{section} {block_cells[0]}" if section and block_cells[0] != "Total" else block_cells[0]
+                rows.append(TableRow(label=label, values=dict(zip(block_columns[1:], block_cells[1:]))))
+
+                for column in block_columns[1:]:
+                    if column not in columns:
+                        columns.append(column)
+
+    if not rows:
+        return None
+
+    if label_header.startswith("Column "):
+        # header of the first column is often empty, but those are years most of the time
+        is_year = [bool(_CONST_YEAR_PATTERN.match(row.label)) for row in rows]
+        label_header = "Year" if sum(is_year) > len(is_year) / 2 else ""
+
+    summary_rows = _trailing_summary_rows(rows) if label_header == "Year" else []
+    rows = rows[:len(rows) - len(summary_rows)]
+
+    remarks = _remarks(data_table)
+    source_index = remarks.find("Source:")
+    source, footnotes = (remarks[source_index:], remarks[:source_index].strip()) if source_index >= 0 else ("", remarks)
+    footnotes = " ".join([_summary_text(row) for row in summary_rows] + ([footnotes] if footnotes else []))
+
+    return ExtractedTable(
+        title=texts[0],
+        note=" ".join(texts[1:]),
+        source=source,
+        footnotes=footnotes,
+        label_header=label_header,
+        columns=columns,
+        rows=rows,
+    )
@@ -0,0 +1,135 @@
+"""
+uploads saves the uploaded files for the ingestion in a single streaming pass.
+
+The upload is copied in chunks to a file next to the document storage. While the chunks are written,
+the contents hash is computed and the encoding is checked with an incremental decoder. Nothing holds the whole file
+(or a decoded copy of it) in memory, so the memory use doesn't depend on the size of the upload.
+The ingestion gets the path and the hash and links the file into the storage instead of copying and hashing it again
+(see document_processor.insert_file_into_vector).
+
+Files that aren't UTF-8 (a BOM, a different <meta charset> or invalid UTF-8 bytes) are transcoded to UTF-8 in a second streaming pass,
+the storage only holds UTF-8 documents (see document_store).
+"""
+import codecs
+import hashlib
+import os
+import re
+import tempfile
+
+from typing import BinaryIO, Union
+
+from pydantic import BaseModel
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_CONST_CHUNK_SIZE = 1024 * 1024
+
+# Used when the file is neither valid UTF-8 nor declares its encoding. Decodes (almost) any byte, like the excel exports do.
+_CONST_FALLBACK_ENCODING = "cp1252"
+
+_CONST_CHARSET_PATTERN = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([\w.:-]+)""", re.IGNORECASE)
+
+_CONST_BOMS = [
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+
+class StoredUpload(BaseModel):
+    path: str
+    content_hash: str
+    size: int
+    encoding: str
+
+
+def _declared_encoding(head: bytes) -> Union[str, None]:
+    """Encoding from the BOM or the html <meta charset> of the first chunk"""
+
+    for bom, encoding in _CONST_BOMS:
+        if head.startswith(bom):
+            return encoding
+
+    match = _CONST_CHARSET_PATTERN.search(head)
+    if match:
+        try:
+            encoding = codecs.lookup(match.group(1).decode("ascii")).name
+            # ascii is a subset of utf-8, mislabeled utf-8 files are common
+            return None if encoding == "ascii" else encoding
+        except (LookupError, UnicodeDecodeError):
+            _logger.info(f"Unknown charset {match.group(1)!r}, ignoring it")
+
+    return None
+
+
+def _transcode(path: str, encoding: str, directory: str, prefix: str, suffix: str) -> StoredUpload:
+    """Rewrites the file as UTF-8, chunk by chunk"""
+
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as source, \
+            tempfile.NamedTemporaryFile("wb", dir=directory, prefix=prefix, suffix=suffix, delete=False) as target:
+        for chunk in iter(lambda: source.read(_CONST_CHUNK_SIZE), b""):
+            encoded = decoder.decode(chunk).encode("utf-8")
+            target.write(encoded)
+            digest.update(encoded)
+            size += len(encoded)
+        encoded = decoder.decode(b"", final=True).encode("utf-8")
+        target.write(encoded)
+        digest.update(encoded)
+        size += len(encoded)
+
+    os.remove(path)
+    return StoredUpload(path=target.name, content_hash=digest.hexdigest(), size=size, encoding=encoding)
+
+
+def save_upload(stream: BinaryIO, directory: str, file_name: str) -> StoredUpload:
+    """Streams the upload to a new file in the directory.
+    Args:
+        stream: binary file object of the upload, read from the current position in chunks
+        directory: where to save it. Should be on the same filesystem as the document storage, so the file can be linked there.
+        file_name: original file name, the saved file is named original_name_XXXXX.ext
+    Returns:
+        path, sha256 and size of the saved UTF-8 file and the encoding the upload had
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    name, extension = os.path.splitext(os.path.basename(file_name))
+
+    digest = hashlib.sha256()
+    validator = codecs.getincrementaldecoder("utf-8")()
+    size = 0
+    encoding = None
+    with tempfile.NamedTemporaryFile("wb", dir=directory, prefix=name + "_", suffix=extension, delete=False) as target:
+        for chunk in iter(lambda: stream.read(_CONST_CHUNK_SIZE), b""):
+            if size == 0:
+                encoding = _declared_encoding(chunk)
+            target.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+
+            if validator is not None and encoding in (None, "utf-8"):
+                try:
+                    # only validates, the decoded chunk is dropped right away
+                    validator.decode(chunk)
+                except UnicodeDecodeError:
+                    validator = None
+                    encoding = _CONST_FALLBACK_ENCODING
+
+    if validator is not None and encoding in (None, "utf-8"):
+        try:
+            validator.decode(b"", final=True)
+        except UnicodeDecodeError:
+            # truncated multibyte sequence at the end
+            encoding = _CONST_FALLBACK_ENCODING
+
+    if encoding in (None, "utf-8"):
+        return StoredUpload(path=target.name, content_hash=digest.hexdigest(), size=size, encoding="utf-8")
+
+    _logger.info(f"{file_name} is {encoding}, transcoding it to utf-8")
+    return _transcode(target.name, encoding, directory, name + "_", extension)
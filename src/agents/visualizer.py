@@ -1,15 +1,18 @@
 """
 Visualizer atemps to create matplot charts and save them as tempfiles.
-Code is executed using PythonREPL - so use with caution.
+Code is executed in a separate, pre-warmed worker process with cpu/memory/time limits (see chart_sandbox).
+Line charts and percent change bars of the data series are drawn from templates (see chart_templates), without the code agent.
+Finished charts are kept in the chart_cache, the same chart asked again is returned from there.
 Further more - if it keeps on failing, enable DEBUG loging to scan for generated python code - chances are you're missing some lib the generated code is trying to run.
 
 Alternative (and safer) approach could be using https://quickchart.io/, but that's for another time
 """
-from typing import Annotated, Literal, List
+from typing import Annotated, Literal, List, Tuple, Union
 from langgraph.constants import END
 
 import ast
-from langchain_experimental.utilities import PythonREPL
+import asyncio
+import tempfile
 
 from langchain.tools import tool
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
@@ -19,6 +22,12 @@ from langgraph.prebuilt import create_react_agent
 
 from state_schemas import ApplicationState
 from config.models import llm
+from agents.context_builder import build_context, last_question
+from agents import document_refs
+from agents.chart_sandbox import get_sandbox
+from agents.chart_cache import CHART_FILE_PREFIX
+from agents import chart_cache, chart_templates
+from agents.chart_templates import ChartSpec
 
 import logging
 
@@ -26,24 +35,24 @@ _CONST_VISUALIZER_ERROR = "nothing to visualize"
 
 _logger = logging.getLogger(__name__)
 
-_repl = PythonREPL()
+def _save_chart(image: bytes) -> str:
+    with tempfile.NamedTemporaryFile(prefix=CHART_FILE_PREFIX, suffix=".png", delete=False) as f:
+        f.write(image)
+        
+    return f.name
 
 @tool
 def _python_repl_tool(code: Annotated[str, "The python code to execute to generate your chart."]):
-    """Use this to execute python code."""
-    
-    _logger.log(logging.INFO, "Visualizer code: \n", code)
+    """Use this to execute python code. Returns the paths of the images of the figures the code has created."""
     
-   # print(logging.INFO, "Visualizer code: \n", code)
+    _logger.info(f"Visualizer code: \n{code}")
     
-    try:
-        result = _repl.run(code)
-    except BaseException as e:
-        #print(f"error _python_repl_tool failed running visualizations: \n", repr(e))
-        _logger.log(logging.INFO, "_python_repl_tool failed running visualizations: \n", repr(e))
-        return f"Error: {repr(e)}"
+    result = get_sandbox().run(code)
+    if result.error:
+        _logger.info(f"_python_repl_tool failed running visualizations: \n{result.error}")
+        return f"Error: {result.error}\nstdout: {result.stdout}"
 
-    return f"Successfully executed:\nstdout: {result}"
+    return f"Successfully executed:\nstdout: {result.stdout}\nimages: {[_save_chart(image) for image in result.images]}"
 
 code_agent = create_react_agent(llm, tools=[_python_repl_tool], state_modifier=f"""
     You are a developer tasked with visualizing the data.
@@ -53,24 +62,18 @@ code_agent = create_react_agent(llm, tools=[_python_repl_tool], state_modifier=f
         import matplotlib.pyplot as plt
         matplotlib.use('agg') 
     
-    Image should be saved in the tempfile. When the image is saved to the tempfile, the script should print(tempfile path).
+    Don't save or show the figures - every figure your code creates is saved as an image automatically and the tool returns the image paths.
      
     Return just the python code that can be evaluated using exec(). No code fences, triple ticks or language identifiers.
     
-    If success, return an array of of paths to the tempfiles generated.
+    If success, return a python list of the image paths returned by the tool.
     
     If there is nothing to visualized - return "{_CONST_VISUALIZER_ERROR}"
     
     """, debug=_logger.getEffectiveLevel() < logging.WARNING)
 
-def visualizer_node(state: ApplicationState) -> Command[Literal["__end__"]]:
-    """ Vizualizer langgraph node.
-        returns: Array of paths to the image saved in the system tmp dir or an error string
-    """
-    
-    documents_message = HumanMessage(content="Here are the raw contents of the data: \n" + "\n---------\n".join(state["documents"]), name="documents")
-    
-    result = code_agent.invoke({"messages": state["messages"][-1:] + [documents_message]}, debug=_logger.getEffectiveLevel() < logging.WARNING)
+def _images_or_error(result: ApplicationState) -> Union[List[str], str]:
+    """Parses the code agent answer: a string representing python list of image paths"""
     
     response_content: str = result["messages"][-1].content;
     
@@ -92,7 +95,91 @@ def visualizer_node(state: ApplicationState) -> Command[Literal["__end__"]]:
     #     goto=END
     # )
     
-    return { "images_or_error": images }
+    return images
+
+def _code_agent_input(state: ApplicationState) -> Tuple[dict, str]:
+    """Code agent input and the chart cache key of it"""
+    
+    question = last_question(state["messages"])
+    context = build_context(document_refs.load(state["documents"]), question)
+    documents_message = HumanMessage(content="Here are the raw contents of the data: \n" + context.text, name="documents")
+    
+    return {"messages": state["messages"][-1:] + [documents_message]}, chart_cache.key("agent", question.strip().lower(), context.text)
+
+def _cache_agent_images(images: Union[List[str], str], chart_key: str) -> Union[List[str], str]:
+    """Moves the code agent charts into the chart cache. Anything that's not our tempfile (e.g. an error) is returned as is."""
+    
+    if isinstance(images, list) and images and all(chart_cache.is_chart_tempfile(image) for image in images):
+        return chart_cache.put_files(chart_key, images)
+    
+    return images
+
+def _template_images(spec: Union[ChartSpec, None]) -> Union[List[str], None]:
+    """Renders the spec with a chart template (or gets it from the chart cache). None - the code agent has to draw it"""
+    
+    code = chart_templates.template_code(spec) if spec is not None else None
+    if code is None:
+        return None
+    
+    chart_key = chart_cache.key("template", code)
+    cached = chart_cache.get(chart_key)
+    if cached is not None:
+        return cached
+    
+    result = chart_templates.render(code)
+    if result is None:
+        return None
+    
+    _logger.info(f"Chart drawn from the {spec.chart_type} template")
+    return chart_cache.put(chart_key, result.images)
+
+def visualizer_node(state: ApplicationState) -> Command[Literal["__end__"]]:
+    """ Vizualizer langgraph node.
+        The common charts are drawn from templates (see chart_templates), the rest by the code agent.
+        returns: Array of paths to the image saved in the system tmp dir or an error string
+    """
+    
+    try:
+        spec = chart_templates.chart_spec(last_question(state["messages"]))
+    except Exception as e:
+        _logger.warning(f"Chart spec failed: {e!r}")
+        spec = None
+    
+    images = _template_images(spec)
+    if images is not None:
+        return { "images_or_error": images }
+    
+    agent_input, chart_key = _code_agent_input(state)
+    cached = chart_cache.get(chart_key)
+    if cached is not None:
+        return { "images_or_error": cached }
+    
+    result = code_agent.invoke(agent_input, debug=_logger.getEffectiveLevel() < logging.WARNING)
+    
+    return { "images_or_error": _cache_agent_images(_images_or_error(result), chart_key) }
+
+async def avisualizer_node(state: ApplicationState) -> Command[Literal["__end__"]]:
+    """Async visualizer_node, used by app.aquery. The (sync) sandbox calls run in a worker thread."""
+    
+    try:
+        spec = await chart_templates.achart_spec(last_question(state["messages"]))
+    except Exception as e:
+        _logger.warning(f"Chart spec failed: {e!r}")
+        spec = None
+    
+    images = await asyncio.to_thread(_template_images, spec)
+    if images is not None:
+        return { "images_or_error": images }
+    
+    # the documents, the context and the chart cache are read from the disk, keep them off the event loop
+    agent_input, chart_key = await asyncio.to_thread(_code_agent_input, state)
+    cached = await asyncio.to_thread(chart_cache.get, chart_key)
+    if cached is not None:
+        return { "images_or_error": cached }
+    
+    result = await code_agent.ainvoke(agent_input, debug=_logger.getEffectiveLevel() < logging.WARNING)
+    
+    return { "images_or_error": await asyncio.to_thread(_cache_agent_images, _images_or_error(result), chart_key) }
 
    
     # Alternative solution for using quickchart.io.
@@ -5,34 +5,61 @@ load_dotenv()
 import argparse
 import logging
 import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import langchain;
 import langchain.globals
 from langgraph.graph import START, StateGraph
 from langgraph.errors import GraphRecursionError
+from langchain_core.messages import AIMessageChunk
 
 import state_schemas
+from config import metrics
+
+from typing import Any, Dict, Iterator, List, Tuple, Union
+from langchain_core.runnables import RunnableLambda
+from agents.supervisor import supervisor_node, asupervisor_node
+from agents.visualizer import visualizer_node, avisualizer_node
+from agents.retriever import retriever_node, aretriever_node
+from agents.analyst import analyst_node, aanalyst_node
 
-from typing import Dict, Union
-from agents.supervisor import supervisor_node
-from agents.visualizer import visualizer_node
-from agents.retriever import retriever_node
-from agents.analyst import analyst_node
+# How many files are extracted / embedded / written at the same time by process_directotry
+_CONST_DEFAULT_INGESTION_CONCURRENCY = 4
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 langchain.globals.set_verbose(logger.getEffectiveLevel() < logging.WARNING)
 
+# Every node has a sync and an async implementation: app.invoke / app.stream run the sync ones, app.ainvoke / app.astream the async ones.
 builder = StateGraph(state_schemas.ApplicationState)
-builder.add_node(supervisor_node)
-builder.add_node(retriever_node)
-builder.add_node(visualizer_node)
-builder.add_node(analyst_node)
+builder.add_node("supervisor_node", RunnableLambda(supervisor_node, afunc=asupervisor_node),
+                 destinations=("retriever_node", "analyst_node", "visualizer_node", "__end__"))
+builder.add_node("retriever_node", RunnableLambda(retriever_node, afunc=aretriever_node), destinations=("supervisor_node",))
+builder.add_node("visualizer_node", RunnableLambda(visualizer_node, afunc=avisualizer_node))
+builder.add_node("analyst_node", RunnableLambda(analyst_node, afunc=aanalyst_node), destinations=("supervisor_node",))
 
 builder.add_edge(START, "supervisor_node");
 
 app = builder.compile(debug=logger.getEffectiveLevel() < logging.WARNING);
 
+_CONST_GRAPH_CONFIG = {"recursion_limit": 30}
+
+def _graph_config(trace: metrics.QueryTrace) -> dict:
+    return {**_CONST_GRAPH_CONFIG, "callbacks": [metrics.MetricsCallbackHandler(trace)]}
+
+def _initial_state(query: str, initialState: Union[state_schemas.ApplicationState, None]) -> state_schemas.ApplicationState:
+    if initialState is None: 
+        return {
+                "messages": [("user", query)],
+                "documents": [],
+                "images_or_error": [],
+        }
+    
+    initialState["messages"].append(("user", query))
+    return initialState
+
 def query(query: str, initialState: state_schemas.ApplicationState = None ) -> Union[state_schemas.ApplicationState, GraphRecursionError]:
     """
     ask a question to ask our system.
@@ -42,18 +69,67 @@ def query(query: str, initialState: state_schemas.ApplicationState = None ) -> U
                                         For eaxmple we will pass a previous chat as initialState from the UI to continue with the user conversation.
     """
     
-    if initialState is None: 
-        initialState =  {
-                "messages": [("user", query)],
-                "documents": [],
-                "images_or_error": [],
-        }
-    else:
-        initialState["messages"].append(("user", query))
+    initialState = _initial_state(query, initialState)
+    try:
+        with metrics.trace_query(query) as trace:
+            state = app.invoke(initialState, config=_graph_config(trace), stream_mode="values")
+    except GraphRecursionError as e:
+        logger.error("Langgraph recursion error")
+        return e;
+    
+    return state
+
+def stream_query(query: str, initialState: state_schemas.ApplicationState = None) -> Iterator[Tuple[str, Any]]:
+    """
+    Same as query(), but yields the progress while the graph is running.
+    Args: 
+        query: str - that's the prompt
+        initiaState: ApplicationState - see query()
+    Yields: (event, payload) tuples
+        ("node", node name) - the node has finished its step
+        ("token", str) - piece of the analyst answer, as the llm generates it
+        ("trace", metrics.QueryTrace) - time, llm calls and tokens per node etc. of the query, right before the state / error
+        ("state", ApplicationState) - the final state, always the last event
+        ("error", GraphRecursionError) - instead of the final state, when the graph didn't finish
+    """
+    
+    initialState = _initial_state(query, initialState)
+    state = initialState
+    error = None
+    with metrics.trace_query(query) as trace:
+        try:
+            for mode, chunk in app.stream(initialState, config=_graph_config(trace), stream_mode=["updates", "messages", "values"]):
+                if mode == "values":
+                    state = chunk
+                elif mode == "updates":
+                    for node in chunk:
+                        yield "node", node
+                elif mode == "messages":
+                    message, metadata = chunk
+                    # only the llm tokens, not the whole message the node returns at the end
+                    if metadata.get("langgraph_node") == "analyst_node" and isinstance(message, AIMessageChunk) and message.content:
+                        yield "token", message.content
+        except GraphRecursionError as e:
+            logger.error("Langgraph recursion error")
+            error = e
+    
+    yield "trace", trace
+    if error is not None:
+        yield "error", error
+        return
+    
+    yield "state", state
+
+async def aquery(query: str, initialState: state_schemas.ApplicationState = None) -> Union[state_schemas.ApplicationState, GraphRecursionError]:
+    """
+    Async query(). Nodes, llm calls, vector search and file reads don't block the event loop,
+    so many queries can run concurrently in a single thread (see benchmarks/load_test.py).
+    """
     
-    config = {"recursion_limit": 30} 
+    initialState = _initial_state(query, initialState)
     try:
-        state = app.invoke(initialState, config=config, stream_mode="values")
+        with metrics.trace_query(query) as trace:
+            state = await app.ainvoke(initialState, config=_graph_config(trace), stream_mode="values")
     except GraphRecursionError as e:
         logger.error("Langgraph recursion error")
         return e;
@@ -76,41 +152,70 @@ def process_document(path: str):
     return result;
     
     
-def process_directotry(directory: str):
+def process_directotry(directory: str, concurrency: int = _CONST_DEFAULT_INGESTION_CONCURRENCY) -> Dict[str, Union[List[str], str]]:
     """
         Process and vectorize the whole directory. 
         File extensions or directory location is not checked. So please be carefull 
+        
+        Files are processed by a bounded pool of workers, so while one file waits for the llm extraction
+        others can already be embedded and written to the vector store.
+        The overview is updated only once, after all the files are processed.
+        
+        Args:
+            directory: path to the directory with the files
+            concurrency: how many files are processed at the same time
+
+        Returns:
+            file name -> insert result (list of inserted ids or an error string)
     """
     
-    from agents import document_processor
+    files = sorted(os.listdir(directory))
+    results: Dict[str, Union[List[str], str]] = {}
     
-    for file in os.listdir(directory):        
-        result = process_document(os.path.join(directory, file))
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {executor.submit(process_document, os.path.join(directory, file)): file for file in files}
         
-        # Yeah, we simply print this one. Enabling debugging would produce too much noise
-        print(f"File {file} inserted with result: {result}")
+        for future in as_completed(futures):
+            file = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = f"File insert error: {file} failed with an error: " + str(e)
+                
+            results[file] = result
+            
+            # Yeah, we simply print this one. Enabling debugging would produce too much noise
+            print(f"File {file} inserted with result: {result}")
         
     update_summary();
+    
+    return results
 
  
 
-def update_summary():
+def update_summary(rebuild: bool = False):
     """
     We maintain the overall short summary on what our vector state conains.
-    Call update_summary() when new docs are added.
+    Call update_summary() when new docs are added. Only the summaries of the new docs are sent to the llm,
+    rebuild=True builds the overview again from all the document summaries.
     """
     from agents import document_processor
     logger.info("Updating documents overview")
-    document_processor.update_overview()
+    document_processor.update_overview(rebuild)
 
     
 def main():
     parser = argparse.ArgumentParser(description='Insurance Data Analysis Pipeline')
     parser.add_argument('--insert-file', type=str, help='Path to data file for processing')
     parser.add_argument('--insert-directory', type=str, help='Path to directory with file for processing')
+    parser.add_argument('--concurrency', type=int, default=_CONST_DEFAULT_INGESTION_CONCURRENCY, help='How many files are processed in parallel with --insert-directory')
     parser.add_argument('--query', type=str, help='Analysis query to run')
     parser.add_argument('--debug', action='store_true', help='Enable debug logging')
-    parser.add_argument('--update-summary', action='store_true', help='Update database summary file')
+    parser.add_argument('--update-summary', action='store_true', help='Merge the summaries of the newly added documents into the database overview')
+    parser.add_argument('--rebuild-summary', action='store_true', help='Build the database overview again from all the document summaries')
+    parser.add_argument('--rebuild-manifest', action='store_true', help='Rebuild the content hash manifest of the file storage')
+    parser.add_argument('--rebuild-series-store', action='store_true', help='Extract the tables of the stored documents into the series store again and embed its new rows (run it after a series store schema upgrade)')
+    parser.add_argument('--rebuild-keyword-index', action='store_true', help='Fill the keyword (BM25) index again from the vector store. Chunks of the documents indexed before the deterministic vector ids (random uuids) are not recovered')
 
     args = parser.parse_args()
     
@@ -119,9 +224,28 @@ def main():
         langchain.globals.set_verbose(logger.getEffectiveLevel() < logging.WARNING)
 
     if args.query:
-        state = query(args.query)
-        for message in state["messages"]:
-            message.pretty_print();
+        streamed = False
+        for event, payload in stream_query(args.query):
+            if event == "node":
+                print(f"[{payload}]", file=sys.stderr, flush=True)
+            elif event == "token":
+                streamed = True
+                print(payload, end="", flush=True)
+            elif event == "error":
+                print(f"Query failed: {payload}", file=sys.stderr)
+            elif event == "trace":
+                print(f"\n{payload.summary()}", file=sys.stderr, flush=True)
+            elif event == "state":
+                # the graph ended without the analyst (nothing found, a clarifying question), its last message is the answer
+                if streamed:
+                    print()
+                else:
+                    print(payload["messages"][-1].content)
+                if logger.getEffectiveLevel() < logging.WARNING:
+                    for message in payload["messages"]:
+                        message.pretty_print();
+                if payload.get("images_or_error"):
+                    print(f"Visualization: {payload['images_or_error']}")
         return;
         
     if args.insert_file:
@@ -129,11 +253,26 @@ def main():
         return;
     
     if args.insert_directory:
-        process_directotry(args.insert_directory)
+        process_directotry(args.insert_directory, args.concurrency)
+        return;
+    
+    if args.update_summary or args.rebuild_summary:
+        update_summary(args.rebuild_summary)
+        return;
+    
+    if args.rebuild_manifest:
+        from agents import document_processor
+        document_processor.rebuild_manifest()
+        return;
+    
+    if args.rebuild_series_store:
+        from agents import document_processor
+        print(f"{document_processor.rebuild_series_store()} new or revised series rows indexed")
         return;
     
-    if args.update_summary:
-        update_summary()
+    if args.rebuild_keyword_index:
+        from agents import document_processor
+        print(f"{document_processor.rebuild_keyword_index()} chunks saved to the keyword index")
         return;
         
 if __name__ == "__main__":
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Load test of the query path: how throughput and latency change with the number of concurrent queries.
+
+Runs the real graph (llm, embeddings and the vector store from .env), so it costs api calls.
+The async path (app.aquery) runs all the queries of a level on a single event loop,
+the sync path (app.query) runs them in a thread pool, for comparison.
+
+Usage (from the repository root):
+    python src/benchmarks/load_test.py --concurrency 1 2 4 8 --queries-per-level 8
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Union
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from config.db import query_embeddings_cache, search_results_cache
+
+_CONST_DEFAULT_QUERIES = [
+    "What was the average expenditure for auto insurance in 2010?",
+    "How did the number of insured vehicles change over the years?",
+    "Which states had the highest average auto insurance premiums?",
+    "What are the loss ratios for private passenger auto insurance?",
+]
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))]
+
+
+def _report(mode: str, concurrency: int, latencies: List[float], errors: int, elapsed: float) -> Dict[str, Union[str, int, float]]:
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "queries": len(latencies) + errors,
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "throughput_qps": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        "latency_p50": round(statistics.median(latencies), 2) if latencies else None,
+        "latency_p95": round(_percentile(latencies, 95), 2) if latencies else None,
+    }
+
+
+async def _run_async(queries: List[str], concurrency: int) -> Dict[str, Union[str, int, float]]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def run_one(query: str):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                state = await app.aquery(query)
+                if isinstance(state, Exception):
+                    raise state
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors += 1
+                print(f"Query '{query}' failed: {e!r}", file=sys.stderr)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[run_one(query) for query in queries])
+
+    return _report("async", concurrency, latencies, errors, time.perf_counter() - started)
+
+
+def _run_sync(queries: List[str], concurrency: int) -> Dict[str, Union[str, int, float]]:
+    latencies = []
+    errors = 0
+
+    def run_one(query: str) -> float:
+        started = time.perf_counter()
+        state = app.query(query)
+        if isinstance(state, Exception):
+            raise state
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for query, future in [(query, executor.submit(run_one, query)) for query in queries]:
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                errors += 1
+                print(f"Query '{query}' failed: {e!r}", file=sys.stderr)
+
+    return _report("sync", concurrency, latencies, errors, time.perf_counter() - started)
+
+
+def _clear_caches():
+    """every level starts cold, otherwise the later levels would be served from the query caches"""
+    query_embeddings_cache.clear()
+    search_results_cache.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query path load test')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8], help='Concurrency levels to measure')
+    parser.add_argument('--queries-per-level', type=int, default=8, help='How many queries are run at each level')
+    parser.add_argument('--query', type=str, action='append', help='Question to ask (repeatable). Defaults to a few sample questions')
+    parser.add_argument('--mode', choices=['async', 'sync', 'both'], default='async', help='app.aquery, app.query in threads or both')
+    parser.add_argument('--json', action='store_true', help='Print the results as json')
+
+    args = parser.parse_args()
+
+    questions = args.query or _CONST_DEFAULT_QUERIES
+    queries = [questions[index % len(questions)] for index in range(args.queries_per_level)]
+    modes = ['async', 'sync'] if args.mode == 'both' else [args.mode]
+
+    results = []
+
+    def collect(result: Dict[str, Union[str, int, float]]):
+        results.append(result)
+        if not args.json:
+            print(" ".join(f"{key}={value}" for key, value in result.items()), flush=True)
+
+    async def run_async_levels():
+        # a single event loop for all the levels - async db connections are bound to the loop that created them
+        for concurrency in args.concurrency:
+            _clear_caches()
+            collect(await _run_async(queries, concurrency))
+
+    if 'async' in modes:
+        asyncio.run(run_async_levels())
+
+    if 'sync' in modes:
+        for concurrency in args.concurrency:
+            _clear_caches()
+            collect(_run_sync(queries, concurrency))
+
+    if args.json:
+        print(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Deterministic stand-ins for the external services, so the pipeline can be measured without api keys or network:
+
+    FakeChatModel - answers without an llm: calls the tools the agents give it, fills the structured outputs from their schema
+                    and writes a fixed length answer. Every call sleeps for a configurable latency.
+    HashingEmbeddings - bag of words feature hashing, similar texts still get similar vectors
+    install() - puts config.models and config.db modules built from them (and an in-memory or the given vector store) into sys.modules.
+                Has to be called before anything from the app is imported.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import re
+import sys
+import time
+import types
+import uuid
+
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain_core.vectorstores import InMemoryVectorStore, VectorStore
+
+_CONST_WORD_PATTERN = re.compile(r"\w+")
+
+# Preferred values for the enum fields of the structured outputs, the supervisor finishes instead of looping
+_CONST_PREFERRED_ENUM_VALUES = ("__end__", "FINISH", "line")
+
+
+class FakeChatModel(BaseChatModel):
+    latency_seconds: float = 0.0
+    """how long every call takes, on top of the output tokens"""
+    seconds_per_output_token: float = 0.0
+    output_tokens: int = 60
+    """length of the text answers, in words"""
+    preferred_tool: Optional[str] = "_data_retrieval"
+    """tool the agents call first, when they have several"""
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def bind_tools(self, tools: Sequence[Any], *, tool_choice: Optional[str] = None, **kwargs: Any):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], tool_choice=tool_choice, **kwargs)
+
+    def _latency(self, message: AIMessage) -> float:
+        return self.latency_seconds + self.seconds_per_output_token * len(str(message.content).split())
+
+    def _respond(self, messages: List[BaseMessage], tools: Optional[List[dict]] = None, tool_choice: Optional[str] = None, **_: Any) -> AIMessage:
+        question = next((str(message.content) for message in reversed(messages) if isinstance(message, HumanMessage)), "")
+
+        if tools:
+            turn = messages[max(index for index, message in enumerate(messages) if isinstance(message, HumanMessage)):] \
+                if any(isinstance(message, HumanMessage) for message in messages) else messages
+            # structured output (tool_choice is set) or an agent that didn't call any tool yet
+            if tool_choice or not any(isinstance(message, ToolMessage) for message in turn):
+                tool = next((tool for tool in tools if tool["function"]["name"] == self.preferred_tool), tools[0])["function"]
+                arguments = _fill(tool.get("parameters", {}), question)
+                return AIMessage(content="", tool_calls=[{"name": tool["name"], "args": arguments, "id": f"call_{uuid.uuid4().hex[:12]}"}])
+
+        context_words = sum(len(str(message.content).split()) for message in messages)
+        words = [f"Answer to '{question[:60]}' based on {context_words} words of context."]
+        words += [f"word{index}" for index in range(max(0, self.output_tokens - len(words[0].split())))]
+        return AIMessage(content=" ".join(words))
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        message = self._respond(messages, **kwargs)
+        time.sleep(self._latency(message))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        message = self._respond(messages, **kwargs)
+        await asyncio.sleep(self._latency(message))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        message = self._respond(messages, **kwargs)
+        if message.tool_calls:
+            time.sleep(self._latency(message))
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": 0} for call in message.tool_calls
+            ]))
+            return
+
+        time.sleep(self.latency_seconds)
+        for word in str(message.content).split(" "):
+            time.sleep(self.seconds_per_output_token)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+def _fill(schema: Dict[str, Any], question: str) -> Any:
+    """Value for a json schema: the question for the strings, the preferred value of the enums, nulls where allowed"""
+
+    options = schema.get("anyOf") or schema.get("oneOf")
+    if options:
+        if any(option.get("type") == "null" for option in options):
+            return None
+        return _fill(options[0], question)
+
+    if "enum" in schema:
+        return next((value for value in _CONST_PREFERRED_ENUM_VALUES if value in schema["enum"]), schema["enum"][0])
+
+    kind = schema.get("type")
+    if kind == "object" or "properties" in schema:
+        return {name: _fill(property_schema, question) for name, property_schema in schema.get("properties", {}).items()}
+    if kind == "array":
+        return []
+    if kind in ("integer", "number"):
+        return 0
+    if kind == "boolean":
+        return False
+
+    return question
+
+
+class HashingEmbeddings(Embeddings):
+    """Words hashed into a fixed size vector and normalized. Cheap, deterministic and texts sharing words are close."""
+
+    def __init__(self, size: int = 256, latency_seconds: float = 0.0):
+        self.size = size
+        self.latency_seconds = latency_seconds
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.size
+        for word in _CONST_WORD_PATTERN.findall(text.lower()):
+            bucket = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=4).digest(), "little")
+            vector[bucket % self.size] += 1.0 if bucket & 0x80000000 else -1.0
+
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency_seconds)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency_seconds)
+        return self._embed(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency_seconds)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        await asyncio.sleep(self.latency_seconds)
+        return self._embed(text)
+
+
+def install(llm: BaseChatModel, embeddings: Embeddings, vector_store: Optional[VectorStore] = None) -> types.ModuleType:
+    """Replaces config.models and config.db with the fakes. Returns the fake config.db module.
+    The query caches are the real ones (config.cache), so the numbers include them.
+    """
+    from config.cache import TTLCache
+
+    if "config.db" in sys.modules or "config.models" in sys.modules:
+        raise RuntimeError("install() has to be called before the app modules are imported")
+
+    models = types.ModuleType("config.models")
+    models.llm = llm
+
+    db = types.ModuleType("config.db")
+    db.embeddings = embeddings
+    # a single store serves both the sync and the async path
+    db.vector_store = db.async_vector_store = vector_store if vector_store is not None else InMemoryVectorStore(embeddings)
+    db.query_embeddings_cache = TTLCache(1024, 3600)
+    db.search_results_cache = TTLCache(1024, 3600)
+    db.cache_stats = lambda: {
+        "query_embeddings": db.query_embeddings_cache.stats(),
+        "search_results": db.search_results_cache.stats(),
+    }
+
+    sys.modules["config.models"] = models
+    sys.modules["config.db"] = db
+    return db
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the ingestion and the query path - no api keys, no network, no Postgres.
+
+The llm, the embeddings and the vector store are replaced by the deterministic fakes (see fakes.py, --vector-backend numpy uses the local index instead)
+with a configurable latency, everything else (table extraction, series store, document store, context building, the graph) is the real code.
+
+For every corpus scale (1x, 10x, 100x copies of data/downloaded_files, the copies get their own series titles so they aren't deduplicated)
+a fresh process in an empty working directory:
+    - inserts the corpus with app.process_directotry -> files/s, MB/s, documents embedded
+    - runs the sample questions with app.query -> per query and per node latency, prompt sizes (tokens) per node
+    - reports its peak memory (max rss)
+
+Usage (from the repository root):
+    python src/benchmarks/offline/run.py --scales 1 10 100 --llm-latency 0.05 --output offline_report.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Any, Dict, List, Union
+from uuid import UUID
+
+_CONST_SRC_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, _CONST_SRC_DIR)
+
+from benchmarks.offline import fakes
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+_CONST_CORPUS_DIR = os.path.join(os.path.dirname(_CONST_SRC_DIR), "data", "downloaded_files")
+
+_CONST_DEFAULT_QUERIES = [
+    "What was the average expenditure for auto insurance in 2010?",
+    "How did the number of insured vehicles change over the years?",
+    "Which states had the highest average auto insurance premiums?",
+    "What are the loss ratios for private passenger auto insurance?",
+]
+
+_CONST_NODES = ("supervisor_node", "retriever_node", "analyst_node", "visualizer_node")
+
+# the first cell of the html table is the title of the series
+_CONST_TITLE_PATTERN = re.compile(r"(<tr><td>)([^<]+)(</td></tr>)")
+
+
+class _NodeMetrics(BaseCallbackHandler):
+    """Collects the duration of every graph node run and the prompt size of every llm call, by node"""
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = {}
+        self.prompt_tokens: Dict[str, List[int]] = {}
+        self._started: Dict[UUID, tuple] = {}
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Any, *, run_id: UUID, parent_run_id: Union[UUID, None] = None,
+                       metadata: Union[Dict[str, Any], None] = None, name: Union[str, None] = None, **kwargs: Any):
+        # the node itself, not the runnables inside it (they share the langgraph_node metadata and the node function has the same name)
+        node = (metadata or {}).get("langgraph_node")
+        if node in _CONST_NODES and name == node and parent_run_id not in self._started:
+            self._started[run_id] = (node, time.perf_counter())
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            self.durations.setdefault(started[0], []).append(time.perf_counter() - started[1])
+
+    on_chain_error = on_chain_end
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID,
+                            metadata: Union[Dict[str, Any], None] = None, **kwargs: Any):
+        from agents.context_builder import count_tokens
+
+        # the top level node, also for the llm calls of the agents inside the nodes ("retriever_node:<id>|agent:<id>")
+        node = (metadata or {}).get("langgraph_checkpoint_ns", "").split(":")[0] or (metadata or {}).get("langgraph_node", "other")
+        for prompt in messages:
+            self.prompt_tokens.setdefault(node, []).append(sum(count_tokens(str(message.content)) for message in prompt))
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))]
+
+
+def _latency_stats(values: List[float]) -> Dict[str, Union[int, float]]:
+    return {
+        "count": len(values),
+        "mean": round(statistics.fmean(values), 4),
+        "p50": round(statistics.median(values), 4),
+        "p95": round(_percentile(values, 95), 4),
+        "max": round(max(values), 4),
+    }
+
+
+def _build_corpus(target: str, scale: int) -> Dict[str, Union[int, float]]:
+    """scale copies of the corpus. The copy number is put into the series title and the file name."""
+
+    os.makedirs(target)
+    files = 0
+    size = 0
+    for name in sorted(os.listdir(_CONST_CORPUS_DIR)):
+        with open(os.path.join(_CONST_CORPUS_DIR, name), encoding="utf-8") as f:
+            contents = f.read()
+
+        stem, extension = os.path.splitext(name)
+        for copy in range(scale):
+            copy_contents = contents if copy == 0 else _CONST_TITLE_PATTERN.sub(rf"\g<1>Copy {copy} \g<2>\g<3>", contents, count=1)
+            with open(os.path.join(target, f"{stem} copy {copy}{extension}" if copy else name), "w", encoding="utf-8") as f:
+                f.write(copy_contents)
+            files += 1
+            size += len(copy_contents.encode("utf-8"))
+
+    return {"files": files, "megabytes": round(size / 1024 / 1024, 3)}
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / 1024 / (1024 if platform.system() == "Darwin" else 1), 1)
+
+
+def _run_scale(args: argparse.Namespace) -> Dict[str, Any]:
+    """One scale, in the current process. The working directory must be empty, the app keeps its data relative to it."""
+
+    embeddings = fakes.HashingEmbeddings(latency_seconds=args.embedding_latency)
+    vector_store = None
+    if args.vector_backend == "numpy":
+        from config.numpy_vector_store import NumpyVectorStore
+        vector_store = NumpyVectorStore(embeddings, "vector_store")
+
+    db = fakes.install(
+        fakes.FakeChatModel(latency_seconds=args.llm_latency, seconds_per_output_token=args.llm_token_latency),
+        embeddings,
+        vector_store,
+    )
+
+    import app
+    from agents import document_processor
+
+    os.makedirs(document_processor.DOCUMENT_STORAGE_PATH, exist_ok=True)
+    report: Dict[str, Any] = {"scale": args.scale}
+
+    corpus = _build_corpus("corpus", args.scale)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stderr if args.verbose else devnull):
+        started = time.perf_counter()
+        results = app.process_directotry("corpus", args.concurrency)
+        elapsed = time.perf_counter() - started
+
+    inserted = [result for result in results.values() if isinstance(result, list)]
+    report["ingestion"] = {
+        **corpus,
+        "seconds": round(elapsed, 3),
+        "files_per_second": round(corpus["files"] / elapsed, 2),
+        "megabytes_per_second": round(corpus["megabytes"] / elapsed, 3),
+        "errors": len(results) - len(inserted),
+        "documents_embedded": sum(len(result) for result in inserted),
+        "vector_store_documents": len(db.vector_store) if vector_store is not None else len(db.vector_store.store),
+    }
+
+    metrics = _NodeMetrics()
+    questions = args.query or _CONST_DEFAULT_QUERIES
+    latencies = []
+    errors = 0
+    for index in range(args.queries):
+        db.search_results_cache.clear()
+        db.query_embeddings_cache.clear()
+        started = time.perf_counter()
+        try:
+            app.app.invoke(app._initial_state(questions[index % len(questions)], None),
+                           config={**app._CONST_GRAPH_CONFIG, "callbacks": [metrics]}, stream_mode="values")
+            latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            errors += 1
+            print(f"Query failed: {e!r}", file=sys.stderr)
+
+    report["queries"] = {
+        "count": args.queries,
+        "errors": errors,
+        "latency_seconds": _latency_stats(latencies) if latencies else None,
+        "node_latency_seconds": {node: _latency_stats(values) for node, values in sorted(metrics.durations.items())},
+        "prompt_tokens": {node: {"count": len(values), "mean": round(statistics.fmean(values)), "max": max(values)}
+                          for node, values in sorted(metrics.prompt_tokens.items())},
+    }
+    report["peak_rss_mb"] = _peak_rss_mb()
+    return report
+
+
+def _scale_in_subprocess(args: argparse.Namespace, scale: int) -> Dict[str, Any]:
+    """Every scale gets a fresh process (clean module state, own peak memory) and a fresh working directory"""
+
+    workdir = tempfile.mkdtemp(prefix=f"offline_bench_{scale}x_")
+    try:
+        command = [sys.executable, os.path.abspath(__file__), "--single-scale", str(scale),
+                   "--queries", str(args.queries), "--concurrency", str(args.concurrency),
+                   "--llm-latency", str(args.llm_latency), "--llm-token-latency", str(args.llm_token_latency),
+                   "--embedding-latency", str(args.embedding_latency), "--vector-backend", args.vector_backend]
+        for question in args.query or []:
+            command += ["--query", question]
+        if args.verbose:
+            command.append("--verbose")
+
+        output = subprocess.run(command, cwd=workdir, stdout=subprocess.PIPE, check=True).stdout
+        return json.loads(output)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark with fake llm, embeddings and vector store')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help='Corpus sizes, in copies of data/downloaded_files')
+    parser.add_argument('--queries', type=int, default=8, help='How many queries are run at each scale')
+    parser.add_argument('--query', type=str, action='append', help='Question to ask (repeatable). Defaults to a few sample questions')
+    parser.add_argument('--concurrency', type=int, default=4, help='Ingestion concurrency (see app.process_directotry)')
+    parser.add_argument('--llm-latency', type=float, default=0.0, help='Seconds every fake llm call takes')
+    parser.add_argument('--llm-token-latency', type=float, default=0.0, help='Additional seconds per generated word')
+    parser.add_argument('--embedding-latency', type=float, default=0.0, help='Seconds every fake embeddings call takes')
+    parser.add_argument('--vector-backend', choices=['memory', 'numpy'], default='memory',
+                        help='In-memory langchain store or the local numpy index (config/numpy_vector_store.py)')
+    parser.add_argument('--output', type=str, help='Write the json report to this file instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='Show the app output')
+    parser.add_argument('--single-scale', type=int, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.single_scale is not None:
+        args.scale = args.single_scale
+        report = _run_scale(args)
+        # the report is the only thing on stdout, the parent reads it
+        print(json.dumps(report))
+        return
+
+    reports = []
+    for scale in args.scales:
+        print(f"Running {scale}x ...", file=sys.stderr, flush=True)
+        report = _scale_in_subprocess(args, scale)
+        ingestion = report["ingestion"]
+        print(f"{scale}x: {ingestion['files']} files in {ingestion['seconds']}s ({ingestion['files_per_second']} files/s), "
+              f"query p50 {(report['queries']['latency_seconds'] or {}).get('p50')}s, peak rss {report['peak_rss_mb']} MB",
+              file=sys.stderr, flush=True)
+        reports.append(report)
+
+    result = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "settings": {
+            "queries": args.queries,
+            "concurrency": args.concurrency,
+            "llm_latency": args.llm_latency,
+            "llm_token_latency": args.llm_token_latency,
+            "embedding_latency": args.embedding_latency,
+            "vector_backend": args.vector_backend,
+        },
+        "scales": reports,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=1)
+    else:
+        print(json.dumps(result, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Small in-process LRU cache with time to live and hit/miss counters.
+A cache whose entries go stale when another process changes the data (e.g. the ingestion workers) can share
+a generation counter through a SQLite file, clearing it in one process clears it in all of them.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import closing
+from typing import Any, Dict, Hashable, Union
+
+
+class SharedGeneration:
+    """Named generation counter in a SQLite file, bumped whenever a process clears the cache"""
+
+    def __init__(self, path: str, name: str):
+        self.path = path
+        self.name = name
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS cache_generations (name TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self) -> int:
+        with closing(self._connect()) as connection:
+            row = connection.execute("SELECT generation FROM cache_generations WHERE name = ?", (self.name,)).fetchone()
+            return row[0] if row else 0
+
+    def bump(self) -> int:
+        with closing(self._connect()) as connection, connection:
+            connection.execute("""
+                INSERT INTO cache_generations VALUES (?, 1)
+                ON CONFLICT (name) DO UPDATE SET generation = generation + 1""", (self.name,))
+            return connection.execute("SELECT generation FROM cache_generations WHERE name = ?", (self.name,)).fetchone()[0]
+
+
+class TTLCache:
+    def __init__(self, max_size: int, ttl_seconds: Union[float, None] = None, shared_generation: Union[SharedGeneration, None] = None):
+        """
+        Args:
+            max_size: least recently used entries are dropped above this size
+            ttl_seconds: entries older than this are treated as missing. None - never expire
+            shared_generation: clear() is propagated to the other processes through it, checked on every get()
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._shared_generation = shared_generation
+        self._seen_shared_generation = shared_generation.get() if shared_generation is not None else None
+
+    def _sync(self):
+        """Drops the entries if another process cleared the cache since we last looked"""
+        if self._shared_generation is None:
+            return
+
+        shared = self._shared_generation.get()
+        with self._lock:
+            if shared != self._seen_shared_generation:
+                self._entries.clear()
+                self.generation += 1
+                self._seen_shared_generation = shared
+
+    def get(self, key: Hashable) -> Union[Any, None]:
+        self._sync()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl_seconds is not None and time.monotonic() - entry[0] > self.ttl_seconds):
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, generation: Union[int, None] = None):
+        """
+        Args:
+            generation: value of self.generation when the value was computed.
+                        If the cache was cleared in the meantime, the (stale) value is not saved.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        shared = self._shared_generation.bump() if self._shared_generation is not None else None
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+            self._seen_shared_generation = shared
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "size": len(self._entries),
+            }
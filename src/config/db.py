@@ -1,20 +1,226 @@
 import os
+import sqlite3
+import hashlib
+import time
+
+from array import array
+from contextlib import closing
+from typing import Dict, List, Union
+
+from langchain_core.embeddings import Embeddings
 # from langchain_openai import OpenAIEmbeddings
-from langchain_postgres import PGVector
 from langchain_voyageai import VoyageAIEmbeddings
 
+from config.cache import SharedGeneration, TTLCache
+from config import metrics
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# "pgvector" (Postgres, NEON_KEY) or "numpy" (local memory-mapped index in VECTOR_STORE_PATH, see config/numpy_vector_store.py)
+_CONST_VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pgvector").lower()
+_CONST_VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", "data/vector_store")
+
+if _CONST_VECTOR_BACKEND not in ("pgvector", "numpy"):
+    raise ValueError(f"Unknown VECTOR_BACKEND {_CONST_VECTOR_BACKEND!r}, expected pgvector or numpy")
+
 connection_string = os.getenv("NEON_KEY")
-if not connection_string:
+if _CONST_VECTOR_BACKEND == "pgvector" and not connection_string:
     raise ValueError("NEON_CONNECTION_STRING environment variable is required")
 
-embeddings = VoyageAIEmbeddings(model="voyage-3-large")
-# or OpenAIEmbeddings(...)
+# Connection pool of the PGVector engines (one sync, one async per process). Use the direct endpoint, not a pgbouncer one,
+# the search settings below are set once per connection.
+_CONST_POOL_SIZE = int(os.getenv("PGVECTOR_POOL_SIZE", "5"))
+_CONST_POOL_MAX_OVERFLOW = int(os.getenv("PGVECTOR_POOL_MAX_OVERFLOW", "5"))
+_CONST_POOL_TIMEOUT_SECONDS = float(os.getenv("PGVECTOR_POOL_TIMEOUT_SECONDS", "30"))
+# Neon closes idle connections, older ones are replaced before they are handed out
+_CONST_POOL_RECYCLE_SECONDS = int(os.getenv("PGVECTOR_POOL_RECYCLE_SECONDS", "1800"))
+
+# Search time settings of the ANN indexes (see vector_indexes.py): candidates kept while walking the HNSW graph
+# (has to be >= k, higher - better recall, slower) and IVFFlat lists scanned per query
+_CONST_HNSW_EF_SEARCH = int(os.getenv("PGVECTOR_HNSW_EF_SEARCH", "100"))
+_CONST_IVFFLAT_PROBES = int(os.getenv("PGVECTOR_IVFFLAT_PROBES", "10"))
+
+_CONST_EMBEDDING_CACHE_FILE = "data/embeddings_cache.sqlite"
+
+# Least recently used embeddings are evicted when the cache grows over this size
+_CONST_EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "256")) * 1024 * 1024
+
+# In-process caches for the query side: the retriever agent repeats the same searches within a run
+# and the UI users keep asking the same questions.
+_CONST_QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+_CONST_QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "3600"))
+
+# query text -> embedding. Doesn't depend on the stored documents, so it's never invalidated.
+query_embeddings_cache = TTLCache(_CONST_QUERY_CACHE_SIZE, _CONST_QUERY_CACHE_TTL_SECONDS)
+
+# (normalized query, k) -> similarity search results. Cleared whenever documents are added to the vector store,
+# also by the ingestion worker processes: the generation is shared through the embeddings cache file.
+search_results_cache = TTLCache(_CONST_QUERY_CACHE_SIZE, _CONST_QUERY_CACHE_TTL_SECONDS,
+                                shared_generation=SharedGeneration(_CONST_EMBEDDING_CACHE_FILE, "search_results"))
+
+metrics.register_cache("query_embeddings", query_embeddings_cache.stats)
+metrics.register_cache("search_results", search_results_cache.stats)
+
+
+class CachedEmbeddings(Embeddings):
+    """Persistent cache in front of the embeddings model, keyed by (model name, sha256 of the text).
+    Re-uploaded files, re-indexing and repeated texts (e.g. source notes) don't hit the embeddings api again.
+    Queries are embedded differently by some models (voyage input_type="query"), so they are kept only in the in-process query_embeddings_cache.
+    """
+
+    def __init__(self, embeddings: Embeddings, model: str, path: str = _CONST_EMBEDDING_CACHE_FILE, max_bytes: int = _CONST_EMBEDDING_CACHE_MAX_BYTES):
+        self.embeddings = embeddings
+        self.model = model
+        self.path = path
+        self.max_bytes = max_bytes
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, text_hash)
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+        now = time.time()
+
+        with closing(self._connect()) as connection:
+            cached = {}
+            unique_hashes = list(dict.fromkeys(hashes))
+            for start in range(0, len(unique_hashes), 500):
+                batch = unique_hashes[start:start + 500]
+                rows = connection.execute(f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                                          [self.model] + batch)
+                cached.update({text_hash: array("f", vector).tolist() for text_hash, vector in rows})
+
+            missing = {text_hash: text for text_hash, text in zip(hashes, texts) if text_hash not in cached}
+            _logger.debug(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+
+            if missing:
+                started = time.perf_counter()
+                vectors = self.embeddings.embed_documents(list(missing.values()))
+                metrics.record_embedding("documents", len(missing), time.perf_counter() - started)
+                cached.update(zip(missing.keys(), vectors))
+
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                                       [(self.model, text_hash, array("f", cached[text_hash]).tobytes(), now) for text_hash in unique_hashes])
+                if missing:
+                    self._evict(connection)
+
+        return [cached[text_hash] for text_hash in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = (self.model, text)
+        vector = query_embeddings_cache.get(key)
+        if vector is None:
+            started = time.perf_counter()
+            vector = self.embeddings.embed_query(text)
+            metrics.record_embedding("query", 1, time.perf_counter() - started)
+            query_embeddings_cache.set(key, vector)
+
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = (self.model, text)
+        vector = query_embeddings_cache.get(key)
+        if vector is None:
+            started = time.perf_counter()
+            vector = await self.embeddings.aembed_query(text)
+            metrics.record_embedding("query", 1, time.perf_counter() - started)
+            query_embeddings_cache.set(key, vector)
+
+        return vector
+
+    def _evict(self, connection: sqlite3.Connection):
+        size = connection.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        if size <= self.max_bytes:
+            return
+
+        # drop the least recently used ones down to 90% of the limit, so we don't evict on every insert
+        to_free = size - int(self.max_bytes * 0.9)
+        freed = 0
+        expired = []
+        for model, text_hash, length in connection.execute("SELECT model, text_hash, LENGTH(vector) FROM embeddings ORDER BY last_used"):
+            if freed >= to_free:
+                break
+            expired.append((model, text_hash))
+            freed += length
+
+        connection.executemany("DELETE FROM embeddings WHERE model = ? AND text_hash = ?", expired)
+        _logger.info(f"Embedding cache: evicted {len(expired)} embeddings ({freed} bytes)")
+
+
+_embeddings_model = "voyage-3-large"
+
+embeddings = CachedEmbeddings(VoyageAIEmbeddings(model=_embeddings_model), model=_embeddings_model)
+# or CachedEmbeddings(OpenAIEmbeddings(...), model=...)
 
 collection_name = "auto_insurance"
 
-vector_store = PGVector(
-    embeddings= embeddings,
-    collection_name=collection_name,
-    connection=connection_string,
-    use_jsonb=True,
-)
\ No newline at end of file
+if _CONST_VECTOR_BACKEND == "numpy":
+    from config.numpy_vector_store import NumpyVectorStore
+
+    # one store serves both the sync and the async path, the search itself runs in a thread
+    vector_store = async_vector_store = NumpyVectorStore(embeddings, os.path.join(_CONST_VECTOR_STORE_PATH, collection_name))
+else:
+    from langchain_postgres import PGVector
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    _engine_args = dict(
+        pool_size=_CONST_POOL_SIZE,
+        max_overflow=_CONST_POOL_MAX_OVERFLOW,
+        pool_timeout=_CONST_POOL_TIMEOUT_SECONDS,
+        pool_recycle=_CONST_POOL_RECYCLE_SECONDS,
+        pool_pre_ping=True,
+    )
+
+    def _set_search_parameters(dbapi_connection, connection_record):
+        """Every new pooled connection gets the ANN search settings. They're plain settings, valid even before an index exists."""
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"SET hnsw.ef_search = {_CONST_HNSW_EF_SEARCH}")
+        cursor.execute(f"SET ivfflat.probes = {_CONST_IVFFLAT_PROBES}")
+        cursor.close()
+        dbapi_connection.commit()
+
+    engine = create_engine(connection_string, **_engine_args)
+    event.listen(engine, "connect", _set_search_parameters)
+
+    # Same collection for the async query path (app.aquery). psycopg3 ("postgresql+psycopg://") handles both modes.
+    # Connections are created lazily on the first call and are bound to the event loop that made them.
+    async_engine = create_async_engine(connection_string, **_engine_args)
+    event.listen(async_engine.sync_engine, "connect", _set_search_parameters)
+
+    vector_store = PGVector(
+        embeddings= embeddings,
+        collection_name=collection_name,
+        connection=engine,
+        use_jsonb=True,
+    )
+
+    async_vector_store = PGVector(
+        embeddings= embeddings,
+        collection_name=collection_name,
+        connection=async_engine,
+        use_jsonb=True,
+    )
+
+
+def cache_stats() -> Dict[str, Dict[str, Union[int, float]]]:
+    """hit/miss counters of the query side caches"""
+    return {
+        "query_embeddings": query_embeddings_cache.stats(),
+        "search_results": search_results_cache.stats(),
+    }
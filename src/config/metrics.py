@@ -0,0 +1,399 @@
+"""
+Per query tracing and process wide metrics of the pipeline.
+
+trace_query() wraps a graph run. While it runs, the MetricsCallbackHandler (pass it in the graph config callbacks) and
+the record_* helpers (called by the embeddings and the vector search) collect into the QueryTrace of the current query:
+    - wall time and runs per graph node and per tool call
+    - llm calls, prompt and completion tokens per node (from the usage metadata, estimated when the model doesn't report it)
+    - embedding calls and vector search latency
+Everything is also added to the process wide registry, rendered in the Prometheus text format (render_prometheus, serve).
+The cache hit rates come from the stats() of the caches registered with register_cache, a trace holds the hits and misses of its query only.
+
+Finished traces are appended to METRICS_JSONL_PATH (one json object per query), when it's set. Disabled by default.
+Once the file grows over METRICS_JSONL_MAX_MB it's moved to <path>.1 (replacing the previous one) and a new one is started.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+METRICS_JSONL_PATH = os.getenv("METRICS_JSONL_PATH", "")
+
+_CONST_JSONL_MAX_BYTES = float(os.getenv("METRICS_JSONL_MAX_MB", "64")) * 1024 * 1024
+
+_CONST_NODES = ("supervisor_node", "retriever_node", "analyst_node", "visualizer_node")
+
+_CONST_PREFIX = "iii_"
+
+_CONST_HELP = {
+    "queries_total": "Queries run through the graph",
+    "query_seconds": "Wall time of the whole query",
+    "node_seconds": "Wall time of a graph node run",
+    "tool_seconds": "Wall time of a tool call",
+    "llm_calls_total": "Chat model calls",
+    "llm_prompt_tokens_total": "Prompt tokens sent to the chat model",
+    "llm_completion_tokens_total": "Completion tokens generated by the chat model",
+    "embedding_seconds": "Embedding api calls (cache misses only)",
+    "embedding_texts_total": "Texts sent to the embedding api",
+    "vector_search_seconds": "Vector store similarity searches (cache misses only)",
+    "keyword_search_seconds": "Keyword index (BM25) searches (cache misses only)",
+}
+
+
+class _Registry:
+    """Counters and summaries (count + sum) keyed by name and labels"""
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self.summaries: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1.0, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self.summaries.setdefault(key, [0, 0.0])
+            summary[0] += 1
+            summary[1] += value
+
+
+registry = _Registry()
+
+# cache name -> stats() of the cache, with hits, misses and hit_rate
+_caches: Dict[str, Callable[[], Dict[str, Union[int, float]]]] = {}
+
+
+def register_cache(name: str, stats: Callable[[], Dict[str, Union[int, float]]]):
+    _caches[name] = stats
+
+
+def cache_stats() -> Dict[str, Dict[str, Union[int, float]]]:
+    return {name: stats() for name, stats in _caches.items()}
+
+
+def _cache_delta(before: Dict[str, Dict[str, Union[int, float]]], after: Dict[str, Dict[str, Union[int, float]]]) -> Dict[str, Dict[str, Union[int, float]]]:
+    """Hits and misses between the two cache_stats() snapshots (the counters are cumulative for the process), the size is the one at the end.
+    The lookups of the queries running at the same time in this process are counted too."""
+
+    delta = {}
+    for name, stats in after.items():
+        start = before.get(name, {})
+        hits = stats.get("hits", 0) - start.get("hits", 0)
+        misses = stats.get("misses", 0) - start.get("misses", 0)
+        delta[name] = {**stats, "hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+
+    return delta
+
+
+class QueryTrace:
+    def __init__(self, query: str):
+        self.query = query
+        self.started = time.time()
+        self.seconds = 0.0
+        # name -> {"runs", "seconds"}
+        self.nodes: Dict[str, Dict[str, float]] = {}
+        self.tools: Dict[str, Dict[str, float]] = {}
+        # node -> {"calls", "prompt_tokens", "completion_tokens"}
+        self.llm: Dict[str, Dict[str, int]] = {}
+        self.embeddings = {"calls": 0, "texts": 0, "seconds": 0.0}
+        self.vector_search = {"calls": 0, "seconds": 0.0}
+        self.keyword_search = {"calls": 0, "seconds": 0.0}
+        self.caches: Dict[str, Dict[str, Union[int, float]]] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, group: Dict[str, Dict[str, float]], name: str, **values: float):
+        with self._lock:
+            entry = group.setdefault(name, {key: 0 for key in values})
+            for key, value in values.items():
+                entry[key] = entry.get(key, 0) + value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "query": self.query,
+            "started": self.started,
+            "seconds": round(self.seconds, 4),
+            "nodes": self.nodes,
+            "tools": self.tools,
+            "llm": self.llm,
+            "embeddings": self.embeddings,
+            "vector_search": self.vector_search,
+            "keyword_search": self.keyword_search,
+            "caches": self.caches,
+        }
+
+    def summary(self) -> str:
+        """Human readable summary, one line per node / tool"""
+
+        lines = [f"Query took {self.seconds:.2f}s"]
+        for node, values in sorted(self.nodes.items(), key=lambda item: -item[1]["seconds"]):
+            llm = self.llm.get(node, {})
+            llm_text = f", {llm['calls']} llm calls, {llm['prompt_tokens']} prompt / {llm['completion_tokens']} completion tokens" if llm else ""
+            lines.append(f"  {node}: {values['seconds']:.2f}s in {int(values['runs'])} runs{llm_text}")
+        for tool, values in sorted(self.tools.items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(f"  tool {tool}: {values['seconds']:.2f}s in {int(values['runs'])} calls")
+        lines.append(f"  embeddings: {self.embeddings['calls']} calls, {self.embeddings['seconds']:.2f}s; "
+                     f"vector search: {self.vector_search['calls']} calls, {self.vector_search['seconds']:.2f}s; "
+                     f"keyword search: {self.keyword_search['calls']} calls, {self.keyword_search['seconds']:.2f}s")
+        # caches the query didn't look anything up in are left out
+        used = {name: stats for name, stats in self.caches.items() if stats.get("hits", 0) + stats.get("misses", 0)}
+        if used:
+            lines.append("  cache hit rates: " + ", ".join(f"{name} {stats.get('hit_rate', 0):.0%}" for name, stats in used.items()))
+
+        return "\n".join(lines)
+
+
+_current_trace: contextvars.ContextVar[Union[QueryTrace, None]] = contextvars.ContextVar("current_trace", default=None)
+
+
+def _node(metadata: Union[Dict[str, Any], None]) -> str:
+    """Top level graph node of a run, also for the runs of the agents inside the nodes ("retriever_node:<id>|agent:<id>")"""
+    metadata = metadata or {}
+    return metadata.get("langgraph_checkpoint_ns", "").split(":")[0] or metadata.get("langgraph_node", "none")
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4) if text else 0
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Collects the node, tool and llm metrics of a graph run into the trace"""
+
+    def __init__(self, trace: QueryTrace):
+        self.trace = trace
+        # run id -> (kind, name, node, started) of the nodes and tools
+        self._runs: Dict[UUID, Tuple[str, str, str, float]] = {}
+        # run id -> (node, estimated prompt tokens) of the llm calls
+        self._llm_runs: Dict[UUID, Tuple[str, int]] = {}
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Any, *, run_id: UUID, parent_run_id: Union[UUID, None] = None,
+                       metadata: Union[Dict[str, Any], None] = None, name: Union[str, None] = None, **kwargs: Any):
+        # the node itself, not the runnables inside it (they share the metadata and the node function has the node's name)
+        node = (metadata or {}).get("langgraph_node")
+        if node in _CONST_NODES and name == node and parent_run_id not in self._runs:
+            self._runs[run_id] = ("node", node, node, time.perf_counter())
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, metadata: Union[Dict[str, Any], None] = None,
+                      name: Union[str, None] = None, **kwargs: Any):
+        self._runs[run_id] = ("tool", name or (serialized or {}).get("name", "unknown"), _node(metadata), time.perf_counter())
+
+    def _end(self, run_id: UUID):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+
+        kind, name, node, started = run
+        seconds = time.perf_counter() - started
+        if kind == "node":
+            self.trace._add(self.trace.nodes, name, runs=1, seconds=seconds)
+            registry.observe("node_seconds", seconds, node=name)
+        else:
+            self.trace._add(self.trace.tools, name, runs=1, seconds=seconds)
+            registry.observe("tool_seconds", seconds, tool=name, node=node)
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID,
+                            metadata: Union[Dict[str, Any], None] = None, **kwargs: Any):
+        # prompt estimate, replaced by the usage metadata at the end if the model reports it
+        prompt_tokens = sum(_estimate_tokens(str(message.content)) for prompt in messages for message in prompt)
+        self._llm_runs[run_id] = (_node(metadata), prompt_tokens)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        run = self._llm_runs.pop(run_id, None)
+        if run is None:
+            return
+
+        node, estimated_prompt_tokens = run
+        prompt_tokens = completion_tokens = 0
+        reported = False
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    reported = True
+                    prompt_tokens += usage.get("input_tokens", 0)
+                    completion_tokens += usage.get("output_tokens", 0)
+                else:
+                    completion_tokens += _estimate_tokens(generation.text)
+
+        if not reported:
+            prompt_tokens = estimated_prompt_tokens
+
+        self.trace._add(self.trace.llm, node, calls=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        registry.increment("llm_calls_total", node=node)
+        registry.increment("llm_prompt_tokens_total", prompt_tokens, node=node)
+        registry.increment("llm_completion_tokens_total", completion_tokens, node=node)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._llm_runs.pop(run_id, None)
+
+
+def record_embedding(kind: str, texts: int, seconds: float):
+    """An embeddings api call. kind: query or documents"""
+
+    registry.observe("embedding_seconds", seconds, kind=kind)
+    registry.increment("embedding_texts_total", texts, kind=kind)
+    trace = _current_trace.get()
+    if trace is not None:
+        with trace._lock:
+            trace.embeddings["calls"] += 1
+            trace.embeddings["texts"] += texts
+            trace.embeddings["seconds"] += seconds
+
+
+def record_vector_search(seconds: float):
+    registry.observe("vector_search_seconds", seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        with trace._lock:
+            trace.vector_search["calls"] += 1
+            trace.vector_search["seconds"] += seconds
+
+
+def record_keyword_search(seconds: float):
+    registry.observe("keyword_search_seconds", seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        with trace._lock:
+            trace.keyword_search["calls"] += 1
+            trace.keyword_search["seconds"] += seconds
+
+
+_jsonl_lock = threading.Lock()
+
+
+def _write_jsonl(trace: QueryTrace):
+    if not METRICS_JSONL_PATH:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(METRICS_JSONL_PATH) or ".", exist_ok=True)
+        with _jsonl_lock:
+            if os.path.exists(METRICS_JSONL_PATH) and os.path.getsize(METRICS_JSONL_PATH) > _CONST_JSONL_MAX_BYTES:
+                os.replace(METRICS_JSONL_PATH, METRICS_JSONL_PATH + ".1")
+        with open(METRICS_JSONL_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(trace.to_dict()) + "\n")
+    except OSError as e:
+        _logger.warning(f"Can't write the query trace to {METRICS_JSONL_PATH}: {e}")
+
+
+@contextlib.contextmanager
+def trace_query(query: str) -> Iterator[QueryTrace]:
+    """Collects the metrics of one query. Pass MetricsCallbackHandler(trace) to the graph config callbacks."""
+
+    trace = QueryTrace(query)
+    token = _current_trace.set(trace)
+    caches = cache_stats()
+    started = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.seconds = time.perf_counter() - started
+        trace.caches = _cache_delta(caches, cache_stats())
+        registry.increment("queries_total")
+        registry.observe("query_seconds", trace.seconds)
+        _write_jsonl(trace)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...], **extra: str) -> str:
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def render_prometheus() -> str:
+    """All the metrics in the Prometheus text exposition format"""
+
+    lines = []
+    with registry._lock:
+        counters = dict(registry.counters)
+        summaries = {key: list(value) for key, value in registry.summaries.items()}
+
+    for metric_type, metrics in (("counter", counters), ("summary", summaries)):
+        for name in sorted({name for name, _ in metrics}):
+            lines.append(f"# HELP {_CONST_PREFIX}{name} {_CONST_HELP.get(name, name)}")
+            lines.append(f"# TYPE {_CONST_PREFIX}{name} {metric_type}")
+            for (metric_name, labels), value in sorted(metrics.items()):
+                if metric_name != name:
+                    continue
+                if metric_type == "counter":
+                    lines.append(f"{_CONST_PREFIX}{name}{_labels(labels)} {value:g}")
+                else:
+                    lines.append(f"{_CONST_PREFIX}{name}_count{_labels(labels)} {value[0]:g}")
+                    lines.append(f"{_CONST_PREFIX}{name}_sum{_labels(labels)} {value[1]:.6f}")
+
+    stats = cache_stats()
+    for field, metric_type in (("hits", "counter"), ("misses", "counter"), ("hit_rate", "gauge")):
+        name = f"{_CONST_PREFIX}cache_{field}{'_total' if metric_type == 'counter' else ''}"
+        lines.append(f"# TYPE {name} {metric_type}")
+        for cache, values in sorted(stats.items()):
+            lines.append(f"{name}{_labels((), cache=cache)} {values.get(field, 0):g}")
+
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any):
+        _logger.debug(format % args)
+
+
+_server: Union[ThreadingHTTPServer, None] = None
+_server_lock = threading.Lock()
+
+
+def serve(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serves render_prometheus() on http://host:port/metrics from a background thread. Started once per process."""
+
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+            _logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    return _server
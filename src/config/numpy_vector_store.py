@@ -0,0 +1,240 @@
+"""
+Local vector store: exact top-k search over a memory-mapped float32 matrix, no database server.
+Selected with VECTOR_BACKEND=numpy (see config.db). For a corpus of a few (ten) thousand chunks
+a vectorized search is well under a millisecond, much less than a round trip to a remote PGVector.
+
+Files in the store directory:
+    vectors.f32 - normalized embeddings, one row of dimension float32 values per document, the row number is the sqlite rowid
+    documents.sqlite - sidecar with the id, text and metadata of each row and the dimension
+
+    - adding a document with an existing id replaces its row in place (the vector store ids are deterministic, see document_processor)
+    - new rows are appended; the memmap is re-opened when the file grew (also by another process, e.g. the ingestion workers)
+    - deleted rows are zeroed and skipped in the search
+Scores are cosine distances (1 - cosine similarity), lower is better, same as PGVector.
+"""
+import json
+import os
+import sqlite3
+import threading
+import uuid
+
+from contextlib import closing
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_CONST_VECTORS_FILE = "vectors.f32"
+_CONST_DOCUMENTS_FILE = "documents.sqlite"
+
+_CONST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    row INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    text TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _version(connection: sqlite3.Connection) -> int:
+    row = connection.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def _bump_version(connection: sqlite3.Connection):
+    connection.execute("INSERT INTO info VALUES ('version', '1') ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+
+class NumpyVectorStore(VectorStore):
+    def __init__(self, embeddings: Embeddings, path: str):
+        """
+        Args:
+            embeddings: embeddings model, the same one the store was filled with
+            path: directory of the store, created if missing
+        """
+        self._embeddings = embeddings
+        self.path = path
+        self._vectors_path = os.path.join(path, _CONST_VECTORS_FILE)
+        self._documents_path = os.path.join(path, _CONST_DOCUMENTS_FILE)
+
+        os.makedirs(path, exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.executescript(_CONST_SCHEMA)
+            row = connection.execute("SELECT value FROM info WHERE key = 'dimension'").fetchone()
+        self.dimension: Optional[int] = int(row[0]) if row else None
+
+        self._lock = threading.Lock()
+        self._matrix: Optional[np.memmap] = None
+        # deleted rows (zero based), excluded from the search
+        self._deleted = np.zeros(0, dtype=bool)
+        self._deleted_version = None
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._documents_path, timeout=30)
+
+    def _rows(self) -> int:
+        if self.dimension is None or not os.path.exists(self._vectors_path):
+            return 0
+        return os.path.getsize(self._vectors_path) // (self.dimension * 4)
+
+    def _view(self) -> Tuple[np.ndarray, np.ndarray]:
+        """The current matrix (re-mapped if the file grew) and the deleted mask"""
+
+        rows = self._rows()
+        with self._lock:
+            if rows == 0:
+                return np.zeros((0, self.dimension or 0), dtype=np.float32), np.zeros(0, dtype=bool)
+
+            if self._matrix is None or self._matrix.shape[0] != rows:
+                self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dimension))
+
+            with closing(self._connect()) as connection:
+                # bumped by every write, also of the other processes
+                version = _version(connection)
+                if version != self._deleted_version or self._deleted.shape[0] != rows:
+                    deleted = np.zeros(rows, dtype=bool)
+                    for (row,) in connection.execute("SELECT row FROM documents WHERE deleted = 1"):
+                        if row - 1 < rows:
+                            deleted[row - 1] = True
+                    self._deleted, self._deleted_version = deleted, version
+
+            return self._matrix, self._deleted
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embeddings
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, *, ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+
+        metadatas = metadatas or [{} for _ in texts]
+        ids = [id or str(uuid.uuid4()) for id in ids] if ids else [str(uuid.uuid4()) for _ in texts]
+
+        vectors = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+
+        with closing(self._connect()) as connection, connection:
+            # the write lock for the whole append, rows and file offsets stay in sync across processes
+            connection.execute("BEGIN IMMEDIATE")
+            if self.dimension is None:
+                row = connection.execute("SELECT value FROM info WHERE key = 'dimension'").fetchone()
+                self.dimension = int(row[0]) if row else vectors.shape[1]
+                connection.execute("INSERT OR IGNORE INTO info VALUES ('dimension', ?)", (str(self.dimension),))
+            if vectors.shape[1] != self.dimension:
+                raise ValueError(f"Embeddings have {vectors.shape[1]} dimensions, the store at {self.path} has {self.dimension}")
+
+            _bump_version(connection)
+
+            # not O_APPEND, pwrite would ignore the offset of the replaced rows
+            file_descriptor = os.open(self._vectors_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                for id, text, metadata, vector in zip(ids, texts, metadatas, vectors):
+                    connection.execute("""
+                        INSERT INTO documents (id, text, metadata, deleted) VALUES (?, ?, ?, 0)
+                        ON CONFLICT (id) DO UPDATE SET text = excluded.text, metadata = excluded.metadata, deleted = 0""",
+                        (id, text, json.dumps(metadata)))
+                    row = connection.execute("SELECT row FROM documents WHERE id = ?", (id,)).fetchone()[0]
+                    os.pwrite(file_descriptor, vector.tobytes(), (row - 1) * self.dimension * 4)
+            finally:
+                os.close(file_descriptor)
+
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+
+        with closing(self._connect()) as connection, connection:
+            connection.executemany("UPDATE documents SET deleted = 1 WHERE id = ?", [(id,) for id in ids])
+            _bump_version(connection)
+            if self.dimension is not None:
+                with open(self._vectors_path, "r+b") as f:
+                    for (row,) in connection.execute(f"SELECT row FROM documents WHERE id IN ({','.join('?' * len(ids))})", ids):
+                        os.pwrite(f.fileno(), bytes(self.dimension * 4), (row - 1) * self.dimension * 4)
+
+        return True
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        if not ids:
+            return []
+
+        with closing(self._connect()) as connection:
+            rows = connection.execute(f"SELECT id, text, metadata FROM documents WHERE deleted = 0 AND id IN ({','.join('?' * len(ids))})",
+                                      list(ids)).fetchall()
+
+        return [Document(id=id, page_content=text, metadata=json.loads(metadata)) for id, text, metadata in rows]
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        matrix, deleted = self._view()
+        if matrix.shape[0] == 0:
+            return []
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        similarities = matrix @ query
+        similarities[deleted] = -np.inf
+        k = min(k, int((~deleted).sum()))
+        if k <= 0:
+            return []
+
+        # exact top-k without sorting the whole array
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+
+        with closing(self._connect()) as connection:
+            rows = {row: (id, text, metadata) for row, id, text, metadata in connection.execute(
+                f"SELECT row, id, text, metadata FROM documents WHERE deleted = 0 AND row IN ({','.join('?' * len(top))})",
+                [int(index) + 1 for index in top])}
+
+        results = []
+        for index in top:
+            # appended by another process but not committed yet
+            if int(index) + 1 not in rows:
+                continue
+            id, text, metadata = rows[int(index) + 1]
+            results.append((Document(id=id, page_content=text, metadata=json.loads(metadata)), float(1.0 - similarities[index])))
+
+        return results
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k, **kwargs)
+
+    async def asimilarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        import asyncio
+
+        embedding = await self.embeddings.aembed_query(query)
+        return await asyncio.to_thread(self.similarity_search_with_score_by_vector, embedding, k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        return self._cosine_relevance_score_fn
+
+    def __len__(self) -> int:
+        with closing(self._connect()) as connection:
+            return connection.execute("SELECT COUNT(*) FROM documents WHERE deleted = 0").fetchone()[0]
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, *,
+                   ids: Optional[List[str]] = None, path: str = "data/vector_store", **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(embedding, path)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
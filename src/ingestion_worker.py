@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Ingestion worker - inserts the files queued by the upload tab (see agents/ingestion_queue.py).
+The UI starts INGESTION_WORKERS of them on its own, but they can also be started by hand:
+    python src/ingestion_worker.py [--workers N] [--exit-when-idle]
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import logging
+import multiprocessing
+
+from agents import ingestion_queue
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingestion worker of the upload queue')
+    parser.add_argument('--workers', type=int, default=1, help='How many worker processes to run')
+    parser.add_argument('--poll-seconds', type=float, default=1.0, help='How often an idle worker checks the queue')
+    parser.add_argument('--exit-when-idle', action='store_true', help='Stop once the queue is empty')
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        ingestion_queue.run_worker(args.poll_seconds, args.exit_when_idle)
+        return
+
+    processes = [
+        multiprocessing.Process(target=ingestion_queue.run_worker, args=(args.poll_seconds, args.exit_when_idle))
+        for _ in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,34 @@
+import os
 
-from typing import List, Union
-from pydantic import Field
+from typing import Annotated, List, Union
+from pydantic import BaseModel, Field
 
 from config.models import llm
 
 from langgraph.prebuilt.chat_agent_executor import AgentState
 
+class DocumentRef(BaseModel):
+    """Reference to a document in the state. The contents are loaded only when a node needs them (see agents.document_refs)"""
+    source: str = Field(description="file name in the document storage or series_store:<lookup parameters>")
+    hash: str = Field(description="sha256 of the contents")
+
+# The state is carried over the turns of a chat, only the most recently retrieved documents are kept
+_CONST_MAX_DOCUMENTS = int(os.getenv("STATE_MAX_DOCUMENTS", "16"))
+
+def merge_documents(current: List[DocumentRef], new: List[DocumentRef]) -> List[DocumentRef]:
+    """documents reducer: appends the new references, a reference already in the state (same contents) moves to the end.
+    Keeps the last _CONST_MAX_DOCUMENTS, so the prompts of a long chat don't get all the documents of the earlier questions.
+    """
+    new = list(new or [])
+    hashes = {document.hash for document in new}
+    merged = [document for document in current or [] if document.hash not in hashes]
+    for document in new:
+        if document.hash in hashes:
+            hashes.remove(document.hash)
+            merged.append(document)
+            
+    return merged[-_CONST_MAX_DOCUMENTS:]
+
 class ApplicationState(AgentState):
-    documents: List[str] = Field(description="raw file contents of the documents")
-    images_or_error: Union[List[str], str] = Field(description="array of image paths returned from the visualizer agent or error string why it wasn't generated")
\ No newline at end of file
+    documents: Annotated[List[DocumentRef], merge_documents] = Field(description="references to the retrieved documents")
+    images_or_error: Union[List[str], str] = Field(description="array of image paths returned from the visualizer agent or error string why it wasn't generated")
@@ -1,4 +1,5 @@
 """Render the chat part of the app"""
+import os
 import streamlit as st
 import logging;
 
@@ -6,6 +7,26 @@ logger = logging.getLogger(__name__)
 
 
 print ()
+
+_CONST_MISSING_CHART_TEXT = "The chart is no longer available, ask the question again to draw it."
+
+def _read_images(images):
+    """Bytes of the chart images. The chat history keeps the bytes, not the paths:
+    the chart cache evicts its files and the visualizer tempfiles are garbage collected (see agents.chart_cache).
+    None for an image that is already gone.
+    """
+    if not isinstance(images, list):
+        return images
+    
+    contents = []
+    for path in images:
+        try:
+            with open(path, "rb") as f:
+                contents.append(f.read())
+        except OSError:
+            logger.warning(f"Chart image {path} is missing")
+            contents.append(None)
+    return contents
     
 def render_styles():
     st.markdown("""
@@ -62,7 +83,16 @@ def render():
     from langgraph.errors import GraphRecursionError
 
     import app
+    from config import metrics
     from agents.document_processor import get_overview
+    from agents import chart_sandbox
+    
+    # chart workers import matplotlib in the background while the user types
+    chart_sandbox.warm_up()
+    
+    # Prometheus scrape endpoint, started once per process
+    if os.getenv("METRICS_PORT"):
+        metrics.serve(int(os.getenv("METRICS_PORT")))
     
     if "messages" not in st.session_state:
         st.session_state["messages"] = []
@@ -85,20 +115,37 @@ def render():
         st.session_state.user_input = ""  # Clear input field after submitting
         st.session_state["messages"].append(HumanMessage(user_input))
         
-        state = app.query(user_input, st.session_state["state"])
+        # The analyst answer is streamed in here while the graph runs. Once done, it's rendered with the rest of the messages.
+        status = st.status("Searching the knowledge base...")
+        answer_placeholder = st.empty()
+        answer = ""
+        state = None
+        for event, payload in app.stream_query(user_input, st.session_state["state"]):
+            if event == "node":
+                status.write(f"{payload.replace('_node', '')} finished")
+            elif event == "token":
+                answer += payload
+                answer_placeholder.markdown(answer)
+            elif event == "trace":
+                status.text(payload.summary())
+            else:
+                state = payload
+        
+        status.update(label="Done", state="complete")
+        answer_placeholder.empty()
         
         # TODO: handle recursion error
         if isinstance(state, GraphRecursionError):
             st.session_state["messages"].append(AIMessage("Retrieval failed, please try again in a moment"))
         else:
             # Take one before the last message, since the last message is the vizualizer, where we don't care about the content    
-            analyst_message = AIMessage(state["messages"][-1].content, images=state["images_or_error"])
+            analyst_message = AIMessage(state["messages"][-1].content, images=_read_images(state["images_or_error"]))
             st.session_state["messages"].append(analyst_message)
             st.session_state["state"] = state
         
 
     # Description or instructions
-    st.html(f"Knowledge base summary: <br />{st.session_state["summary"]}<hr />")
+    st.html(f"Knowledge base summary: <br />{st.session_state['summary']}<hr />")
     st.text_input("Ask a question:", placeholder="Type your question here...", key="user_input", on_change=handle_user_input())
      
     with st.container(key="messages-container"):
@@ -122,7 +169,10 @@ def render():
 
             if hasattr(message, "images") and isinstance(message.images, list):
                 for image in message.images:
-                    st.image(image)
+                    if image is None:
+                        st.caption(_CONST_MISSING_CHART_TEXT)
+                    else:
+                        st.image(image)
                     
                     
     render_styles()
@@ -1,51 +1,55 @@
 """Render file uploading tab"""
-import os
 import streamlit as st
-import tempfile
 
 _CONST_TMP_FILE_DIR = "data/tmp_files"
 
+# How often the status of the queued files is refreshed
+_CONST_POLL_SECONDS = 2
+
+@st.fragment(run_every=_CONST_POLL_SECONDS)
+def _render_jobs():
+    """Status of the files queued in this session. Only this fragment is re-run while polling, not the whole page"""
+    from agents import ingestion_queue
+
+    job_ids = list(st.session_state["ingestion_jobs"].values())
+    if not job_ids:
+        return
+
+    jobs = ingestion_queue.get_jobs(job_ids)
+    st.dataframe(
+        [{"file": job.file_name, "status": job.status, "stage": job.stage, "attempts": job.attempts, "result": job.result or ""} for job in jobs],
+        hide_index=True,
+    )
+
+    if any(job.status in ("queued", "running") for job in jobs):
+        # workers may have died since the upload, a crashed job is picked up again by the new ones
+        ingestion_queue.ensure_workers()
+        st.caption("Files are processed in the background, you can keep chatting in the meantime.")
+
 def render():
 # Set the app title
-    from agents import document_processor 
+    from agents import ingestion_queue, uploads
 
     st.title("Multiple File Upload in Streamlit")
 
     # File uploader with multiple file support
     uploaded_files = st.file_uploader(
-        "Upload your files (you can select multiple)", 
+        "Upload your files (you can select multiple)",
         accept_multiple_files=True
     )
 
-    # print(uploaded_files)
-    
-    if uploaded_files and len(uploaded_files):
-        all_insert_results = [];
-        for file in uploaded_files:
-            filecontent = file.getvalue().decode("utf-8")
-
-            name, extension = os.path.splitext(file.name)
-            
-            # Generated file name will be original_name_XXXXX.ext
-            with tempfile.NamedTemporaryFile(dir=os.path.join(_CONST_TMP_FILE_DIR), prefix=name + "_", suffix=extension, delete=True, mode="w") as temp_file:
-                temp_file.write(filecontent)
-                temp_file.flush()
-                
-                insert_result_or_error = document_processor.insert_file_into_vector(temp_file.name)
-                    
-                if isinstance(insert_result_or_error, list):
-                    all_insert_results.extend(insert_result_or_error)
-                else:
-                    all_insert_results.append(insert_result_or_error)
-                
-        document_processor.update_overview()
-        
-        st.session_state["summary"] = document_processor.get_overview().replace("\n", "<br />");
-        
-        st.html("<br />".join(all_insert_results))
-            
-                
-            
-    
-            
-    
\ No newline at end of file
+    # uploader file id -> ingestion job id. The uploader keeps its files between the reruns, each one is queued only once.
+    if "ingestion_jobs" not in st.session_state:
+        st.session_state["ingestion_jobs"] = {}
+
+    new_files = [file for file in uploaded_files or [] if file.file_id not in st.session_state["ingestion_jobs"]]
+    if new_files:
+        for file in new_files:
+            # streamed to disk in chunks and hashed on the way, the worker links the saved file into the storage
+            file.seek(0)
+            upload = uploads.save_upload(file, _CONST_TMP_FILE_DIR, file.name)
+            st.session_state["ingestion_jobs"][file.file_id] = ingestion_queue.enqueue(upload.path, file.name, upload.content_hash)
+
+        ingestion_queue.ensure_workers()
+
+    _render_jobs()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Creates and tunes the indexes of the PGVector table (langchain_pg_embedding). Without them every search is a sequential scan
+over all the embeddings.
+    - ANN index on the embedding column: hnsw (default, better speed/recall trade-off, no training step)
+      or ivfflat (smaller and faster to build, its lists are computed from the current rows - build it after the ingestion)
+    - GIN (jsonb_path_ops) on cmetadata for the metadata filters, btree on collection_id
+    - ANALYZE at the end
+The embedding column has to have a fixed dimension for the ANN index, an untyped one is altered to vector(N).
+The table is shared by all the collections, so is the index (the app has a single one, auto_insurance).
+The search time settings (ef_search, probes) are set on the pooled connections in config/db.py.
+
+Usage:
+    python src/vector_indexes.py [--index hnsw|ivfflat] [--m 16] [--ef-construction 64] [--lists N] [--rebuild] [--maintenance-work-mem 1GB]
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import math
+
+from sqlalchemy import text
+
+from config import db
+
+_CONST_TABLE = "langchain_pg_embedding"
+
+_CONST_ANN_INDEXES = {
+    "hnsw": "ix_langchain_pg_embedding_hnsw",
+    "ivfflat": "ix_langchain_pg_embedding_ivfflat",
+}
+# same name langchain_postgres gives it on the tables it creates itself
+_CONST_METADATA_INDEX = "ix_cmetadata_gin"
+_CONST_COLLECTION_INDEX = "ix_langchain_pg_embedding_collection_id"
+
+# operator class for the distance strategy of the store (DistanceStrategy values)
+_CONST_OPERATOR_CLASSES = {
+    "cosine": "vector_cosine_ops",
+    "l2": "vector_l2_ops",
+    "inner": "vector_ip_ops",
+}
+
+
+def _dimensions(connection) -> int:
+    """Dimension of the embedding column. An untyped column is altered to the dimension of the stored embeddings."""
+
+    typmod = connection.execute(text("SELECT atttypmod FROM pg_attribute WHERE attrelid = CAST(:table AS regclass) AND attname = 'embedding'"),
+                                {"table": _CONST_TABLE}).scalar()
+    if typmod and typmod > 0:
+        return typmod
+
+    dimensions = connection.execute(text(f"SELECT DISTINCT vector_dims(embedding) FROM {_CONST_TABLE} LIMIT 2")).scalars().all()
+    if len(dimensions) > 1:
+        raise ValueError(f"The table has embeddings of different sizes ({dimensions}), they can't share an index")
+    # empty table, the size the current model gives
+    dimension = dimensions[0] if dimensions else len(db.embeddings.embed_query("dimension"))
+
+    print(f"Altering {_CONST_TABLE}.embedding to vector({dimension}) ...")
+    connection.execute(text(f"ALTER TABLE {_CONST_TABLE} ALTER COLUMN embedding TYPE vector({dimension})"))
+    return dimension
+
+
+def _drop_invalid_indexes(connection):
+    """A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind, IF NOT EXISTS would skip it"""
+
+    invalid = connection.execute(text("""
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = CAST(:table AS regclass) AND NOT i.indisvalid"""), {"table": _CONST_TABLE}).scalars().all()
+    for name in invalid:
+        print(f"Dropping invalid index {name}")
+        connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+
+def _ivfflat_lists(connection) -> int:
+    """pgvector's recommendation: rows / 1000 up to 1M rows, sqrt(rows) above"""
+
+    rows = connection.execute(text(f"SELECT COUNT(*) FROM {_CONST_TABLE}")).scalar()
+    if rows == 0:
+        raise ValueError("ivfflat lists are computed from the existing rows, insert the documents first (or use hnsw)")
+    return max(1, rows // 1000) if rows <= 1_000_000 else int(math.sqrt(rows))
+
+
+def create_indexes(index: str = "hnsw", m: int = 16, ef_construction: int = 64, lists: int = None,
+                   rebuild: bool = False, maintenance_work_mem: str = "512MB"):
+    """Creates the missing indexes, without locking the table for writes (CONCURRENTLY).
+
+    Args:
+        index: ANN index type, hnsw or ivfflat. The index of the other type is dropped.
+        m: hnsw - connections per node
+        ef_construction: hnsw - candidate list size while building
+        lists: ivfflat - number of lists, computed from the row count when not given
+        rebuild: drop and create the ANN index again, e.g. with other parameters or after a large ingestion (ivfflat)
+        maintenance_work_mem: memory for the build, hnsw builds much faster when the graph fits
+    """
+    operator_class = _CONST_OPERATOR_CLASSES[db.vector_store._distance_strategy.value]
+
+    # CREATE INDEX CONCURRENTLY can't run in a transaction
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+        version = connection.execute(text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")).scalar()
+        if index == "hnsw" and tuple(int(part) for part in version.split(".")[:2]) < (0, 5):
+            raise ValueError(f"hnsw needs pgvector 0.5.0 or newer, the database has {version}")
+
+        connection.execute(text(f"SET maintenance_work_mem = '{maintenance_work_mem}'"))
+        _drop_invalid_indexes(connection)
+        dimension = _dimensions(connection)
+
+        for kind, name in _CONST_ANN_INDEXES.items():
+            if kind != index or rebuild:
+                connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+        if index == "hnsw":
+            parameters = f"m = {m}, ef_construction = {ef_construction}"
+        else:
+            parameters = f"lists = {lists or _ivfflat_lists(connection)}"
+
+        print(f"Creating {index} index ({operator_class}, {parameters}) on {dimension} dimensional embeddings ...")
+        connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {_CONST_ANN_INDEXES[index]} "
+                                f"ON {_CONST_TABLE} USING {index} (embedding {operator_class}) WITH ({parameters})"))
+
+        print("Creating metadata and collection indexes ...")
+        connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {_CONST_METADATA_INDEX} "
+                                f"ON {_CONST_TABLE} USING gin (cmetadata jsonb_path_ops)"))
+        connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {_CONST_COLLECTION_INDEX} "
+                                f"ON {_CONST_TABLE} (collection_id)"))
+
+        connection.execute(text(f"ANALYZE {_CONST_TABLE}"))
+
+        for name, size in connection.execute(text("""
+                SELECT indexrelname, pg_size_pretty(pg_relation_size(indexrelid)) FROM pg_stat_user_indexes
+                WHERE relname = :table ORDER BY indexrelname"""), {"table": _CONST_TABLE}):
+            print(f"  {name}: {size}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create the ANN and metadata indexes of the PGVector table')
+    parser.add_argument('--index', choices=['hnsw', 'ivfflat'], default='hnsw', help='ANN index type')
+    parser.add_argument('--m', type=int, default=16, help='hnsw: connections per node')
+    parser.add_argument('--ef-construction', type=int, default=64, help='hnsw: candidate list size while building')
+    parser.add_argument('--lists', type=int, help='ivfflat: number of lists (default: rows / 1000)')
+    parser.add_argument('--rebuild', action='store_true', help='Drop and create the ANN index again')
+    parser.add_argument('--maintenance-work-mem', type=str, default='512MB', help='Memory for the index build')
+    args = parser.parse_args()
+
+    if not hasattr(db, "engine"):
+        print("VECTOR_BACKEND isn't pgvector, nothing to index")
+        return
+
+    create_indexes(args.index, args.m, args.ef_construction, args.lists, args.rebuild, args.maintenance_work_mem)
+    print("Done. Tune the search with PGVECTOR_HNSW_EF_SEARCH / PGVECTOR_IVFFLAT_PROBES")
+
+
+if __name__ == "__main__":
+    main()
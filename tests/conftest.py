@@ -0,0 +1,12 @@
+"""
+The app modules are imported from src/, with the fake llm and embeddings of the offline benchmark
+(no api keys or database needed, see benchmarks/offline/fakes.py).
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from benchmarks.offline import fakes
+
+fakes.install(fakes.FakeChatModel(), fakes.HashingEmbeddings())
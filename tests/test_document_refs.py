@@ -0,0 +1,19 @@
+from agents import document_refs, series_store
+
+
+def test_revised_series_values_are_not_cached_under_the_old_hash(monkeypatch):
+    csv = {"contents": "series,period\nA,2010\n"}
+    monkeypatch.setattr(series_store, "query", lambda **parameters: [])
+    monkeypatch.setattr(series_store, "to_csv", lambda values: csv["contents"])
+
+    ref = document_refs._ref(document_refs._CONST_SERIES_PREFIX + '{"series": "A"}', csv["contents"])
+
+    # revised after the lookup, the current values are loaded but not kept for ref.hash
+    csv["contents"] = "series,period\nA,2011\n"
+    assert document_refs.load([ref]) == ["series,period\nA,2011\n"]
+    assert document_refs._series_lookups.get(ref.hash) is None
+
+    # back to the values the hash stands for, those are cached
+    csv["contents"] = "series,period\nA,2010\n"
+    assert document_refs.load([ref]) == ["series,period\nA,2010\n"]
+    assert document_refs._series_lookups.get(ref.hash) == "series,period\nA,2010\n"
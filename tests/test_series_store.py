@@ -0,0 +1,33 @@
+import pytest
+
+from agents import series_store
+from agents.table_extractor import ExtractedTable, TableRow
+
+
+@pytest.fixture(autouse=True)
+def _series_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(series_store, "SERIES_DB_PATH", str(tmp_path / "series.sqlite"))
+    monkeypatch.setattr(series_store, "_initialized", False)
+
+
+def test_yearly_rows_under_a_section_heading_are_stored_by_year():
+    # the labels table_extractor gives the yearly rows under the "Liability" and "Physical damage" headings
+    table = ExtractedTable(
+        title="Commercial Auto Insurance Losses, 2004-2005",
+        label_header="Year",
+        columns=["Claim frequency", "Claim severity"],
+        rows=[
+            TableRow(label="Liability 2004", values={"Claim frequency": "1.10", "Claim severity": "$9,000"}),
+            TableRow(label="Liability 2005", values={"Claim frequency": "1.05", "Claim severity": "$9,500"}),
+            TableRow(label="Physical damage 2004", values={"Claim frequency": "3.20", "Claim severity": "$2,100"}),
+            TableRow(label="Physical damage 2005", values={"Claim frequency": "3.10", "Claim severity": "$2,200"}),
+        ],
+    )
+    keys = series_store.add_table(table, "commercial_auto.xls")
+
+    assert ("Commercial Auto Insurance Losses", "2005", "Liability") in keys
+    values = series_store.query("commercial auto insurance losses", "claim frequency", 2005, 2005)
+    assert [(value.label, value.year, value.raw_value) for value in values] == [("Liability", 2005, "1.05"), ("Physical damage", 2005, "3.10")]
+
+    [row] = series_store.canonical_rows([("Commercial Auto Insurance Losses", "2004", "Physical damage")])
+    assert "2004, Physical damage, Claim frequency: 3.20" in row.text
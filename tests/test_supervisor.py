@@ -0,0 +1,46 @@
+from langchain_core.messages import HumanMessage
+from langgraph.graph import END
+
+from agents import retriever
+from agents.supervisor import _route
+from state_schemas import DocumentRef
+
+
+def _retriever_message(documents):
+    """The message retriever_node adds to the state, for an agent result with these documents"""
+    command = retriever._command({"messages": [HumanMessage("Here's what I found")], "documents": documents})
+    return command.update["messages"][0]
+
+
+def test_first_turn_goes_to_the_analyst_when_the_retriever_found_documents():
+    documents = [DocumentRef(source="expenditures.xls", hash="a")]
+    state = {"messages": [HumanMessage("Average expenditure in 2010?"), _retriever_message(documents)], "documents": documents}
+
+    assert _route(state) == "analyst_node"
+
+
+def test_empty_retrieval_of_a_follow_up_falls_back_to_the_llm():
+    documents = [DocumentRef(source="expenditures.xls", hash="a")]
+    first_turn = [
+        HumanMessage("Average expenditure in 2010?"),
+        _retriever_message(documents),
+        HumanMessage("It was $800", name="analyst"),
+    ]
+    # the documents of the first question stay in the state (see state_schemas.merge_documents)
+    state = {"messages": first_turn + [HumanMessage("And the number of hurricanes in 2010?"), _retriever_message([])], "documents": documents}
+
+    assert _route(state) is None
+
+
+def test_follow_up_without_a_chart_ends_after_the_analyst():
+    documents = [DocumentRef(source="expenditures.xls", hash="a"), DocumentRef(source="cpi.xls", hash="b")]
+    state = {"messages": [
+        HumanMessage("Average expenditure in 2010?"),
+        _retriever_message(documents[:1]),
+        HumanMessage("It was $800", name="analyst"),
+        HumanMessage("And the motor vehicle insurance index?"),
+        _retriever_message(documents[1:]),
+        HumanMessage("It was 400", name="analyst"),
+    ], "documents": documents}
+
+    assert _route(state) == END